@@ -0,0 +1,278 @@
+"""
+Batch runner which simulates every configuration file of a directory or glob pattern in parallel, and consolidates the
+statistics of all the configurations into one comparison table.
+"""
+import argparse
+import csv
+import glob
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import main
+from CityConfig import CityConfig
+
+# Columns of the comparison table written by run_batch()
+comparison_columns = ['configuration', 'mean_response_time', 'success_percentage', 'emergencies', 'wall_time_seconds',
+                      'peak_memory_mb', 'status']
+# Extensions of the configuration files simulated when a directory is given (see main.configure_city_file())
+configuration_extensions = ['.txt', '.json', '.toml']
+# Approximate memory used by a worker process before configuring a city, in megabytes
+worker_base_memory_mb = 80
+
+
+def find_configuration_files(configurations: str) -> list:
+    """
+    Lists the configuration files to be simulated, given either a directory (all the text, JSON and TOML configuration
+    files in it) or a glob pattern of configuration files.
+    :param configurations: Directory or glob pattern of configuration files
+    :return: Sorted list of paths of the configuration files
+    >>> [os.path.basename(path) for path in find_configuration_files('config/*_ps.txt')]
+    ['corner_medium_ps.txt', 'hybrid_medium_ps.txt', 'inner_medium_ps.txt', 'large_ps.txt', 'small_ps.txt']
+    >>> len(find_configuration_files('config'))
+    13
+    >>> find_configuration_files('config/missing_*.txt')
+    []
+    """
+    if os.path.isdir(configurations):
+        return sorted(path for extension in configuration_extensions
+                      for path in glob.glob(os.path.join(configurations, f'*{extension}')))
+    return sorted(glob.glob(configurations))
+
+
+def estimate_memory_mb(configuration_path: str) -> float:
+    """
+    Estimates the memory required by a worker process to simulate a configuration file, from the dimensions of the city
+    and the number of emergency units configured in it, without constructing the city. The estimate is dominated by the
+    travel time table from every unit to every coordinate of the city (see City.build_travel_time_table()). An invalid
+    structured configuration file is estimated at the base memory of a worker, as it is rejected before its city is
+    constructed.
+    :param configuration_path: Path of the configuration file
+    :return: Estimated memory in megabytes
+    >>> round(estimate_memory_mb('config/corner_medium_ps.txt'), 2)
+    80.05
+    """
+    dimensions = {'height': 1, 'width': 1}
+    number_of_units = 0
+    if configuration_path.endswith(('.json', '.toml')):
+        try:
+            config = CityConfig.load(configuration_path)
+        except (OSError, ValueError):
+            return worker_base_memory_mb
+        dimensions = {'height': config.height, 'width': config.width}
+        number_of_units = sum(len(locations) for locations in config.buildings.values())
+    else:
+        with open(configuration_path, 'r') as f:
+            for line in f:
+                dimension = re.match(r'\s*(height|width)\s+(\d+)', line, re.IGNORECASE)
+                if dimension:
+                    dimensions[dimension.group(1).lower()] = int(dimension.group(2))
+                elif re.match(r'\s*\d+\s*,\s*\d+', line):
+                    number_of_units += 1
+    number_of_nodes = dimensions['height'] * dimensions['width'] * main.City.zone_dimension ** 2
+    # Travel time table and its temporary copy while rebuilt, and the graph arrays of the city
+    table_bytes = 2 * 8 * number_of_units * number_of_nodes
+    graph_bytes = 200 * number_of_nodes
+    return worker_base_memory_mb + (table_bytes + graph_bytes) / 2 ** 20
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of the current process, None where it can't be measured (the resource module is not available
+    on Windows).
+    :return: Peak resident memory in megabytes
+    >>> peak = peak_memory_mb()
+    >>> peak is None or peak > 0
+    True
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is measured in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def write_series(configuration_path: str, series_directory: str, resp_times: list, perc_successful: list):
+    """
+    Writes the average response time and percentage of successfully responded emergencies after each run of a
+    configuration to <name>_resptime.csv and <name>_percsuccessful.csv, named after the configuration file, in the
+    format of the series of results/ written by the notebooks.
+    :param configuration_path: Path of the configuration file
+    :param series_directory: Directory of the CSV files written
+    :param resp_times: Average response time after each run
+    :param perc_successful: Percentage of successfully responded emergencies after each run
+    :return: None
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> write_series('config/demo.txt', directory, [7.5, 7.0], [80.0, 82.5])
+    >>> with open(os.path.join(directory, 'demo_resptime.csv')) as f:
+    ...     f.read().splitlines()
+    [',Average Response Time', '1,7.5', '2,7.0']
+    """
+    name = os.path.splitext(os.path.basename(configuration_path))[0]
+    os.makedirs(series_directory, exist_ok=True)
+    for suffix, column, series in [('resptime', 'Average Response Time', resp_times),
+                                   ('percsuccessful', 'Percentage of Successfully Responded Emergencies',
+                                    perc_successful)]:
+        with open(os.path.join(series_directory, f'{name}_{suffix}.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['', column])
+            writer.writerows((run, float(value)) for run, value in enumerate(series, start=1))
+
+
+def run_configuration(configuration_path: str, seed: int = None, result_cache_directory: str = None,
+                      series_directory: str = None) -> dict:
+    """
+    Configures the city of a configuration file and simulates it, in a worker process of run_batch().
+    :param configuration_path: Path of the configuration file
+    :param seed: Seed of the simulation
+    :param result_cache_directory: Directory of a ResultCache of the results of the simulations
+    :param series_directory: Directory where the series of the statistics after each run are written (see
+    write_series()), not written if not given
+    :return: Dictionary of the statistics of the configuration, keyed by the columns of the comparison table
+    """
+    start = time.perf_counter()
+    row = dict.fromkeys(comparison_columns)
+    row['configuration'] = configuration_path
+    try:
+        city, base_rate, base_population = main.configure_city_file(os.path.basename(configuration_path),
+                                                                    os.path.dirname(configuration_path) or '.')
+    except OSError as e:
+        print(e)
+        city = None
+    if city is None:
+        row['status'] = 'invalid configuration'
+    else:
+        result_cache = None
+        if result_cache_directory is not None:
+            from ResultCache import ResultCache
+            result_cache = ResultCache(result_cache_directory)
+        resp_times, perc_successful, number_of_emergencies, _ = main.simulate(city, base_rate, base_population, seed,
+                                                                              show_progress=False,
+                                                                              result_cache=result_cache)
+        if number_of_emergencies == []:
+            row['status'] = 'failed'
+        else:
+            row['mean_response_time'] = resp_times[-1]
+            row['success_percentage'] = perc_successful[-1]
+            row['emergencies'] = number_of_emergencies
+            row['status'] = 'ok'
+            if series_directory is not None:
+                write_series(configuration_path, series_directory, resp_times, perc_successful)
+    row['wall_time_seconds'] = round(time.perf_counter() - start, 3)
+    # Peak resident memory of the worker, which only simulates this configuration
+    row['peak_memory_mb'] = peak_memory_mb()
+    return row
+
+
+def run_batch(configurations: str, workers: int = None, memory_limit_mb: float = None, seed: int = None,
+              output_file: str = 'results/batch_comparison.csv', result_cache_directory: str = None,
+              series_directory: str = None) -> list:
+    """
+    Simulates every configuration file of a directory or glob pattern, scheduling the configurations across a pool of
+    worker processes, and writes the statistics of all the configurations to one comparison table (CSV file) with the
+    mean response time, percentage of successfully responded emergencies, number of emergencies and wall time of each
+    configuration. Every configuration is simulated in a fresh worker process. If a memory limit is given, a
+    configuration is only started when the estimated memory of all the running configurations stays within the limit
+    (see estimate_memory_mb()), so that the workers together don't exceed it; a configuration estimated to need more
+    than the whole limit is simulated on its own. A configuration whose worker fails, e.g. killed when out of memory,
+    is recorded with the status failed instead of aborting the batch.
+    :param configurations: Directory or glob pattern of configuration files
+    :param workers: Maximum number of worker processes, defaults to the number of CPUs
+    :param memory_limit_mb: Limit of the total memory of the worker processes, in megabytes
+    :param seed: Seed of the simulation of every configuration, so all configurations are compared on equal terms
+    :param output_file: Path of the comparison table written
+    :param result_cache_directory: Directory of a ResultCache, so that configurations already simulated with the same
+    seed are not simulated again
+    :param series_directory: Directory where the series of the statistics after each run of every configuration are
+    written (see write_series()), e.g. results/ to regenerate the series plotted by the notebooks
+    :return: List of dictionaries of the statistics of each configuration, in the order of the configuration files
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> with open(os.path.join(directory, 'tiny.txt'), 'w') as f:
+    ...     _ = f.write('Dimensions\\nHeight 1\\nWidth 1\\nPopulation distribution\\n5000\\nIntensity\\n1 0 0 0 0\\n'
+    ...                 'Small building\\n2\\n1,1\\n0,0\\nEmergency rate\\n1 200000\\n')
+    >>> with open(os.path.join(directory, 'broken.txt'), 'w') as f:
+    ...     _ = f.write('Dimensions\\nHeight 1\\nWidth -1\\n')
+    >>> rows = run_batch(directory, workers=2, memory_limit_mb=1000, seed=3,
+    ...                  output_file=os.path.join(directory, 'comparison.csv'), series_directory=directory)
+    >>> [(os.path.basename(row['configuration']), row['status']) for row in rows]
+    [('broken.txt', 'invalid configuration'), ('tiny.txt', 'ok')]
+    >>> rows[1]['mean_response_time'] < 10 and rows[1]['emergencies'] > 0
+    True
+    >>> with open(os.path.join(directory, 'comparison.csv')) as f:
+    ...     [row['configuration'].endswith('tiny.txt') for row in csv.DictReader(f)]
+    [False, True]
+    >>> sorted(name for name in os.listdir(directory) if name.startswith('tiny_'))
+    ['tiny_percsuccessful.csv', 'tiny_resptime.csv']
+    >>> from CityConfig import convert_text_config
+    >>> structured = tempfile.mkdtemp()
+    >>> convert_text_config('tiny.txt', directory).save(os.path.join(structured, 'tiny.json'))
+    >>> rows = run_batch(structured, workers=1, seed=3, output_file=os.path.join(structured, 'comparison.csv'))
+    >>> [(os.path.basename(row['configuration']), row['status']) for row in rows]
+    [('tiny.json', 'ok')]
+    """
+    configuration_paths = find_configuration_files(configurations)
+    workers = os.cpu_count() if workers is None else workers
+    estimates = {path: estimate_memory_mb(path) for path in configuration_paths}
+    pending = list(configuration_paths)
+    running = {}
+    results = {}
+    executor = ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1)
+    try:
+        while pending or running:
+            # Start configurations while there are free workers and their estimated memory fits within the limit
+            while pending and len(running) < workers:
+                memory_in_use = sum(estimates[path] for path in running.values())
+                if running and memory_limit_mb is not None and \
+                        memory_in_use + estimates[pending[0]] > memory_limit_mb:
+                    break
+                try:
+                    future = executor.submit(run_configuration, pending[0], seed, result_cache_directory,
+                                             series_directory)
+                except BrokenProcessPool:
+                    # A worker was killed, the configurations still running in the pool fail with it
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1)
+                    continue
+                running[future] = pending.pop(0)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path = running.pop(future)
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    # A worker killed (e.g. out of memory) or an unexpected error only fails its configuration
+                    print(f"Simulation of {path} failed: {e!r}")
+                    results[path] = dict.fromkeys(comparison_columns, None)
+                    results[path].update(configuration=path, status='failed')
+    finally:
+        executor.shutdown()
+    rows = [results[path] for path in configuration_paths]
+    output_directory = os.path.dirname(output_file)
+    if output_directory:
+        os.makedirs(output_directory, exist_ok=True)
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=comparison_columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a batch of city configuration files in parallel.')
+    parser.add_argument('configurations', help='Directory or glob pattern of configuration files')
+    parser.add_argument('--workers', type=int, default=None, help='Maximum number of worker processes')
+    parser.add_argument('--memory-limit', type=float, default=None, help='Total memory limit of the workers in MB')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the simulation of every configuration')
+    parser.add_argument('--output', default='results/batch_comparison.csv', help='Path of the comparison table')
+    parser.add_argument('--result-cache', default=None, help='Directory of the cache of the results of the simulations')
+    parser.add_argument('--series-directory', default=None,
+                        help='Directory of the series of the statistics after each run of every configuration')
+    arguments = parser.parse_args()
+    run_batch(arguments.configurations, arguments.workers, arguments.memory_limit, arguments.seed, arguments.output,
+              arguments.result_cache, arguments.series_directory)
@@ -0,0 +1,213 @@
+"""
+Benchmark suite timing the hot paths of the simulation over a range of city sizes and numbers of emergency units, with
+baselines saved as JSON files so that the performance of commits can be compared.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from CityConfiguration import City
+from Emergency import Emergency
+from EmergencyUnit import EmergencyUnit, UnitIndex
+import main
+
+# Number of zones along each side of the cities benchmarked, and numbers of emergency units placed in them
+zone_sizes = [2, 10, 25, 50]
+unit_counts = [5, 50, 200]
+# Number of emergencies allocated teams by the allocation benchmark
+allocated_emergencies = 200
+
+
+def measure(function, repeat: int = 3) -> tuple:
+    """
+    Times a function, keeping the fastest of several calls, and measures the peak memory allocated during a call.
+    :param function: Function called without arguments
+    :param repeat: Number of timed calls
+    :return: Fastest time of a call in seconds, and peak memory allocated during a call in megabytes
+    >>> seconds, peak_memory_mb = measure(lambda: np.ones(2 ** 20), repeat=2)
+    >>> seconds > 0, round(peak_memory_mb)
+    (True, 8)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def create_units(city: City, number_of_units: int, rng: np.random.Generator) -> list:
+    """
+    Creates emergency units of every size at distinct random coordinates of a city, replacing the units configured.
+    :param city: City where the units are placed
+    :param number_of_units: Number of units
+    :param rng: Numpy random number generator
+    :return: List of the emergency units
+    """
+    EmergencyUnit.clear_emergency_buildings()
+    nodes = rng.choice(city.number_of_nodes, number_of_units, replace=False)
+    columns = city.width * City.zone_dimension
+    sizes = list(EmergencyUnit.type_to_capacity_mapping)
+    return [EmergencyUnit(sizes[i % len(sizes)], (int(node) // columns, int(node) % columns))
+            for i, node in enumerate(nodes.tolist())]
+
+
+def simulate_layout(city: City, unit_list: list, base_rate_for_emergency: float, base_population: int,
+                    number_of_runs: int):
+    """
+    Simulates a city with emergency units at the locations and of the sizes of a list of units, configured anew for
+    every call as main.simulate() clears the emergency units of the city once done.
+    :param city: City simulated
+    :param unit_list: List of the emergency units whose sizes and locations are configured
+    :param base_rate_for_emergency: Emergency rate per unit minute, for the base population
+    :param base_population: Base population of the emergency rate
+    :param number_of_runs: Number of simulation runs
+    :return: None
+    """
+    EmergencyUnit.clear_emergency_buildings()
+    for unit in unit_list:
+        EmergencyUnit(unit.size, unit.location)
+    main.simulate(city, base_rate_for_emergency, base_population, seed=0, show_progress=False,
+                  number_of_runs=number_of_runs)
+
+
+def allocate_and_release(city: City, index: UnitIndex, arrivals: np.ndarray):
+    """
+    Allocates teams to emergencies one after the other, relieving the teams of each emergency before the next one.
+    :param city: City where the emergencies take place
+    :param index: UnitIndex of the emergency units
+    :param arrivals: Numpy structured array of Emergency.arrival_dtype records
+    :return: None
+    """
+    for minute, zone, row, col, intensity in arrivals.tolist():
+        emergency = Emergency(city, zone, minute, (row, col), intensity)
+        emergency.resolve_emergency(minute, index)
+        emergency.release_teams()
+    Emergency.clear_emergencies()
+
+
+def run_benchmarks(sizes: list = None, units: list = None, repeat: int = 3, number_of_runs: int = 1) -> list:
+    """
+    Times the construction of the city graph (City.__init__, which builds it with build_city_graph()), a traffic
+    update with the rebuild of the travel time table (update_graph_edges), the allocation of teams to emergencies
+    (allocate_teams_to_emergency), the drawing of the emergencies of a day (generate_arrivals) and a full simulation
+    (simulate), for every city size and number of units. Combinations with more units than coordinates are skipped.
+    The emergency rate of the simulation is set so that an emergency occurs every 100 minutes for each unit, keeping
+    the load of the units similar across city sizes.
+    :param sizes: Numbers of zones along each side of the cities, defaults to zone_sizes
+    :param units: Numbers of emergency units, defaults to unit_counts
+    :param repeat: Number of timed calls of each benchmark
+    :param number_of_runs: Number of runs of the simulation benchmark
+    :return: List of dictionaries with the benchmark, zones, units, seconds and peak_memory_mb of each measurement
+    >>> rows = run_benchmarks([2], [5], repeat=1)
+    >>> [(row['benchmark'], row['zones'], row['units']) for row in rows] # doctest: +NORMALIZE_WHITESPACE
+    [('city_init', 4, 5), ('update_graph_edges', 4, 5), ('allocate_teams', 4, 5), ('generate_arrivals', 4, 5),
+     ('simulate', 4, 5)]
+    >>> all(row['seconds'] > 0 and row['peak_memory_mb'] > 0 for row in rows)
+    True
+    """
+    sizes = zone_sizes if sizes is None else sizes
+    units = unit_counts if units is None else units
+    rows = []
+    for size in sizes:
+        populations = [2000] * (size * size)
+        intensities = [0.4, 0.2, 0.2, 0.1, 0.1]
+        for number_of_units in units:
+            if number_of_units > size * size * City.zone_dimension ** 2:
+                continue
+            rng = np.random.default_rng(0)
+            results = {'city_init': measure(lambda: City(size, size, populations, intensities), repeat)}
+            city = City(size, size, populations, intensities)
+            unit_list = create_units(city, number_of_units, rng)
+            city.set_unit_locations([unit.location for unit in unit_list])
+            results['update_graph_edges'] = measure(lambda: city.update_graph_edges(1, rng), repeat)
+            base_rate = number_of_units / 100
+            zone_probabilities = main.poisson_probability(base_rate / sum(populations) * np.asarray(populations))
+            arrivals = Emergency.generate_arrivals(city, zone_probabilities, 1440, rng)[:allocated_emergencies]
+            index = UnitIndex(unit_list)
+            results['allocate_teams'] = measure(lambda: allocate_and_release(city, index, arrivals), repeat)
+            results['generate_arrivals'] = measure(
+                lambda: Emergency.generate_arrivals(city, zone_probabilities, 1440, rng), repeat)
+            city.set_unit_locations([])
+            results['simulate'] = measure(
+                lambda: simulate_layout(city, unit_list, base_rate, sum(populations), number_of_runs), repeat)
+            EmergencyUnit.clear_emergency_buildings()
+            for benchmark, (seconds, peak_memory_mb) in results.items():
+                rows.append({'benchmark': benchmark, 'zones': size * size, 'units': number_of_units,
+                             'seconds': seconds, 'peak_memory_mb': peak_memory_mb})
+    return rows
+
+
+def save_baseline(rows: list, path: str):
+    """
+    Saves the measurements of run_benchmarks() as a JSON baseline, along with the commit and the versions of Python
+    and numpy they were measured with.
+    :param rows: Measurements returned by run_benchmarks()
+    :param path: Path of the baseline file
+    :return: None
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    with open(path, 'w') as f:
+        json.dump({'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+                   'measurements': rows}, f, indent=1)
+
+
+def compare_to_baseline(rows: list, path: str, tolerance: float = 0.2) -> list:
+    """
+    Compares measurements to a baseline saved by save_baseline(), reporting the measurements slower or using more
+    memory than the baseline by more than the tolerance.
+    :param rows: Measurements returned by run_benchmarks()
+    :param path: Path of the baseline file
+    :param tolerance: Relative increase of time or memory over the baseline considered a regression
+    :return: List of tuples of the benchmark, zones, units, metric, baseline value and measured value of each
+    regression
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+    >>> save_baseline([{'benchmark': 'simulate', 'zones': 4, 'units': 5, 'seconds': 1.0, 'peak_memory_mb': 10.0}], path)
+    >>> compare_to_baseline([{'benchmark': 'simulate', 'zones': 4, 'units': 5, 'seconds': 1.5,
+    ...                       'peak_memory_mb': 11.0}], path)
+    [('simulate', 4, 5, 'seconds', 1.0, 1.5)]
+    """
+    with open(path) as f:
+        baseline = {(row['benchmark'], row['zones'], row['units']): row for row in json.load(f)['measurements']}
+    regressions = []
+    for row in rows:
+        key = (row['benchmark'], row['zones'], row['units'])
+        if key not in baseline:
+            continue
+        for metric in ['seconds', 'peak_memory_mb']:
+            if row[metric] > baseline[key][metric] * (1 + tolerance):
+                regressions.append(key + (metric, baseline[key][metric], row[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the simulation.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=zone_sizes, help='Zones along each side of the cities')
+    parser.add_argument('--units', type=int, nargs='+', default=unit_counts, help='Numbers of emergency units')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed calls of each benchmark')
+    parser.add_argument('--save', help='Path of the JSON baseline to save the measurements to')
+    parser.add_argument('--compare', help='Path of a JSON baseline to compare the measurements to')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative increase considered a regression')
+    arguments = parser.parse_args()
+    measurements = run_benchmarks(arguments.sizes, arguments.units, arguments.repeat)
+    for measurement in measurements:
+        print(f"{measurement['benchmark']:<20} {measurement['zones']:>6} zones {measurement['units']:>4} units "
+              f"{measurement['seconds']:>10.4f} s {measurement['peak_memory_mb']:>9.2f} MB")
+    if arguments.save:
+        save_baseline(measurements, arguments.save)
+    if arguments.compare:
+        for regression in compare_to_baseline(measurements, arguments.compare, arguments.tolerance):
+            print("Regression: {} with {} zones and {} units, {} {:.4f} -> {:.4f}".format(*regression))
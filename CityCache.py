@@ -0,0 +1,219 @@
+"""
+Content-addressed on-disk cache of the graphs of cities and of the travel time tables of their emergency units, so
+that cities sharing dimensions and zone populations are built once across sweeps and processes.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from CityConfiguration import City
+
+
+class CityCache:
+    """
+    Cache of the arrays of the graphs of cities (see City.graph_array_names), keyed by a hash of the width, height,
+    zone populations and zone dimension of the city, and of travel time tables, keyed by a hash of the city, the
+    coordinates of the units and the commute times of the edges. Every entry is stored as .npy files which are
+    memory-mapped when loaded, and the least recently used entries are evicted once the cache exceeds its size limit.
+    Only the travel time tables of the commute times of the start of the day are cached by default, as the commute
+    times drawn at the other traffic updates are different in every run, unless they are replayed from a ScenarioTrace.
+    Entries are written to a temporary path and moved into place, so processes can share a cache directory.
+    """
+    # Version of the layout of the cache, part of every key so that entries of another layout are never loaded
+    format_version = 1
+
+    def __init__(self, directory: str, max_bytes: int = 2 ** 30, traffic_tables: bool = False):
+        """
+        :param directory: Directory of the cache, created if needed
+        :param max_bytes: Size of the cache above which the least recently used entries are evicted
+        :param traffic_tables: Whether the travel time tables of every traffic update are cached, e.g. when the
+        traffic of a ScenarioTrace is replayed several times for the same units
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.traffic_tables = traffic_tables
+        os.makedirs(os.path.join(directory, 'cities'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'tables'), exist_ok=True)
+
+    @staticmethod
+    def city_key(width: int, height: int, zone_populations) -> str:
+        """
+        Key of the graph of a city, a hash of everything the graph depends on.
+        :param width: Width of the city in terms of number of zones
+        :param height: Height of the city in terms of number of zones
+        :param zone_populations: Population of each zone of the city
+        :return: Hexadecimal digest
+        >>> CityCache.city_key(2, 1, [400, 800]) == CityCache.city_key(2, 1, np.asarray([400.0, 800.0]))
+        True
+        >>> CityCache.city_key(2, 1, [400, 800]) == CityCache.city_key(1, 2, [400, 800])
+        False
+        """
+        digest = hashlib.sha256(json.dumps([CityCache.format_version, width, height, City.zone_dimension]).encode())
+        digest.update(np.ascontiguousarray(zone_populations, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def get_city(self, width: int, height: int, zone_populations, intensity_distribution) -> City:
+        """
+        Constructs a city from the arrays of its graph in the cache, building the graph and storing it in the cache
+        if it isn't found. The city uses the cache for its travel time tables.
+        :param width: Width of the city in terms of number of zones
+        :param height: Height of the city in terms of number of zones
+        :param zone_populations: Population of each zone of the city
+        :param intensity_distribution: Probability of emergencies of each intensity
+        :return: City
+        >>> cache = CityCache(tempfile.mkdtemp())
+        >>> city = cache.get_city(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> warm = cache.get_city(2, 1, [400, 800], [1, 0, 0, 0, 0])
+        >>> type(warm.edge_likely).__name__, bool((warm.edge_likely == city.edge_likely).all())
+        ('memmap', True)
+        >>> warm.set_unit_locations([(0, 0), (2, 5)])
+        >>> city.set_unit_locations([(0, 0), (2, 5)])
+        >>> bool((warm.travel_time_table == city.travel_time_table).all()), len(os.listdir(cache.table_directory))
+        (True, 1)
+        >>> entry = os.path.join(cache.directory, 'cities', CityCache.city_key(2, 1, [400, 800]))
+        >>> os.remove(os.path.join(entry, f'{City.graph_array_names[-1]}.npy'))  # Partly evicted by another process
+        >>> rebuilt = cache.get_city(2, 1, [400, 800], [1, 0, 0, 0, 0])
+        >>> type(rebuilt.edge_likely).__name__, bool((rebuilt.edge_likely == city.edge_likely).all())
+        ('ndarray', True)
+        >>> type(cache.get_city(2, 1, [400, 800], [1, 0, 0, 0, 0]).edge_likely).__name__
+        'memmap'
+        """
+        path = os.path.join(self.directory, 'cities', CityCache.city_key(width, height, zone_populations))
+        try:
+            os.utime(path)
+            # Copy-on-write mappings, as scipy needs writable buffers for the adjacency of the graph
+            graph_arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')
+                            for name in City.graph_array_names}
+        except FileNotFoundError:
+            # Not cached yet, or evicted by another process while loaded, in which case what is left of the entry is
+            # removed so that it can be stored again
+            remove_entry(path)
+            graph_arrays = None
+        if graph_arrays is not None:
+            city = City(width, height, zone_populations, intensity_distribution, graph_arrays=graph_arrays)
+        else:
+            city = City(width, height, zone_populations, intensity_distribution)
+            staging = tempfile.mkdtemp(dir=self.directory)
+            for name in City.graph_array_names:
+                np.save(os.path.join(staging, f'{name}.npy'), getattr(city, name))
+            self.store(staging, path)
+        city.routing_cache = self
+        return city
+
+    @property
+    def table_directory(self) -> str:
+        return os.path.join(self.directory, 'tables')
+
+    def travel_time_table(self, city: City, unit_nodes: list) -> np.ndarray:
+        """
+        Travel time table of units of a city for the current commute times of its edges (see
+        City.build_travel_time_table()), loaded from the cache or computed and stored in the cache.
+        :param city: City of the units
+        :param unit_nodes: Node numbers of the units, in the order of the rows of the table
+        :return: Numpy array of the travel time table
+        >>> cache = CityCache(tempfile.mkdtemp())
+        >>> city = cache.get_city(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.set_unit_locations([(0, 0)])
+        >>> city.update_graph_edges(1, np.random.default_rng(0))
+        >>> len(os.listdir(cache.table_directory))
+        1
+        """
+        if not self.traffic_tables and (city.edge_weights != City.default_commute_time).any():
+            return city.shortest_travel_times(unit_nodes)
+        digest = hashlib.sha256(CityCache.city_key(city.width, city.height, city.zone_populations).encode())
+        digest.update(np.asarray(unit_nodes, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(city.edge_weights, dtype=np.float64).tobytes())
+        path = os.path.join(self.table_directory, f'{digest.hexdigest()}.npy')
+        try:
+            os.utime(path)
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            # Not cached yet, or evicted by another process
+            pass
+        table = city.shortest_travel_times(unit_nodes)
+        descriptor, staging = tempfile.mkstemp(dir=self.directory, suffix='.npy')
+        with os.fdopen(descriptor, 'wb') as f:
+            np.save(f, table)
+        self.store(staging, path)
+        return table
+
+    def store(self, staging: str, path: str):
+        """
+        Moves a new entry into place, and evicts the least recently used entries if the cache exceeds its size limit.
+        An entry stored by another process in the meantime is kept, and the new one discarded.
+        :param staging: Temporary path of the entry, in the cache directory
+        :param path: Path of the entry
+        :return: None
+        """
+        try:
+            os.rename(staging, path)
+        except OSError:
+            remove_entry(staging)
+        self.evict(keep=path)
+
+    def entries(self) -> list:
+        """
+        Entries of the cache, with their size in bytes and time of last use.
+        :return: List of tuples of the time of last use, size and path of each entry
+        """
+        entries = []
+        for kind in ['cities', 'tables']:
+            for name in os.listdir(os.path.join(self.directory, kind)):
+                path = os.path.join(self.directory, kind, name)
+                try:
+                    if os.path.isdir(path):
+                        size = sum(entry.stat().st_size for entry in os.scandir(path))
+                    else:
+                        size = os.path.getsize(path)
+                    entries.append((os.path.getmtime(path), size, path))
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+        return entries
+
+    def evict(self, keep: str = None):
+        """
+        Evicts the least recently used entries until the cache is within its size limit.
+        :param keep: Path of an entry never evicted, e.g. the entry just stored
+        :return: None
+        >>> cache = CityCache(tempfile.mkdtemp(), max_bytes=6000)
+        >>> city = cache.get_city(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city = cache.get_city(2, 2, [400, 800, 400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> len(os.listdir(os.path.join(cache.directory, 'cities')))
+        1
+        >>> sum(size for _, size, _ in cache.entries()) <= 6000
+        True
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                remove_entry(path)
+                total -= size
+
+    def clear(self):
+        """
+        Removes every entry of the cache.
+        :return: None
+        """
+        for _, _, path in self.entries():
+            remove_entry(path)
+
+
+def remove_entry(path: str):
+    """
+    Removes an entry of the cache (directory or file), if it still exists.
+    :param path: Path of the entry
+    :return: None
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,324 @@
+"""
+Structured (JSON or TOML) configuration files of a city, validated against a declarative schema, and converter of the
+text configuration files read by main.configure_city_file().
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import numpy as np
+from CityConfiguration import City
+from EmergencyUnit import EmergencyUnit
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+# Version of the format of the structured configuration files
+format_version = 1
+# Schema of the structured configuration files: type, whether the field is required and description of each field
+config_schema = {
+    'format_version': (int, False, 'Version of the format of the configuration file'),
+    'width': (int, True, 'Width of the city in terms of number of zones, greater than 0'),
+    'height': (int, True, 'Height of the city in terms of number of zones, greater than 0'),
+    'zone_populations': (list, True, 'Population of each zone specified row wise (width * height values greater '
+                                     'than 0)'),
+    'intensity_distribution': (list, True, 'Probability of emergencies of each of the 5 intensities, summing to 1'),
+    'buildings': (dict, True, 'List of [row, column] coordinates of the emergency units of each size (small, medium '
+                              'and large), no two units sharing the same coordinates'),
+    'emergency_rate': (dict, False, 'Emergency rate per unit minute (rate) for a base population (base_population), '
+                                    'defaults to the rate calculated from the Montgomery PA data'),
+}
+emergency_rate_schema = {
+    'rate': ((int, float), True, 'Emergency rate per unit minute, greater than 0'),
+    'base_population': (int, True, 'Base population of the emergency rate, greater than 0'),
+}
+
+
+def check_fields(data: dict, schema: dict, name: str):
+    """
+    Checks that a table of a configuration has the required fields of its schema, no unknown field and fields of the
+    right types.
+    :param data: Table of the configuration
+    :param schema: Schema of the table
+    :param name: Name of the table in error messages
+    :return: None
+    >>> check_fields({'rate': 1.0}, emergency_rate_schema, 'emergency_rate')
+    Traceback (most recent call last):
+    ...
+    ValueError: emergency_rate is missing the field base_population
+    >>> check_fields({'rate': '1', 'base_population': 2}, emergency_rate_schema, 'emergency_rate')
+    Traceback (most recent call last):
+    ...
+    ValueError: emergency_rate.rate should be of type int or float, got str
+    """
+    if not isinstance(data, dict):
+        raise ValueError(f"{name} should be a table, got {type(data).__name__}")
+    for field in data:
+        if field not in schema:
+            raise ValueError(f"{name} has an unknown field {field}")
+    for field, (field_type, required, _) in schema.items():
+        if field not in data:
+            if required:
+                raise ValueError(f"{name} is missing the field {field}")
+            continue
+        types = field_type if isinstance(field_type, tuple) else (field_type,)
+        # bool is a subclass of int, but never a valid number of the configuration
+        if isinstance(data[field], bool) or not isinstance(data[field], types):
+            raise ValueError(f"{name}.{field} should be of type {' or '.join(t.__name__ for t in types)}, got "
+                             f"{type(data[field]).__name__}")
+
+
+def numeric_array(values: list, name: str, dtype) -> np.ndarray:
+    """
+    Converts a list of numbers of a configuration to a numpy array, rejecting values which aren't numbers.
+    :param values: List of numbers
+    :param name: Name of the field in error messages
+    :param dtype: Numpy data type of the array
+    :return: Numpy array of the values
+    >>> numeric_array([1, 2.5], 'zone_populations', float).tolist()
+    [1.0, 2.5]
+    >>> numeric_array([1, '2'], 'zone_populations', float)
+    Traceback (most recent call last):
+    ...
+    ValueError: zone_populations should only contain numbers
+    """
+    if not all(type(value) in (int, float) for value in values):
+        raise ValueError(f"{name} should only contain numbers")
+    return np.asarray(values, dtype=dtype)
+
+
+class CityConfig:
+    """
+    Validated configuration of a city: dimensions, zone populations, intensity distribution, emergency units and
+    emergency rate. Building the city and the emergency units from the configuration is left to build_city() and
+    build_units(), so loading a configuration doesn't change the emergency units registered in EmergencyUnit.
+    """
+
+    def __init__(self, width: int, height: int, zone_populations, intensity_distribution, buildings: dict,
+                 base_rate_for_emergency: float = None, base_population: int = None):
+        """
+        :param width: Width of the city in terms of number of zones
+        :param height: Height of the city in terms of number of zones
+        :param zone_populations: Population of each zone specified row wise
+        :param intensity_distribution: Probability of emergencies of each of the 5 intensities
+        :param buildings: Dictionary mapping each size of emergency unit to a numpy array of the (row, column)
+        coordinates of the units of the size
+        :param base_rate_for_emergency: Emergency rate per unit minute, None for the default rate
+        :param base_population: Base population of the emergency rate, None for the default population
+        """
+        self.width = width
+        self.height = height
+        self.zone_populations = np.asarray(zone_populations, dtype=float)
+        self.intensity_distribution = np.asarray(intensity_distribution, dtype=float)
+        self.buildings = buildings
+        self.base_rate_for_emergency = base_rate_for_emergency
+        self.base_population = base_population
+
+    @staticmethod
+    def from_dict(data: dict):
+        """
+        Validates a configuration against config_schema, and the consistency of its fields: number of zone
+        populations, intensity distribution, coordinates of the emergency units within the city and not shared by two
+        units.
+        :param data: Configuration, as read from a JSON or TOML file
+        :return: CityConfig validated
+        >>> data = {'width': 2, 'height': 1, 'zone_populations': [2500, 2500],
+        ...         'intensity_distribution': [0.4, 0.2, 0.2, 0.1, 0.1],
+        ...         'buildings': {'small': [[1, 1], [0, 5]], 'large': [[2, 2]]}}
+        >>> config = CityConfig.from_dict(data)
+        >>> config.buildings['small'].tolist(), config.base_rate_for_emergency
+        ([[1, 1], [0, 5]], None)
+        >>> CityConfig.from_dict(dict(data, zone_populations=[2500, 0]))
+        Traceback (most recent call last):
+        ...
+        ValueError: zone_populations[1] should be greater than 0, got 0.0
+        >>> CityConfig.from_dict(dict(data, buildings={'small': [[1, 1]], 'medium': [[1, 1]]}))
+        Traceback (most recent call last):
+        ...
+        ValueError: Coordinates are duplicate for EmergencyResponse unit buildings.. - (1, 1)
+        >>> CityConfig.from_dict(dict(data, buildings={'small': [[3, 1]]}))
+        Traceback (most recent call last):
+        ...
+        ValueError: buildings.small[0] coordinates (3, 1) are outside the city of 3x6 coordinates
+        """
+        check_fields(data, config_schema, 'configuration')
+        if data.get('format_version', format_version) != format_version:
+            raise ValueError(f"Configuration has format version {data['format_version']}, expected version "
+                             f"{format_version}")
+        width, height = data['width'], data['height']
+        for name, value in [('width', width), ('height', height)]:
+            if value <= 0:
+                raise ValueError(f"Kindly check {name}, it's passed as {value}. This isn't correct. It should be "
+                                 f"greater than 0")
+        zone_populations = numeric_array(data['zone_populations'], 'zone_populations', float)
+        if len(zone_populations) != width * height:
+            raise ValueError(f"zone_populations should have width * height = {width * height} values, got "
+                             f"{len(zone_populations)}")
+        invalid = np.flatnonzero(zone_populations <= 0)
+        if len(invalid):
+            raise ValueError(f"zone_populations[{invalid[0]}] should be greater than 0, got "
+                             f"{zone_populations[invalid[0]]}")
+        intensity_distribution = numeric_array(data['intensity_distribution'], 'intensity_distribution', float)
+        if len(intensity_distribution) != 5:
+            raise ValueError("Please specify intensity probabilities for all 5 types of intensities")
+        if (intensity_distribution < 0).any() or not np.isclose(intensity_distribution.sum(), 1):
+            raise ValueError("Intensity distributions should sum to 1")
+        buildings = {}
+        rows, columns = height * City.zone_dimension, width * City.zone_dimension
+        for size, coordinates in data['buildings'].items():
+            if size not in EmergencyUnit.type_to_capacity_mapping:
+                raise ValueError(f"buildings has an unknown size {size}, expected one of "
+                                 f"{', '.join(EmergencyUnit.type_to_capacity_mapping)}")
+            if not isinstance(coordinates, list) or \
+                    not all(isinstance(coordinate, list) and len(coordinate) == 2 for coordinate in coordinates):
+                raise ValueError(f"buildings.{size} should be a list of [row, column] coordinates")
+            locations = numeric_array([value for coordinate in coordinates for value in coordinate],
+                                      f'buildings.{size}', float).reshape(-1, 2)
+            if (locations != np.round(locations)).any():
+                raise ValueError(f"buildings.{size} coordinates should be integers")
+            locations = locations.astype(int)
+            outside = np.flatnonzero((locations < 0).any(axis=1) | (locations[:, 0] >= rows) |
+                                     (locations[:, 1] >= columns))
+            if len(outside):
+                raise ValueError(f"buildings.{size}[{outside[0]}] coordinates {tuple(locations[outside[0]].tolist())} "
+                                 f"are outside the city of {rows}x{columns} coordinates")
+            buildings[size] = locations
+        all_locations = np.concatenate([locations for locations in buildings.values()] + [np.empty((0, 2), int)])
+        unique_locations, counts = np.unique(all_locations, axis=0, return_counts=True)
+        if (counts > 1).any():
+            raise ValueError(f"Coordinates are duplicate for EmergencyResponse unit buildings.. - "
+                             f"{tuple(unique_locations[np.argmax(counts > 1)].tolist())}")
+        base_rate_for_emergency = base_population = None
+        if 'emergency_rate' in data:
+            check_fields(data['emergency_rate'], emergency_rate_schema, 'emergency_rate')
+            base_rate_for_emergency = float(data['emergency_rate']['rate'])
+            base_population = data['emergency_rate']['base_population']
+            if base_rate_for_emergency <= 0 or base_population <= 0:
+                raise ValueError("emergency_rate.rate and emergency_rate.base_population should be greater than 0")
+        return CityConfig(width, height, zone_populations, intensity_distribution, buildings,
+                          base_rate_for_emergency, base_population)
+
+    def to_dict(self) -> dict:
+        """
+        Configuration in the structure of config_schema.
+        :return: Dictionary of the configuration
+        """
+        data = {'format_version': format_version, 'width': self.width, 'height': self.height,
+                'zone_populations': [int(population) if population == int(population) else population
+                                     for population in self.zone_populations.tolist()],
+                'intensity_distribution': self.intensity_distribution.tolist(),
+                'buildings': {size: locations.tolist() for size, locations in self.buildings.items()}}
+        if self.base_rate_for_emergency is not None:
+            data['emergency_rate'] = {'rate': self.base_rate_for_emergency, 'base_population': self.base_population}
+        return data
+
+    @staticmethod
+    def load(path: str):
+        """
+        Loads and validates a structured configuration file, in JSON (.json) or TOML (.toml) format.
+        :param path: Path of the configuration file
+        :return: CityConfig validated
+        """
+        if path.endswith('.toml'):
+            if tomllib is None:
+                raise ValueError("TOML configuration files need Python 3.11 or later, use a JSON file instead")
+            with open(path, 'rb') as f:
+                data = tomllib.load(f)
+        else:
+            with open(path) as f:
+                data = json.load(f)
+        return CityConfig.from_dict(data)
+
+    def save(self, path: str):
+        """
+        Saves the configuration to a JSON file.
+        :param path: Path of the configuration file
+        :return: None
+        >>> import tempfile
+        >>> config = convert_text_config('configuration.txt')
+        >>> path = os.path.join(tempfile.mkdtemp(), 'configuration.json')
+        >>> config.save(path)
+        >>> CityConfig.load(path).to_dict() == config.to_dict()
+        True
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def build_city(self, cache=None) -> City:
+        """
+        Constructs the city of the configuration.
+        :param cache: CityCache from which the graph of the city is loaded if it was already built for the same
+        dimensions and zone populations, the city is built from scratch if not given
+        :return: City configured
+        """
+        if cache is not None:
+            return cache.get_city(self.width, self.height, self.zone_populations, self.intensity_distribution)
+        return City(self.width, self.height, self.zone_populations, self.intensity_distribution)
+
+    def build_units(self, register: bool = False) -> list:
+        """
+        Creates the emergency units of the configuration, e.g. for a SimulationEngine.
+        :param register: Whether the units replace the emergency units registered in EmergencyUnit, as needed by
+        main.simulate()
+        :return: List of the emergency units
+        >>> config = CityConfig(2, 1, [2500, 2500], [1, 0, 0, 0, 0], {'small': np.asarray([[1, 1], [0, 5]])})
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> [unit.location for unit in config.build_units()], EmergencyUnit.response_buildings
+        ([(1, 1), (0, 5)], [])
+        >>> len(config.build_units(register=True)), len(EmergencyUnit.response_buildings)
+        (2, 2)
+        """
+        if register:
+            EmergencyUnit.clear_emergency_buildings()
+        return [EmergencyUnit(size, (row, col), register) for size, locations in self.buildings.items()
+                for row, col in locations.tolist()]
+
+
+def convert_text_config(configuration_file: str, config_directory: str = "./config") -> CityConfig:
+    """
+    Converts a text configuration file, as read by main.configure_city_file(), to a structured configuration.
+    :param configuration_file: Name of the text configuration file
+    :param config_directory: Directory containing the text configuration file
+    :return: CityConfig of the text configuration file
+    >>> config = convert_text_config('configuration.txt')
+    >>> config.width, config.height, {size: len(locations) for size, locations in config.buildings.items()}
+    (2, 2, {'small': 2, 'medium': 2, 'large': 1})
+    >>> config.base_rate_for_emergency is None
+    True
+    """
+    # Imported here as main reads structured configuration files with CityConfig
+    import main
+    # The messages of configure_city_file() are turned into the error raised
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        city, base_rate_for_emergency, base_population = main.configure_city_file(configuration_file,
+                                                                                  config_directory)
+    units = EmergencyUnit.response_buildings
+    EmergencyUnit.clear_emergency_buildings()
+    if city is None:
+        raise ValueError(f"Configuration file {configuration_file} is invalid: {messages.getvalue().strip()}")
+    buildings = {size: np.asarray([unit.location for unit in units if unit.size == size], dtype=int).reshape(-1, 2)
+                 for size in EmergencyUnit.type_to_capacity_mapping}
+    return CityConfig(city.width, city.height, city.zone_populations, city.intensity_distribution, buildings,
+                      base_rate_for_emergency, base_population)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert text configuration files to JSON configuration files.')
+    parser.add_argument('configurations', nargs='+', help='Paths of the text configuration files')
+    parser.add_argument('--output-directory', default=None, help='Directory of the JSON configuration files, '
+                                                                 'defaults to the directory of each text file')
+    arguments = parser.parse_args()
+    for configuration_path in arguments.configurations:
+        directory, name = os.path.split(configuration_path)
+        try:
+            converted = convert_text_config(name, directory or '.')
+        except ValueError as v:
+            print(v)
+            continue
+        output_path = os.path.join(arguments.output_directory or directory, os.path.splitext(name)[0] + '.json')
+        converted.save(output_path)
+        print(f"{configuration_path} -> {output_path}")
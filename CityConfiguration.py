@@ -1,11 +1,13 @@
+import heapq
 import numpy as np
-import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 
 
 # Function for mod_pert_random has been picked from Mr Weible's example
 # from https://github.com/iSchool-597PR/2022_Fall_examples/blob/main/unit_07/Probability_Distributions.ipynb
 
-def mod_pert_random(low, likely, high, confidence=4, samples=1):
+def mod_pert_random(low, likely, high, confidence=4, samples=1, rng=None):
     """Produce random numbers according to the 'Modified PERT' distribution
     :param low: The lowest value expected as possible
     :param likely: The 'most likely' value, statistically, the mode
@@ -15,6 +17,7 @@ def mod_pert_random(low, likely, high, confidence=4, samples=1):
     values 1-18 Formulas to convert beta to PERT are adapted from a whitepaper "Modified Pert Simulation"
     by Paulo Buchsbaum
     :param samples: Number of random values to generate
+    :param rng: Numpy random number generator used for the draw, the global numpy generator is used if not given
     """
     # Check for reasonable confidence levels to allow:
     if confidence < 1 or confidence > 18:
@@ -25,7 +28,7 @@ def mod_pert_random(low, likely, high, confidence=4, samples=1):
     a = (mean - low) / (high - low) * (confidence + 2)
     b = ((confidence + 1) * high - low - confidence * likely) / (high - low)
 
-    beta = np.random.beta(a, b, samples)
+    beta = (np.random if rng is None else rng).beta(a, b, samples)
     beta = beta * (high - low) + low
     return beta
 
@@ -40,13 +43,23 @@ class City:
     default_commute_time = 3  # Class variable - represents constant time between two adjacent nodes with no
 
     # traffic between them
+    # Fraction of the edges above which a change of commute times rebuilds the travel time table from scratch, instead
+    # of updating only the rows of the units whose shortest paths may change (see update_travel_time_table())
+    incremental_edge_fraction = 0.5
+    # Multiple of the travel time of the last unit selected up to which the stale rows of the table are recomputed
+    refresh_limit_factor = 2
+    # Arrays of the graph built by build_city_graph(), which depend only on the dimensions and zone populations
+    graph_array_names = ['likely_vals', 'node_zones', 'node_populations', 'edge_sources', 'edge_destinations',
+                         'edge_likely', 'adjacency_indices', 'adjacency_edges', 'adjacency_indptr']
 
-    def __init__(self, width: int, height: int, zone_populations: list, intensity_distribution: list):
+    def __init__(self, width: int, height: int, zone_populations: list, intensity_distribution: list,
+                 graph_arrays: dict = None):
         """
-        Initialize a networkx graph where each node is a coordinate in the city, with its properties being zone number,
+        Initialize a graph where each node is a coordinate in the city, with its properties being zone number,
         population density of zone. Add edges between every pair or coordinates with the time property equal
         to sum of the distance between the two coordinates and a penalty parameter which is randomized as a
-        probability distribution of the population densities of the two nodes.
+        probability distribution of the population densities of the two nodes. The graph is stored in numpy arrays
+        (see build_city_graph()), and a networkx view of it is available as city_graph.
         Also initialize a mapping of zone numbers to their population densities and top-left corner coordinates
         (this will be used to randomize zone of an emergency as a distribution of the population
         density and then determine a random coordinate within the zone)
@@ -55,20 +68,47 @@ class City:
         :param zone_populations: List of population of each zone specified row wise
         :param intensity_distribution: List with probability of occurrence of emergencies of different scales, with 1
         being the least intense
+        :param graph_arrays: Dictionary of the arrays of the graph (see graph_array_names) of a city with the same
+        dimensions and zone populations, used instead of building the graph, e.g. loaded from a CityCache
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> arrays = {name: getattr(city, name) for name in City.graph_array_names}
+        >>> restored = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1], graph_arrays=arrays)
+        >>> restored.number_of_nodes, bool((restored.edge_weights == city.edge_weights).all())
+        (18, True)
         """
         self.width = width
         self.height = height
         self.zone_populations = np.asarray(zone_populations)
-        self.coordinate_populations = []
         self.intensity_distribution = intensity_distribution
         self.intensity_cumulative = np.cumsum(np.rint(np.asarray(self.intensity_distribution) * 100))
-        for i in range(len(zone_populations)):
-            for _ in range(City.zone_dimension ** 2):  # number of nodes per zone?
-                self.coordinate_populations.append(zone_populations[i] / (City.zone_dimension ** 2))
-        self.city_graph = nx.Graph()
-        self.build_city_graph()
-        self.likely_vals = self.zone_populations / np.sum(self.zone_populations)
-        self.update_graph_edges(0)
+        # Population of each of the coordinates of every zone, listed zone by zone
+        self.coordinate_populations = np.repeat(self.zone_populations / (City.zone_dimension ** 2),
+                                                City.zone_dimension ** 2).tolist()
+        # networkx view of the graph, built when city_graph is first accessed after a change to the graph
+        self.graph_view = None
+        self.adjacency_lists = None
+        # Coordinates of the emergency units for which travel times are tabulated, see set_unit_locations()
+        self.unit_locations = []
+        self.unit_index = {}
+        self.travel_time_table = None
+        self.travel_time_table_bytes = 0
+        # Lower bound of the stale entries of each row of the travel time table, the edges whose commute times changed
+        # and the lowest commute time of every edge since the table was built, see update_travel_time_table()
+        self.travel_time_bounds = None
+        self.changed_edges = None
+        self.minimum_edge_weights = None
+        # CityCache of the travel time tables, which are computed on every rebuild if not set
+        self.routing_cache = None
+        if graph_arrays is None:
+            self.likely_vals = self.zone_populations / np.sum(self.zone_populations)
+            self.build_city_graph()
+            self.update_graph_edges(0)
+        else:
+            # The commute times of the start of the day are the default commute time, as in update_graph_edges(0)
+            for name in City.graph_array_names:
+                setattr(self, name, graph_arrays[name])
+            self.number_of_nodes = len(self.node_zones)
+            self.edge_weights = np.full(len(self.edge_sources), float(City.default_commute_time))
 
     def get_commute_time(self, source_node: tuple, dest_node: tuple, time_weight: int):
         """
@@ -91,21 +131,21 @@ class City:
         ...
         Exception: Invalid Source or Destination Node.
         """
-        if self.city_graph.has_edge(source_node, dest_node):
+        if not (self.check_coordinates(*source_node) and self.check_coordinates(*dest_node)):
+            raise Exception("Invalid Source or Destination Node.")
+        if abs(source_node[0] - dest_node[0]) + abs(source_node[1] - dest_node[1]) == 1:
             # calculate most likely value of traffic based on zone_population and plug into pert distribution
-            likely = 0.5 * (self.likely_vals[self.city_graph.nodes[source_node]['Zone_Number']]
-                            + self.likely_vals[self.city_graph.nodes[dest_node]['Zone_Number']])
+            likely = 0.5 * (self.likely_vals[self.node_zones[self.node_number(source_node)]]
+                            + self.likely_vals[self.node_zones[self.node_number(dest_node)]])
             traffic_time = mod_pert_random(low=0, likely=likely, high=1, samples=1)
             traffic_time *= time_weight  # scale traffic time value by time of day weight
             # increase commute time by traffic_time%
             commute_time = City.default_commute_time + City.default_commute_time * traffic_time
-            return float(commute_time)
-        elif self.city_graph.has_node(source_node) & self.city_graph.has_node(dest_node):
+            return float(commute_time[0])
+        else:
             print(f"Commute time cannot be changed as there is no direct path between source and "
                   f"destination. Returning default time: {City.default_commute_time}")
             return float(City.default_commute_time)
-        else:
-            raise Exception("Invalid Source or Destination Node.")
 
     def build_city_graph(self):
         """
@@ -115,7 +155,12 @@ class City:
         and total nodes in a column is given by height of the object * n. There is an edge between
         every vertically and horizontally adjacent node, and no diagonal edges. The time taken to
         go traverse between adjacent node has been set to the default value specified as class variable.
-        :return: None. Modifies graph object in place
+        Nodes are numbered row-wise (see node_number()), and the zone number and population of every node are stored in
+        numpy arrays. Edges are stored as arrays of the node numbers they join, along with the most likely value of the
+        traffic penalty of every edge (the average of likely_vals of the zones of its two nodes, as in
+        get_commute_time()) and the commute time of every edge, which is updated by update_graph_edges(). The
+        adjacency of the nodes is stored in compressed sparse row (CSR) form, with every entry referring to an edge.
+        :return: None. Modifies graph arrays in place
 
         >>> city =  City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
         >>> city.build_city_graph()
@@ -143,41 +188,107 @@ class City:
         >>> city =  City(2, 2, [400, 800, 1600, 2400], [0.4, 0.2, 0.2, 0.1, 0.1])
         >>> city.city_graph.nodes[(1,5)]['Zone_Number']
         1
+        >>> int(city.node_zones[city.node_number((1, 5))]), float(city.node_populations[city.node_number((4, 0))])
+        (1, 177.77777777777777)
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> len(city.edge_sources), len(city.edge_weights)
+        (27, 27)
+        >>> edge = list(zip(city.edge_sources, city.edge_destinations)).index((2, 3))
+        >>> round(float(city.edge_likely[edge]), 4)
+        0.5
+        >>> node = city.node_number((1, 1))
+        >>> city.adjacency_indices[city.adjacency_indptr[node]:city.adjacency_indptr[node + 1]].tolist()
+        [1, 6, 8, 13]
+        """
+
+        columns = self.width * City.zone_dimension
+        rows = self.height * City.zone_dimension
+        self.number_of_nodes = rows * columns
+        nodes = np.arange(self.number_of_nodes).reshape(rows, columns)
+        # Adding node attributes: zone number changes every zone_dimension coordinates along rows as well as columns
+        self.node_zones = ((nodes // columns // City.zone_dimension) * self.width
+                           + (nodes % columns) // City.zone_dimension).ravel()
+        self.node_populations = self.zone_populations[self.node_zones] / City.zone_dimension ** 2
+
+        # Adding Edges: horizontal edges followed by vertical edges
+        self.edge_sources = np.concatenate((nodes[:, :-1].ravel(), nodes[:-1, :].ravel()))
+        self.edge_destinations = np.concatenate((nodes[:, 1:].ravel(), nodes[1:, :].ravel()))
+        self.edge_likely = 0.5 * (self.likely_vals[self.node_zones[self.edge_sources]]
+                                  + self.likely_vals[self.node_zones[self.edge_destinations]])
+        self.edge_weights = np.full(len(self.edge_sources), float(City.default_commute_time))
+
+        # Adjacency of every node in CSR form, each edge being listed for both of its nodes
+        edges = np.arange(len(self.edge_sources))
+        from_nodes = np.concatenate((self.edge_sources, self.edge_destinations))
+        to_nodes = np.concatenate((self.edge_destinations, self.edge_sources))
+        order = np.lexsort((to_nodes, from_nodes))
+        self.adjacency_indices = to_nodes[order].astype(np.int32)
+        self.adjacency_edges = np.concatenate((edges, edges))[order]
+        self.adjacency_indptr = np.zeros(self.number_of_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(from_nodes, minlength=self.number_of_nodes), out=self.adjacency_indptr[1:])
+        self.graph_view = None
+        self.adjacency_lists = None
+
+    def __getstate__(self):
+        """
+        State of the city used when it is pickled, e.g. to be sent to worker processes. The networkx view and the
+        adjacency lists are left out, as they are rebuilt from the graph arrays when needed.
+        :return: Dictionary of the attributes of the city
+        >>> import pickle
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> graph = city.city_graph
+        >>> copy = pickle.loads(pickle.dumps(city))
+        >>> copy.graph_view is None, copy.city_graph.number_of_edges()
+        (True, 27)
+        """
+        state = self.__dict__.copy()
+        state['graph_view'] = None
+        state['adjacency_lists'] = None
+        return state
+
+    @property
+    def city_graph(self):
+        """
+        Compatibility view of the city graph as a networkx graph, where each node is a tuple of coordinates with the
+        attributes 'Zone_Number', 'Zone_Population' and 'Coord_Population', and each edge has the attribute
+        'adjusted_time'. The view is rebuilt from the arrays of the graph after every traffic update, changes made to it
+        don't affect the simulation.
+        :return: networkx Graph of the city
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.city_graph.number_of_nodes(), city.city_graph.number_of_edges()
+        (18, 27)
+        >>> city.city_graph.nodes[(2, 4)]
+        {'Zone_Number': 1, 'Zone_Population': 800, 'Coord_Population': 88.88888888888889}
+        >>> city.city_graph is city.city_graph
+        True
         """
+        if self.graph_view is None:
+            import networkx as nx
+            columns = self.width * City.zone_dimension
+            graph = nx.Graph()
+            graph.add_nodes_from(((node // columns, node % columns),
+                                  {'Zone_Number': zone, 'Zone_Population': zone_population,
+                                   'Coord_Population': coordinate_population})
+                                 for node, (zone, zone_population, coordinate_population) in
+                                 enumerate(zip(self.node_zones.tolist(),
+                                               self.zone_populations[self.node_zones].tolist(),
+                                               self.node_populations.tolist())))
+            graph.add_edges_from(((source // columns, source % columns), (dest // columns, dest % columns),
+                                  {'adjusted_time': commute_time})
+                                 for source, dest, commute_time in zip(self.edge_sources.tolist(),
+                                                                       self.edge_destinations.tolist(),
+                                                                       self.edge_weights.tolist()))
+            self.graph_view = graph
+        return self.graph_view
 
-        # Adding Nodes and node attributes
-        # Zone should only be updated at intervals of value specified in class variable zone_dimension along rows
-        # as well as columns
-        zone_num = -1
-        for i in range(City.zone_dimension * self.height):
-            for j in range(City.zone_dimension * self.width):
-                # Updated zone if column is 0 or divisible by zone_dimension
-                if (j == 0) or (j % City.zone_dimension == 0):
-                    zone_num += 1
-                # Add nodes and node attributes
-                self.city_graph.add_nodes_from([((i, j), {'Zone_Number': zone_num,
-                                                          'Zone_Population': self.zone_populations[zone_num],
-                                                          'Coord_Population': self.zone_populations[
-                                                                                zone_num] / City.zone_dimension ** 2})])
-            # Rollback zone_num to -1 unless column reaches update interval
-            if (i == 0) or (i % City.zone_dimension != 0):
-                zone_num -= self.width
-
-        # Adding Edges
-        nodes = list(self.city_graph.nodes)
-        for (i, j) in nodes:
-            # Update horizontal edges
-            if self.city_graph.has_node((i, j + 1)):
-                self.city_graph.add_edge((i, j), (i, j + 1), adjusted_time=City.default_commute_time)
-            # Update vertical edges
-            if self.city_graph.has_node((i + 1, j)):
-                self.city_graph.add_edge((i, j), (i + 1, j), adjusted_time=City.default_commute_time)
-
-    def update_graph_edges(self, time_of_day: int):
-        """
-        Calculate random time penalty due to traffic and update edge attribute 'adjusted time' for all graph edges
+    def update_graph_edges(self, time_of_day: int, rng: np.random.Generator = None):
+        """
+        Calculate random time penalty due to traffic and update edge attribute 'adjusted time' for all graph edges.
+        The penalties of all the edges are drawn in a single draw (see draw_edge_weights()), and stored in edge_weights.
+        The travel time table of the emergency units is rebuilt for the new traffic, if units have been set.
         :param time_of_day: Time of day identifier. 0: 12AM-6AM, 1:6AM-12PM, 2: 12PM-6PM, 3: 6PM-12AM
-        :return: None. Modifies graph object in place
+        :param rng: Numpy random number generator used for the traffic penalties
+        :return: None. Modifies graph arrays in place
 
         >>> city =  City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
         >>> city.update_graph_edges(0)
@@ -194,19 +305,351 @@ class City:
         ...
         Exception: Time of day value should be one of the keys in Class object traffic_time_weight keys
         """
+        self.set_edge_weights(self.draw_edge_weights(time_of_day, rng))
+
+    def draw_edge_weights(self, time_of_day: int, rng: np.random.Generator = None) -> np.ndarray:
+        """
+        Draw the commute times of all the edges for a time of day, without applying them to the city. The penalties of
+        all the edges are drawn in a single draw, with the same distribution as in get_commute_time().
+        :param time_of_day: Time of day identifier. 0: 12AM-6AM, 1:6AM-12PM, 2: 12PM-6PM, 3: 6PM-12AM
+        :param rng: Numpy random number generator used for the traffic penalties
+        :return: Numpy array of the commute time of each edge, in the order of edge_sources
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> weights = city.draw_edge_weights(1, np.random.default_rng(0))
+        >>> weights.shape, bool((weights != city.edge_weights).any())
+        ((27,), True)
+        """
         if time_of_day in City.traffic_time_weights.keys():
-            for (i, j) in self.city_graph.nodes:
-                # Update horizontal edges
-                if self.city_graph.has_node((i, j + 1)):
-                    commute_time = self.get_commute_time((i, j), (i, j + 1), City.traffic_time_weights[time_of_day])
-                    self.city_graph[(i, j)][(i, j + 1)]['adjusted_time'] = commute_time
-                # Update vertical edges
-                if self.city_graph.has_node((i + 1, j)):
-                    commute_time = self.get_commute_time((i, j), (i + 1, j), City.traffic_time_weights[time_of_day])
-                    self.city_graph[(i, j)][(i + 1, j)]['adjusted_time'] = commute_time
+            traffic_time = mod_pert_random(low=0, likely=self.edge_likely, high=1, samples=len(self.edge_likely),
+                                           rng=rng)
+            traffic_time *= City.traffic_time_weights[time_of_day]  # scale traffic time value by time of day weight
+            # increase commute time by traffic_time%
+            return City.default_commute_time + City.default_commute_time * traffic_time
         else:
             raise Exception("Time of day value should be one of the keys in Class object traffic_time_weight keys")
 
+    def set_edge_weights(self, edge_weights: np.ndarray):
+        """
+        Apply commute times to all the edges, drawn by draw_edge_weights() or replayed from a recorded scenario or a
+        traffic profile. The travel time table of the emergency units is updated for the new commute times, if units
+        have been set (see update_travel_time_table()).
+        :param edge_weights: Numpy array of the commute time of each edge, in the order of edge_sources
+        :return: None
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.set_edge_weights(np.full(27, 4.0))
+        >>> city.city_graph[(1, 1)][(0, 1)]['adjusted_time']
+        4.0
+        >>> city.set_edge_weights(np.full(26, 4.0))
+        Traceback (most recent call last):
+        ...
+        ValueError: Expected the commute times of 27 edges, got 26
+        """
+        if len(edge_weights) != len(self.edge_sources):
+            raise ValueError(f"Expected the commute times of {len(self.edge_sources)} edges, got {len(edge_weights)}")
+        previous_weights, self.edge_weights = self.edge_weights, edge_weights
+        self.graph_view = None
+        self.adjacency_lists = None
+        if self.unit_locations:
+            if self.travel_time_table is not None and self.routing_cache is None:
+                self.update_travel_time_table(previous_weights)
+            else:
+                self.build_travel_time_table()
+
+    def node_number(self, location: tuple) -> int:
+        """
+        Number of a coordinate of the city, counted from 0 row-wise over all the coordinates of the city
+        :param location: Coordinates in the city
+        :return: Node number of the coordinates
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.node_number((0, 0)), city.node_number((1, 2)), city.node_number((2, 5))
+        (0, 8, 17)
+        """
+        return location[0] * self.width * City.zone_dimension + location[1]
+
+    def set_unit_locations(self, unit_locations: list):
+        """
+        Set the coordinates of the emergency units, for which the travel time to every coordinate of the city is
+        tabulated at each traffic update. The table is built immediately for the current traffic.
+        :param unit_locations: List of coordinates of the emergency units
+        :return: None
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.set_unit_locations([(0, 0), (2, 5)])
+        >>> city.travel_time_table.shape, city.travel_time_table_bytes
+        ((2, 18), 288)
+        >>> city.set_unit_locations([])
+        >>> city.travel_time_table is None
+        True
+        """
+        self.unit_locations = list(unit_locations)
+        self.unit_index = {location: index for index, location in enumerate(self.unit_locations)}
+        if self.unit_locations:
+            self.build_travel_time_table()
+        else:
+            self.travel_time_table = None
+            self.travel_time_table_bytes = 0
+            self.travel_time_bounds = None
+
+    def build_travel_time_table(self):
+        """
+        Build a dense table of the shortest time taken to commute from every emergency unit to every coordinate of the
+        city with the current traffic, using Dijkstra's shortest path algorithm over a sparse matrix of the graph.
+        Rows of the table follow the order of unit_locations and columns follow node_number(). The memory used by the
+        table in bytes is recorded in travel_time_table_bytes, as it is rebuilt with every traffic update. If the city
+        has a routing_cache, tables already computed for the same units and commute times are loaded from it instead.
+        :return: None
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.update_graph_edges(2)
+        >>> city.set_unit_locations([(0, 0), (1, 4)])
+        >>> import networkx as nx
+        >>> expected = nx.shortest_path_length(city.city_graph, (1, 4), (2, 0), weight='adjusted_time')
+        >>> bool(np.isclose(city.travel_time_table[1, city.node_number((2, 0))], expected))
+        True
+        >>> float(city.travel_time_table[0, 0])
+        0.0
+        """
+        unit_nodes = [self.node_number(location) for location in self.unit_locations]
+        if self.routing_cache is None:
+            self.travel_time_table = self.shortest_travel_times(unit_nodes)
+        else:
+            self.travel_time_table = self.routing_cache.travel_time_table(self, unit_nodes)
+        self.travel_time_table_bytes = self.travel_time_table.nbytes
+        self.travel_time_bounds = None
+        self.changed_edges = None
+        self.minimum_edge_weights = None
+
+    def update_travel_time_table(self, previous_weights: np.ndarray):
+        """
+        Update the travel time table of the emergency units for the current commute times incrementally, instead of
+        rebuilding it. The entries of the table are left as they are, and each row gets a lower bound below which its
+        entries are still exact: a path using an edge whose commute time changed since the table was built is at least
+        as long as the travel time of the unit to the closest node of such an edge, plus the lowest commute time the
+        edge had since. The entries from or above the bound of their row are stale, and their rows are only recomputed
+        when a lookup can't do without them (see closest_table_units()), so traffic changing in a few places of the
+        city only recomputes the rows of the units whose closest units are affected. The table is rebuilt from scratch
+        once more than incremental_edge_fraction of the edges changed since it was built, e.g. for traffic drawn anew
+        for every edge.
+        :param previous_weights: Numpy array of the commute times of the edges before the change
+        :return: None
+        >>> city = City(3, 3, [400, 800, 400, 800, 1600, 800, 400, 800, 400], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.update_graph_edges(1, np.random.default_rng(0))
+        >>> city.set_unit_locations([(0, 0), (4, 4), (8, 8)])
+        >>> weights = city.edge_weights.copy()
+        >>> weights[city.node_zones[city.edge_sources] == 8] *= 3
+        >>> city.set_edge_weights(weights)
+        >>> exact = city.shortest_travel_times([0, 40, 80])
+        >>> fresh = city.travel_time_table < city.travel_time_bounds[:, None]
+        >>> bool((city.travel_time_table[fresh] == exact[fresh]).all()), bool(fresh.all()), bool(fresh.any())
+        (True, False, True)
+        >>> city.refresh_travel_time_rows(np.arange(3))
+        >>> bool((city.travel_time_table == exact).all())
+        True
+        >>> city.set_edge_weights(np.full(len(weights), 2.0))
+        >>> city.travel_time_bounds is None
+        True
+        """
+        changed = np.flatnonzero(self.edge_weights != previous_weights)
+        if len(changed) == 0:
+            return
+        if self.travel_time_bounds is None:
+            self.travel_time_bounds = np.full(len(self.unit_locations), np.inf)
+            self.changed_edges = np.zeros(len(self.edge_weights), dtype=bool)
+            self.minimum_edge_weights = previous_weights.copy()
+        self.changed_edges[changed] = True
+        if np.count_nonzero(self.changed_edges) > City.incremental_edge_fraction * len(self.edge_weights):
+            self.build_travel_time_table()
+            return
+        self.minimum_edge_weights[changed] = np.minimum(self.minimum_edge_weights[changed], self.edge_weights[changed])
+        table = self.travel_time_table
+        closest = np.minimum(table[:, self.edge_sources[changed]], table[:, self.edge_destinations[changed]])
+        self.travel_time_bounds = np.minimum(self.travel_time_bounds,
+                                             (closest + self.minimum_edge_weights[changed]).min(axis=1))
+
+    def refresh_travel_time_rows(self, rows: np.ndarray, limit: float = np.inf):
+        """
+        Recompute rows of the travel time table for the current commute times, after an incremental update (see
+        update_travel_time_table()). Only the travel times within a limit are computed, the others being left infinite,
+        so the limit is the bound of the rows: a search around each unit up to the limit is much cheaper than over the
+        whole city when the closest units of an emergency are needed.
+        :param rows: Numpy array of the rows recomputed
+        :param limit: Travel time up to which the rows are computed
+        :return: None
+        """
+        unit_nodes = [self.node_number(self.unit_locations[row]) for row in rows]
+        self.travel_time_table[rows] = self.shortest_travel_times(unit_nodes, limit=limit)
+        self.travel_time_bounds[rows] = limit
+
+    def closest_table_units(self, location: tuple, rows: np.ndarray, capacities: np.ndarray,
+                            requirement: int) -> tuple:
+        """
+        Orders units of the travel time table by the time taken to reach a location, as in find_closest_units(), and
+        selects the closest units which together can provide the required number of teams. After an incremental update
+        of the table (see update_travel_time_table()), the rows of the stale entries which could be among the closest
+        units are recomputed until the selection only depends on exact entries, so it is the same as with a table
+        rebuilt from scratch. Stale entries are first ranked by their previous travel times, which are usually close to
+        the current ones, so that most rows needed are recomputed at once, then by the lower bound of their row.
+        :param location: Coordinates from which the units are searched for
+        :param rows: Numpy array of the rows of the units in the table
+        :param capacities: Numpy array of the number of teams available in each unit
+        :param requirement: Number of teams required at the location
+        :return: Numpy array of the positions in rows of the closest units, in order, and numpy array of the time taken
+        from each unit to reach the location
+        """
+        node = self.node_number(location)
+        times = self.travel_time_table[rows, node]
+        stale = None if self.travel_time_bounds is None else times >= self.travel_time_bounds[rows]
+        estimate = True
+        while True:
+            ranked = times if stale is None or estimate else np.where(stale, self.travel_time_bounds[rows], times)
+            # Minimal default time of 1 minute for a unit at the location itself
+            ranked[ranked == 0] = 1
+            # Ties resolved by the order of the units in the table, which doesn't change as teams are dispatched
+            order = np.lexsort((rows, -capacities, ranked))
+            needed = np.searchsorted(np.cumsum(capacities[order]), requirement) + 1
+            if stale is None:
+                return order[:needed], ranked
+            # Stale entries whose bound is beyond the last unit selected can't be closer than the units selected
+            competing = stale & (self.travel_time_bounds[rows] <= ranked[order[:needed][-1]])
+            if not competing.any():
+                if not estimate:
+                    return order[:needed], ranked
+                estimate = False
+                continue
+            estimate = False
+            # Searched beyond the last unit selected, so that the rows recomputed are usually enough for the selection
+            # and for the next emergencies close by
+            self.refresh_travel_time_rows(np.unique(rows[competing]),
+                                          City.refresh_limit_factor * ranked[order[:needed][-1]])
+            times = self.travel_time_table[rows, node]
+            stale = times >= self.travel_time_bounds[rows]
+
+    def shortest_travel_times(self, unit_nodes: list, edge_weights: np.ndarray = None,
+                              limit: float = np.inf) -> np.ndarray:
+        """
+        Computes the shortest commute times from nodes to every coordinate of the city, for the current commute times
+        of the edges, using Dijkstra's shortest path algorithm from each node.
+        :param unit_nodes: List of the node numbers from which the commute times are computed
+        :param edge_weights: Numpy array of the commute time of each edge used instead of the current commute times,
+        e.g. those of another simulation run (see LockstepEngine)
+        :param limit: Commute time up to which the commute times are computed, the longer ones being infinite
+        :return: Numpy array of the commute times, with one row per node of unit_nodes
+        """
+        edge_weights = self.edge_weights if edge_weights is None else edge_weights
+        adjacency = csr_matrix((edge_weights[self.adjacency_edges], self.adjacency_indices, self.adjacency_indptr),
+                               shape=(self.number_of_nodes, self.number_of_nodes))
+        return dijkstra(adjacency, directed=False, indices=unit_nodes, limit=limit)
+
+    def find_closest_units(self, location: tuple, unit_capacities: dict, requirement: int) -> list:
+        """
+        Finds the emergency units closest to a location, using a single run of Dijkstra's shortest path algorithm from
+        the location. As the paths of the city can be commuted in either direction, the time taken to commute from the
+        location to a unit is the time taken by teams from the unit to reach the location. The search stops as soon as
+        the units found can provide the required number of teams, once all the units reachable in the same time as
+        the last unit needed have been found. If a unit is at the location itself, a minimal default time of 1 minute
+        is considered as the time taken to reach the location. If the travel time table has been built for the units
+        (see set_unit_locations()), it is used instead of the search.
+        :param location: Coordinates from which the units are searched for
+        :param unit_capacities: Dictionary mapping coordinates of the units which have teams available to the number of
+        teams available
+        :param requirement: Number of teams required at the location
+        :return: List of tuples of the time taken to reach the location and the coordinates of the unit, ordered by time
+        (ascending) and number of teams available (descending), with ties resolved by the order of unit_capacities
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.find_closest_units((0, 0), {(0, 0): 3, (2, 5): 7, (0, 1): 3, (1, 0): 5}, 3)
+        [(1, (0, 0))]
+        >>> city.find_closest_units((0, 0), {(0, 0): 3, (2, 5): 7, (0, 1): 3, (1, 0): 5}, 4)
+        [(1, (0, 0)), (3.0, (1, 0)), (3.0, (0, 1))]
+        >>> city.find_closest_units((0, 0), {(0, 0): 3, (2, 5): 7, (0, 1): 3, (1, 0): 5}, 20)
+        [(1, (0, 0)), (3.0, (1, 0)), (3.0, (0, 1)), (21.0, (2, 5))]
+        """
+        if self.travel_time_table is not None and all(unit in self.unit_index for unit in unit_capacities):
+            return self.lookup_closest_units(location, unit_capacities, requirement)
+        if self.adjacency_lists is None:
+            self.adjacency_lists = (self.adjacency_indptr.tolist(), self.adjacency_indices.tolist(),
+                                    self.edge_weights[self.adjacency_edges].tolist())
+        indptr, indices, weights = self.adjacency_lists
+        unit_nodes = {self.node_number(unit_location): (index, unit_location)
+                      for index, unit_location in enumerate(unit_capacities)}
+        source = self.node_number(location)
+        closest_units = []
+        teams_found = 0
+        cutoff = None
+        settled = set()
+        heap = [(0, source)]
+        while heap:
+            time, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            # Stop once every unit reachable in the same time as the last unit needed has been found
+            if cutoff is not None and time > cutoff:
+                break
+            settled.add(node)
+            if node in unit_nodes:
+                index, unit_location = unit_nodes[node]
+                capacity = unit_capacities[unit_location]
+                closest_units.append((1 if node == source else time, -capacity, index, unit_location))
+                teams_found += capacity
+                if cutoff is None and teams_found >= requirement:
+                    cutoff = time
+            for position in range(indptr[node], indptr[node + 1]):
+                neighbour = indices[position]
+                if neighbour not in settled:
+                    heapq.heappush(heap, (time + weights[position], neighbour))
+        closest_units.sort()
+        return [(time, unit_location) for time, _, _, unit_location in closest_units]
+
+    def lookup_closest_units(self, location: tuple, unit_capacities: dict, requirement: int) -> list:
+        """
+        Finds the emergency units closest to a location using the travel time table, in the same order as
+        find_closest_units(). Only the closest units which together can provide the required number of teams are
+        returned.
+        :param location: Coordinates from which the units are searched for
+        :param unit_capacities: Dictionary mapping coordinates of the units which have teams available to the number of
+        teams available
+        :param requirement: Number of teams required at the location
+        :return: List of tuples of the time taken to reach the location and the coordinates of the unit, with ties
+        resolved by the order of unit_locations
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> units = {(0, 0): 3, (2, 5): 7, (0, 1): 3, (1, 0): 5}
+        >>> city.set_unit_locations(list(units))
+        >>> city.lookup_closest_units((0, 0), units, 4)
+        [(1.0, (0, 0)), (3.0, (1, 0))]
+        >>> city.lookup_closest_units((0, 0), units, 20) == city.find_closest_units((0, 0), units, 20)
+        True
+        """
+        locations = list(unit_capacities)
+        capacities = np.fromiter(unit_capacities.values(), dtype=np.int64, count=len(locations))
+        rows = np.fromiter((self.unit_index[unit] for unit in locations), dtype=np.int64, count=len(locations))
+        closest, times = self.closest_table_units(location, rows, capacities, requirement)
+        return [(times[index].item(), locations[index]) for index in closest]
+
+    def lookup_available_units(self, location: tuple, units, requirement: int) -> list:
+        """
+        Finds the emergency units of an index closest to a location using the travel time table, in the same order as
+        lookup_closest_units(), reading the number of teams available from the capacity vector of the index instead of
+        a dictionary of the units with teams available.
+        :param location: Coordinates from which the units are searched for
+        :param units: UnitIndex of the units, all of which are tabulated by the city (see UnitIndex.table_rows())
+        :param requirement: Number of teams required at the location
+        :return: List of tuples of the time taken to reach the location and the coordinates of the unit
+        >>> from EmergencyUnit import EmergencyUnit, UnitIndex
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> capacities = {(0, 0): 3, (2, 5): 7, (0, 1): 3, (1, 0): 5}
+        >>> city.set_unit_locations(list(capacities))
+        >>> sizes = {3: 'small', 5: 'medium', 7: 'large'}
+        >>> index = UnitIndex([EmergencyUnit(sizes[teams], location, register=False)
+        ...                    for location, teams in capacities.items()])
+        >>> index.units[(0, 0)].dispatch_teams(3)
+        >>> city.lookup_available_units((0, 0), index, 4)
+        [(3.0, (1, 0))]
+        >>> city.lookup_available_units((0, 0), index, 20) == city.lookup_closest_units((0, 0), index.capacities(), 20)
+        True
+        """
+        available = np.flatnonzero(units.capacity > 0)
+        capacities = units.capacity[available]
+        rows = units.table_rows(self)[available]
+        closest, times = self.closest_table_units(location, rows, capacities, requirement)
+        return [(times[index].item(), units.locations[available[index]]) for index in closest]
+
     def check_coordinates(self, x: int, y: int) -> bool:
         """
         Checks if a given set of coordinate is within the permissible set of coordinates for a city. Function was
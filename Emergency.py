@@ -1,17 +1,14 @@
 import random
 import math
-import threading
-import networkx as nx
+import numpy as np
 from CityConfiguration import City
-from collections import defaultdict
-from EmergencyUnit import EmergencyUnit
+from EmergencyUnit import EmergencyUnit, UnitIndex
 
 
 class Emergency:
     """
     Emergency entity which represents the emergencies occurring throughout the city.
     """
-    lock = threading.Lock()
     # Dictionary mapping different intensities to number of emergency teams and total time taken to
     # resolve each intensity type of emergency, once team reaches the location of the emergency.
     intensity_mapping = {1: {'teams': 3, 'time': 5}, 2: {'teams': 4, 'time': 10}, 3: {'teams': 5, 'time': 15},
@@ -20,15 +17,22 @@ class Emergency:
     resolution_time_threshold = 10
     # List containing all the Emergency objects over one simulation run
     emergencies = []
+    # Record of an emergency drawn by generate_arrivals(): minute of occurrence, zone, location and intensity
+    arrival_dtype = np.dtype([('minute', np.int32), ('zone', np.int32), ('row', np.int16), ('col', np.int16),
+                              ('intensity', np.int8)])
 
-    def __init__(self, city: City, zone: int):
+    def __init__(self, city: City, zone: int, arrival_time=0, location: tuple = None, intensity: int = None):
         """
         Randomize the location of emergency within the specified zone, using a uniform distribution, and
-        randomize the intensity of the emergency using the user provided probabilites. The number
-        of teams required to resolve the emergency is also initialized using the pre-defined dictionary mapping,
-        and the emergency is attempted to be resolved.
+        randomize the intensity of the emergency using the user provided probabilites, unless the location and intensity
+        have already been drawn (see generate_arrivals()). The number
+        of teams required to resolve the emergency is also initialized using the pre-defined dictionary mapping.
+        The emergency is resolved once teams are allocated to it through resolve_emergency().
         :param city: City configured where the emergency is taking place
         :param zone: Zone number of the city, counted from 0 row-wise, where the emergency occurs
+        :param arrival_time: Minute of the simulation run at which the emergency occurs
+        :param location: Coordinates of the emergency, randomized within the zone if not specified
+        :param intensity: Intensity of the emergency, randomized if not specified
         :return: None
         >>> populations = [2000, 3500, 900, 4500, 700, 9000, 870, 4500, 2000, 400, 2400, 3000]
         >>> intensity_distributions = [0.2, 0.2, 0.2, 0.2, 0.2]
@@ -56,39 +60,56 @@ class Emergency:
         True
         >>> e4=Emergency(test1, 15)
         Unable to create an emergency as zone does not exist in the city.
+        >>> e5=Emergency(test1, 7, 12, (4, 10), 3)
+        >>> e5.location, e5.intensity, e5.requirement, e5.arrival_time
+        ((4, 10), 3, 5, 12)
         """
         if zone >= city.width*city.height:
             print('Unable to create an emergency as zone does not exist in the city.')
             return
         self.time_to_respond = None
+        self.time_to_resolve = None
+        self.arrival_time = arrival_time
+        self.waiting_time = 0
         zone_col = zone % city.width
         zone_row = math.floor(zone/city.width)
-        self.response_unit = None
-        # One of 9 coordinates (0 to 8) chosen to position emergency
-        loc = random.randint(0, (City.zone_dimension ** 2) - 1)
-        r = math.floor(loc/City.zone_dimension)
-        c = loc % City.zone_dimension
-        # Location of the emergency calculated with respect to the city coordinate grid
-        self.location = ((zone_row*City.zone_dimension) + r, (zone_col*City.zone_dimension) + c)
-        rand = random.randint(1, 100)
-        for i in range(len(city.intensity_cumulative)):
-            if rand <= city.intensity_cumulative[i]:
-                self.intensity = i + 1
-                break
+        self.response_unit = {}
+        # Sum of the times taken by teams from each allocated emergency unit to reach the location of the emergency
+        self.response_time_sum = 0
+        if location is None:
+            # One of 9 coordinates (0 to 8) chosen to position emergency
+            loc = random.randint(0, (City.zone_dimension ** 2) - 1)
+            r = math.floor(loc/City.zone_dimension)
+            c = loc % City.zone_dimension
+            # Location of the emergency calculated with respect to the city coordinate grid
+            location = ((zone_row*City.zone_dimension) + r, (zone_col*City.zone_dimension) + c)
+        self.location = location
+        if intensity is None:
+            rand = random.randint(1, 100)
+            for i in range(len(city.intensity_cumulative)):
+                if rand <= city.intensity_cumulative[i]:
+                    intensity = i + 1
+                    break
+        self.intensity = intensity
         self.city_of_emergency = city
         self.requirement = Emergency.intensity_mapping[self.intensity]['teams']
+        # Number of teams which are still to be allocated to the emergency
+        self.pending_requirement = self.requirement
         Emergency.emergencies.append(self)
-        self.resolve_emergency()
 
-    def resolve_emergency(self):
+    def resolve_emergency(self, current_time=None, units: UnitIndex = None):
         """
         Invokes the core logic of the simulation to allocate the required number of available teams from optimal
-        locations of the emergency units, in order to resolve the emergency. Once the optimal allocation of teams
-        from one or more emergency units is calculated, the simulation performs the computation representing
-        the passage of time, which represents the teams being busy and unavailable to respond to other emergencies.
-        Once the specified amount of time required for the teams to commute to the location of the emergency, resolve
-        the emergency and commute back to their original location(s) has elapsed, the teams are released and are
-        free to respond to subsequent emergencies.
+        locations of the emergency units, in order to resolve the emergency. Once all the required teams are allocated,
+        the time taken to respond to the emergency is recorded, along with the total time for which the allocated teams
+        are busy and unavailable to respond to other emergencies: the time required for the teams to commute to the
+        location of the emergency, resolve the emergency and commute back to their original location(s). The teams are
+        released using release_teams() once this time has elapsed on the simulation clock. If the required number of
+        teams isn't available, the emergency keeps the teams allocated so far and time_to_respond remains None until it
+        is resolved at a later minute.
+        :param current_time: Minute of the simulation run at which teams are being allocated, defaults to the minute at
+        which the emergency occurred
+        :param units: UnitIndex of the emergency units of the city, defaults to EmergencyUnit.building_index
         :return: None
         >>> populations = [2500, 2500]
         >>> intensity_distributions = [1, 0, 0, 0, 0]
@@ -118,40 +139,56 @@ class Emergency:
         >>> e.time_to_respond == 1.0
         True
         """
-        emergency_units, time_taken_to_reach, waiting_time = self.allocate_teams_to_emergency()
-        # Total time taken to resolve emergency
-        time_to_resolve = time_taken_to_reach + Emergency.intensity_mapping[self.intensity]['time'] + \
-            time_taken_to_reach + waiting_time
+        emergency_units, time_taken_to_reach, waiting_time = self.allocate_teams_to_emergency(current_time, units)
+        if time_taken_to_reach is None:
+            return
+        # Total time for which the allocated teams are busy once all of them have been allocated (to-commute time, time
+        # to resolve emergency and fro-commute time). Teams allocated before the emergency started waiting are also
+        # busy during the waiting time, as they are relieved together with the rest of the teams.
+        self.time_to_resolve = time_taken_to_reach + Emergency.intensity_mapping[self.intensity]['time'] + \
+            time_taken_to_reach
         # Time taken to respond to the emergency (commute time to location of emergency)
         self.time_to_respond = float(time_taken_to_reach) + waiting_time
+        self.waiting_time = waiting_time
         self.response_unit = emergency_units
-        # Waiting for passage of time equivalent to the total time that teams are busy (to-commute time, time to resolve
-        # emergency, fro-commute time and any waiting time), by simulating each minute as program equivalent of passage
-        # of a minute as what occurs in the simulate() function, where each iteration and the computation within each
-        # iteration until a random number is chosen is considered to be 1 minute in program/simulation time
-        for _ in range(int(time_to_resolve)):
-            for __ in self.city_of_emergency.zone_populations:
-                random.randint(1, 1000000)
-        # Relieve emergency teams after keeping them busy for the required duration of time as described above
-        for emergency_unit, num_teams in emergency_units.items():
+
+    def release_teams(self):
+        """
+        Relieve the emergency teams allocated to the emergency, once they have been kept busy for the time required to
+        resolve the emergency, making them free to respond to subsequent emergencies.
+        :return: None
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> Emergency.clear_emergencies()
+        >>> test = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> unit = EmergencyUnit('large', (1, 1))
+        >>> e = Emergency(test, 0)
+        >>> e.resolve_emergency()
+        >>> unit.available_capacity
+        4
+        >>> e.release_teams()
+        >>> unit.available_capacity
+        7
+        """
+        for emergency_unit, num_teams in self.response_unit.items():
             emergency_unit.relieve_response_teams(num_teams)
 
-    def allocate_teams_to_emergency(self):
+    def allocate_teams_to_emergency(self, current_time=None, units: UnitIndex = None):
         """
         Optimally allocate the required number of teams to resolve the emergency by finding the available teams
         from one or more emergency units. Calculate the time required to respond to the emergency as the average of
-        the time required for each of the teams to commute to the location of the emergency using the Dijkstra's
-        shortest path algorithm. Update the number of available teams in the emergency units from which teams are being
-        dispatched.
-        In the scenario that no emergency units have teams available, then the emergency waits for the
-        required number of teams to become available, and the waiting time is also recorded.
-        Since each emergency is created on a separate thread, a locking mechanism is added to the logic in this method
-        in order to prevent race conditions, and ensure that the optimal allocation of teams calculation is performed
-        for only one thread (emergency) at one point in time.
-        :return: Dictionary containing mapping of emergency unit objects to the time required for teams from each
-        of the allocated emergency units to reach the location of the emergency (respond to the emergency), the
-        response time in minutes for the particular emergency, waiting time (if any) in minutes that was involved
-        in waiting for required number of teams to become available.
+        the time required for each of the teams to commute to the location of the emergency using a single run of
+        Dijkstra's shortest path algorithm from the location of the emergency (see City.find_closest_units()). Update
+        the number of available teams in the emergency units from which teams are being dispatched.
+        In the scenario that emergency units don't have enough teams available, then the teams available are allocated
+        and the emergency waits for the remaining teams to become available. The allocation is then continued at a
+        later minute of the simulation run, and the waiting time is recorded.
+        :param current_time: Minute of the simulation run at which teams are being allocated, defaults to the minute at
+        which the emergency occurred
+        :param units: UnitIndex of the emergency units of the city, defaults to EmergencyUnit.building_index
+        :return: Dictionary containing mapping of emergency unit objects to the number of teams allocated from each of
+        the emergency units, the response time in minutes for the particular emergency (None if the emergency is still
+        waiting for teams), waiting time (if any) in minutes that was involved in waiting for required number of teams
+        to become available.
         >>> populations = [2500, 2500]
         >>> intensity_distributions = [0, 1, 0, 0, 0]
         >>> test = City(2, 1, populations, intensity_distributions)
@@ -186,56 +223,77 @@ class Emergency:
         >>> 0 <= list(unit_loc.keys())[0].location[1] <= 5
         True
         """
-        # Locking mechanism used for the thread to acquire a lock at the beginning of the method and release it at the
-        # end to prevent race conditions
-        # Locking code obtained from https://coderslegacy.com/python/lock-in-with-statement/
-        waiting_time = 0
-        with Emergency.lock:
-            graph = self.city_of_emergency.city_graph
-            emergency_requirement = self.requirement
-            # Response time measured in minutes
-            response_time = 0
-            winner_nodes = defaultdict(dict)
-            while emergency_requirement != 0:
-                node_to_emergency_details = defaultdict(dict)
-                # For units where teams are available, sort the units by time required for a team from unit
-                # to reach location of emergency (ascending order), and use number of
-                # available teams (descending order) to resolve ties while sorting. If an emergency occurs
-                # at the same location as an emergency unit, minimal default time of 1 minute is considered
-                # as the time taken to respond to the emergency.
-                for unit in EmergencyUnit.response_buildings:
-                    if unit.available_capacity > 0:
-                        node_to_emergency_details[unit]['capacity'] = unit.available_capacity
-                        node_to_emergency_details[unit]['time'] = 1 if unit.location == self.location \
-                            else nx.algorithms.shortest_path_length(
-                            graph, unit.location, self.location, weight='adjusted_time', method='dijkstra')
-                sorted_node_to_emergency_details = {k: v for k, v in sorted(node_to_emergency_details.items(),
-                                                                            key=lambda item: (
-                                                                            item[1]['time'], -item[1]['capacity']))}
-                for response_unit in sorted_node_to_emergency_details:
-                    emergency_requirement, available, teams_dispatched = response_unit.check_team_availability(
-                        emergency_requirement)
-                    if available:
-                        response_time += sorted_node_to_emergency_details[response_unit]['time']
-                        response_unit.dispatch_teams(teams_dispatched)
-                        winner_nodes[response_unit] = teams_dispatched
-                    if emergency_requirement == 0:
-                        break
-                # If there aren't sufficient teams available to resolve the emergency, wait until a team becomes
-                # available (appropriate flag is set by thread in EmergencyUnit class when relieving teams).
-                # Record the waiting time in minutes, by simulating each minute as program equivalent of passage
-                # of a minute as what occurs in the simulate() function, where each iteration and the computation
-                # within each iteration until a random number is chosen is considered to be 1 minute in
-                # program/simulation time
-                if emergency_requirement != 0:
-                    EmergencyUnit.wait_for_teams_to_be_available = True
-                    while EmergencyUnit.wait_for_teams_to_be_available:
-                        for __ in self.city_of_emergency.zone_populations:
-                            random.randint(1, 1000000)
-                        waiting_time += 1
-                else:
-                    avg_resp = response_time / len(winner_nodes)
-            return winner_nodes, avg_resp, waiting_time
+        current_time = self.arrival_time if current_time is None else current_time
+        units = EmergencyUnit.building_index if units is None else units
+        # For units where teams are available, sort the units by time required for a team from unit
+        # to reach location of emergency (ascending order), and use number of
+        # available teams (descending order) to resolve ties while sorting. If an emergency occurs
+        # at the same location as an emergency unit, minimal default time of 1 minute is considered
+        # as the time taken to respond to the emergency. Only the closest units which together have the
+        # required number of teams available are considered. The index of the units keeps track of the units
+        # where teams are available, so the units without teams available are never visited.
+        # The travel time table is read directly with the capacity vector of the index if it tabulates all the units
+        city = self.city_of_emergency
+        if city.travel_time_table is not None and units.table_rows(city) is not None:
+            closest_units = city.lookup_available_units(self.location, units, self.pending_requirement)
+        else:
+            closest_units = city.find_closest_units(self.location, units.capacities(), self.pending_requirement)
+        for time, location in closest_units:
+            if self.pending_requirement == 0:
+                break
+            response_unit = units.units[location]
+            self.pending_requirement, available, teams_dispatched = response_unit.check_team_availability(
+                self.pending_requirement)
+            if available:
+                self.response_time_sum += time
+                response_unit.dispatch_teams(teams_dispatched)
+                self.response_unit[response_unit] = self.response_unit.get(response_unit, 0) + teams_dispatched
+        waiting_time = current_time - self.arrival_time
+        if self.pending_requirement != 0:
+            return self.response_unit, None, waiting_time
+        avg_resp = self.response_time_sum / len(self.response_unit)
+        return self.response_unit, avg_resp, waiting_time
+
+    @staticmethod
+    def generate_arrivals(city: City, zone_probabilities: np.array, minutes: int, rng: np.random.Generator = None):
+        """
+        Draw all the emergencies occurring in the city over the given number of minutes at once, instead of one
+        emergency at a time. An emergency occurs in a zone within a minute with the probability given for the zone
+        (see poisson_probability() in main.py), its location is drawn uniformly from the coordinates of the zone, and
+        its intensity is drawn using the intensity probabilities of the city, as done in __init__().
+        :param city: City configured where the emergencies take place
+        :param zone_probabilities: Numpy array of the probabilities of emergency occurring in the next 1 minute, in each
+        zone of the city
+        :param minutes: Number of minutes over which emergencies are drawn
+        :param rng: Numpy random number generator used for the draws
+        :return: Numpy structured array of arrival_dtype records, ordered by minute and then by zone
+        >>> city = City(2, 1, [2500, 2500], [0, 0, 1, 0, 0])
+        >>> arrivals = Emergency.generate_arrivals(city, np.asarray([1.0, 0.0]), 3, np.random.default_rng(0))
+        >>> arrivals['minute'].tolist(), arrivals['zone'].tolist(), arrivals['intensity'].tolist()
+        ([0, 1, 2], [0, 0, 0], [3, 3, 3])
+        >>> bool(((0 <= arrivals['row']) & (arrivals['row'] < 3) & (arrivals['col'] < 3)).all())
+        True
+        >>> arrivals = Emergency.generate_arrivals(city, np.asarray([0.5, 0.25]), 10000, np.random.default_rng(0))
+        >>> [round(float(np.mean(arrivals['zone'] == zone)), 1) for zone in (0, 1)]
+        [0.7, 0.3]
+        >>> bool(((3 <= arrivals['col']) == (arrivals['zone'] == 1)).all())
+        True
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        # Bernoulli draw of an emergency occurring in every zone in every minute
+        minute, zone = np.nonzero(rng.random((minutes, len(zone_probabilities))) < zone_probabilities)
+        arrivals = np.empty(len(minute), dtype=Emergency.arrival_dtype)
+        arrivals['minute'] = minute
+        arrivals['zone'] = zone
+        # One of 9 coordinates (0 to 8) within the zone chosen to position each emergency
+        loc = rng.integers(0, City.zone_dimension ** 2, len(minute))
+        arrivals['row'] = (zone // city.width) * City.zone_dimension + loc // City.zone_dimension
+        arrivals['col'] = (zone % city.width) * City.zone_dimension + loc % City.zone_dimension
+        # Intensity chosen as the first intensity whose cumulative percentage is at least the random percentage drawn
+        rand = rng.integers(1, 101, len(minute))
+        intensity = np.searchsorted(city.intensity_cumulative, rand)
+        arrivals['intensity'] = np.minimum(intensity, len(city.intensity_cumulative) - 1) + 1
+        return arrivals
 
     @staticmethod
     def clear_emergencies():
@@ -254,3 +312,100 @@ class Emergency:
         0
         """
         Emergency.emergencies = []
+
+
+class EmergencyTable:
+    """
+    Struct-of-arrays storage of the emergencies responded to during a simulation run: one numpy array per column,
+    grown by doubling, with a row appended as each emergency is allocated all its teams. The statistics of the run and
+    the records of the EventLog are computed on the columns with vectorized reductions, instead of walking the
+    Emergency objects, which are only kept while the teams allocated to them are busy.
+    """
+    # Columns of the table: minute of occurrence, location, intensity, number of emergency units and of teams
+    # dispatched, waiting time for teams and response time (travel time + waiting time)
+    column_dtypes = {'minute': np.int64, 'row': np.int16, 'col': np.int16, 'intensity': np.int8,
+                     'units_dispatched': np.int16, 'teams': np.int16, 'waiting_time': np.float64,
+                     'response_time': np.float64}
+
+    def __init__(self, capacity: int = 1024):
+        """
+        :param capacity: Number of rows allocated initially
+        """
+        self.size = 0
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in EmergencyTable.column_dtypes.items()}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """
+        View of a column over the rows of the table.
+        :param name: Name of the column
+        :return: Numpy array
+        """
+        return self.columns[name][:self.size]
+
+    def append(self, emergency: Emergency):
+        """
+        Adds a row for an emergency which has been allocated all its teams.
+        :param emergency: Emergency responded to
+        :return: None
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> units = [EmergencyUnit('small', (1, 1)), EmergencyUnit('small', (1, 4))]
+        >>> table = EmergencyTable(capacity=1)
+        >>> for minute in [3, 7]:
+        ...     emergency = Emergency(City(2, 1, [2500, 2500], [0, 1, 0, 0, 0]), 0, minute, (1, 1), 2)
+        ...     emergency.resolve_emergency()
+        ...     table.append(emergency)
+        ...     emergency.release_teams()
+        >>> len(table), table['minute'].tolist(), table['units_dispatched'].tolist(), table['teams'].tolist()
+        (2, [3, 7], [2, 2], [4, 4])
+        >>> table.statistics() == (np.mean(table['response_time']), 100.0)
+        True
+        """
+        if self.size == len(self.columns['minute']):
+            for name, column in self.columns.items():
+                self.columns[name] = np.resize(column, 2 * len(column))
+        row = self.size
+        columns = self.columns
+        columns['minute'][row] = emergency.arrival_time
+        columns['row'][row], columns['col'][row] = emergency.location
+        columns['intensity'][row] = emergency.intensity
+        columns['units_dispatched'][row] = len(emergency.response_unit)
+        columns['teams'][row] = emergency.requirement
+        columns['waiting_time'][row] = emergency.waiting_time
+        columns['response_time'][row] = emergency.time_to_respond
+        self.size += 1
+
+    @staticmethod
+    def from_emergencies(emergencies: list):
+        """
+        Table of a list of emergencies, all responded to.
+        :param emergencies: List of Emergency objects
+        :return: EmergencyTable
+        """
+        table = EmergencyTable(max(len(emergencies), 1))
+        for emergency in emergencies:
+            table.append(emergency)
+        return table
+
+    def statistics(self) -> tuple:
+        """
+        Average response time of the emergencies of the table and percentage of emergencies successfully responded to,
+        within Emergency.resolution_time_threshold minutes.
+        :return: Tuple of the average response time and the percentage, nan for an empty table
+        >>> EmergencyTable().statistics()
+        (nan, nan)
+        """
+        if self.size == 0:
+            return float('nan'), float('nan')
+        response_times = self['response_time']
+        successful = np.count_nonzero(response_times <= Emergency.resolution_time_threshold)
+        return np.mean(response_times), (successful / self.size) * 100
+
+    def clear(self):
+        """
+        Removes every row of the table, keeping the allocated columns.
+        :return: None
+        """
+        self.size = 0
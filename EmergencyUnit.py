@@ -1,23 +1,170 @@
 
+import numpy as np
+
+
+class UnitIndex:
+    """
+    Index of a set of emergency units by location, keeping track of the units which have teams available. The number
+    of teams available in every unit is stored in a capacity vector, indexed by the slot of each unit (its position in
+    the order in which the units were indexed), which the available_capacity of the units are views of. The units
+    update the index themselves whenever their teams are dispatched or relieved, so that the allocation of teams only
+    considers the units with teams available, and the duplicate location of a unit is found in constant time.
+    """
+
+    def __init__(self, units: list = ()):
+        """
+        Index the given emergency units, which update this index (rather than any index they were added to before)
+        from then on.
+        :param units: List of emergency units
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> index = UnitIndex([EmergencyUnit('small', (1, 1)), EmergencyUnit('medium', (0, 0))])
+        >>> (1, 1) in index, (1, 2) in index, index.capacities()
+        (True, False, {(1, 1): 3, (0, 0): 5})
+        >>> index.available[(1, 1)].dispatch_teams(3)
+        >>> index.capacities(), index.capacity.tolist()
+        ({(0, 0): 5}, [0, 5])
+        """
+        # Every unit indexed, by location
+        self.units = {}
+        # Units with teams available, by location, in the order in which their teams last became available (units
+        # leave when they run out of teams and rejoin at the end when relieved), see capacities() for the slot order
+        self.available = {}
+        # Locations of the units and number of teams available in each unit, by slot
+        self.locations = []
+        self.capacity = np.zeros(0, dtype=np.int64)
+        # Rows of the travel time table of a city for each slot, see table_rows()
+        self.table_rows_of = (None, 0, None)
+        for unit in units:
+            self.add(unit)
+
+    def __contains__(self, location: tuple) -> bool:
+        return location in self.units
+
+    def add(self, unit):
+        """
+        Add an emergency unit to the index.
+        :param unit: Emergency unit
+        :return: None
+        """
+        if unit.location in self.units:
+            raise ValueError(f"Coordinates are duplicate for EmergencyResponse unit buildings.. - {unit.location}")
+        # Teams available read before the unit becomes a view of this index
+        available_capacity = unit.available_capacity
+        self.units[unit.location] = unit
+        unit.slot = len(self.locations)
+        unit.index = self
+        self.locations.append(unit.location)
+        self.capacity = np.append(self.capacity, available_capacity)
+        self.update(unit)
+
+    def update(self, unit):
+        """
+        Update the availability of an emergency unit after its teams were dispatched or relieved.
+        :param unit: Emergency unit
+        :return: None
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> units = [EmergencyUnit('small', (1, 1)), EmergencyUnit('small', (1, 2))]
+        >>> index = UnitIndex(units)
+        >>> units[0].dispatch_teams(3)
+        >>> list(index.available)
+        [(1, 2)]
+        >>> units[0].relieve_response_teams(1)
+        >>> list(index.available), index.capacities()
+        ([(1, 2), (1, 1)], {(1, 1): 1, (1, 2): 3})
+        """
+        if self.capacity[unit.slot] > 0:
+            self.available[unit.location] = unit
+        else:
+            self.available.pop(unit.location, None)
+
+    def capacities(self) -> dict:
+        """
+        Number of teams available in each unit with teams available, in the order in which the units were indexed
+        (slot order), so that ties between units broken by the order of the dictionary (see City.find_closest_units())
+        don't depend on the order in which the units were dispatched and relieved.
+        :return: Dictionary mapping the locations of the units with teams available to their number of teams available
+        """
+        return {unit.location: unit.available_capacity for unit in sorted(self.available.values(),
+                                                                          key=lambda unit: unit.slot)}
+
+    def table_rows(self, city) -> np.ndarray:
+        """
+        Rows of the travel time table of a city (see City.set_unit_locations()) of the units, by slot. The rows are
+        computed once for the units tabulated by the city.
+        :param city: City whose travel time table is used
+        :return: Numpy array of the row of each slot, None if some units aren't tabulated by the city
+        >>> from CityConfiguration import City
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> city.set_unit_locations([(0, 0), (1, 1)])
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> UnitIndex([EmergencyUnit('small', (1, 1)), EmergencyUnit('small', (0, 0))]).table_rows(city).tolist()
+        [1, 0]
+        >>> UnitIndex([EmergencyUnit('small', (2, 2))]).table_rows(city) is None
+        True
+        """
+        unit_index, number_of_units, rows = self.table_rows_of
+        if unit_index is not city.unit_index or number_of_units != len(self.locations):
+            if all(location in city.unit_index for location in self.locations):
+                rows = np.fromiter((city.unit_index[location] for location in self.locations), dtype=np.int64,
+                                   count=len(self.locations))
+            else:
+                rows = None
+            self.table_rows_of = (city.unit_index, len(self.locations), rows)
+        return rows
+
+
 class EmergencyUnit:
     # Class variable - List of all emergency units (all objects of class)
     response_buildings = []
-    wait_for_teams_to_be_available = False
+    # Class variable - Index of all emergency units by location
+    building_index = UnitIndex()
     type_to_capacity_mapping = {'small': 3, 'medium': 5, 'large': 7}
 
-    def __init__(self, size: str, location: tuple):
+    def __init__(self, size: str, location: tuple, register: bool = True):
         """
         Initialize size and location of the emergency unit, along with number of teams currently available
         :param size:
         :param location:
+        :param register: Whether the unit is added to the emergency units of the city (response_buildings)
         """
+        self.size = size
         self.location = location
-        self.available_capacity = EmergencyUnit.type_to_capacity_mapping[size]
+        # Index storing the number of teams available in the unit, in the slot of the unit, once the unit is indexed
+        self.index = None
+        self.slot = None
+        self.unindexed_capacity = EmergencyUnit.type_to_capacity_mapping[size]
+        if not register:
+            return
         if self.check_emergency_building_coordinates():
+            EmergencyUnit.building_index.add(self)
             EmergencyUnit.response_buildings.append(self)
         else:
             raise ValueError(f"Coordinates are duplicate for EmergencyResponse unit buildings.. - {self.location}")
 
+    @property
+    def available_capacity(self) -> int:
+        """
+        Number of teams currently available in the unit, stored in the capacity vector of its index.
+        >>> unit = EmergencyUnit('small', (0, 0), register=False)
+        >>> unit.available_capacity
+        3
+        >>> index = UnitIndex([unit])
+        >>> unit.dispatch_teams(2)
+        >>> unit.available_capacity, index.capacity.tolist()
+        (1, [1])
+        """
+        if self.index is None:
+            return self.unindexed_capacity
+        return int(self.index.capacity[self.slot])
+
+    @available_capacity.setter
+    def available_capacity(self, available_capacity: int):
+        if self.index is None:
+            self.unindexed_capacity = available_capacity
+        else:
+            self.index.capacity[self.slot] = available_capacity
+            self.index.update(self)
+
     def relieve_response_teams(self, relieved_units):
         """
         Function to relive response teams once a emergency is resolved
@@ -30,7 +177,6 @@ class EmergencyUnit:
         >>> e.available_capacity
         6
         """
-        EmergencyUnit.wait_for_teams_to_be_available = False
         self.available_capacity += relieved_units
 
     def dispatch_teams(self, required_units):
@@ -78,12 +224,7 @@ class EmergencyUnit:
         ...
         ValueError: Coordinates are duplicate for EmergencyResponse unit buildings.. - (2, 2)
         """
-        flag = True
-        for unit in EmergencyUnit.response_buildings:
-            if unit.location == self.location:
-                flag = False
-                break
-        return flag
+        return self.location not in EmergencyUnit.building_index
 
     @staticmethod
     def clear_emergency_buildings():
@@ -91,7 +232,7 @@ class EmergencyUnit:
         Function to reset all variables to default (empty) value before next run of the simulation
         :return: None
         """
-        EmergencyUnit.wait_for_teams_to_be_available = False
         EmergencyUnit.response_buildings = []
+        EmergencyUnit.building_index = UnitIndex()
 
 
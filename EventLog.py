@@ -0,0 +1,135 @@
+"""
+Event log streaming the details of every emergency of a simulation to disk, in a columnar format.
+"""
+import json
+import os
+import numpy as np
+
+
+class EventLog:
+    """
+    Sink of the emergencies of a simulation, written in chunks to a directory with one raw binary file per column
+    (<column>.bin) and a schema.json file describing the columns, so that memory use stays flat however long the
+    simulation, and each column can be loaded (or memory-mapped) directly as a numpy array, e.g. into a pandas
+    DataFrame with pd.DataFrame(EventLog.load(directory)).
+    """
+    # Columns of the log: run, minute of occurrence, location, intensity, number of emergency units and of teams
+    # dispatched, travel time of the teams, waiting time for teams and response time (travel time + waiting time)
+    event_dtype = np.dtype([('run', np.int32), ('minute', np.int32), ('row', np.int16), ('col', np.int16),
+                            ('intensity', np.int8), ('units_dispatched', np.int16), ('teams', np.int16),
+                            ('travel_time', np.float32), ('waiting_time', np.float32),
+                            ('response_time', np.float32)])
+
+    def __init__(self, directory: str, chunk_size: int = 65536):
+        """
+        Creates the directory of the log, replacing the files of any previous log in it.
+        :param directory: Directory of the log
+        :param chunk_size: Number of emergencies kept in memory before they are written to disk
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.number_of_events = 0
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'schema.json'), 'w') as f:
+            json.dump({name: EventLog.event_dtype[name].str for name in EventLog.event_dtype.names}, f)
+        self.files = {name: open(os.path.join(directory, f'{name}.bin'), 'wb') for name in EventLog.event_dtype.names}
+
+    @staticmethod
+    def records(emergencies) -> np.ndarray:
+        """
+        Converts the emergencies of a simulation run into records of the log, with the run left to be set by write().
+        :param emergencies: EmergencyTable of the run, or list of the Emergency objects of the run, responded to
+        :return: Numpy structured array of event_dtype records
+        >>> from CityConfiguration import City
+        >>> from Emergency import Emergency
+        >>> from EmergencyUnit import EmergencyUnit
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> units = [EmergencyUnit('small', (1, 1)), EmergencyUnit('small', (1, 4))]
+        >>> emergency = Emergency(City(2, 1, [2500, 2500], [0, 1, 0, 0, 0]), 0, 7, (1, 1), 2)
+        >>> emergency.resolve_emergency()
+        >>> record = EventLog.records([emergency])[0]
+        >>> record['minute'], record['row'], record['col'], record['units_dispatched'], record['teams']
+        (7, 1, 1, 2, 4)
+        >>> bool(record['response_time'] == record['travel_time'] + record['waiting_time'])
+        True
+        """
+        if isinstance(emergencies, list):
+            from Emergency import EmergencyTable
+            emergencies = EmergencyTable.from_emergencies(emergencies)
+        records = np.zeros(len(emergencies), dtype=EventLog.event_dtype)
+        for name in ['minute', 'row', 'col', 'intensity', 'units_dispatched', 'teams', 'waiting_time',
+                     'response_time']:
+            records[name] = emergencies[name]
+        records['travel_time'] = emergencies['response_time'] - emergencies['waiting_time']
+        return records
+
+    def write(self, records: np.ndarray, run: int):
+        """
+        Adds the records of the emergencies of a run to the log, writing them to disk once chunk_size emergencies are
+        buffered.
+        :param records: Numpy structured array of event_dtype records, as returned by records()
+        :param run: Index of the run
+        :return: None
+        """
+        records['run'] = run
+        self.buffer.append(records)
+        self.buffered += len(records)
+        self.number_of_events += len(records)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered records to the column files.
+        :return: None
+        """
+        if self.buffer:
+            chunk = np.concatenate(self.buffer)
+            for name, f in self.files.items():
+                chunk[name].tofile(f)
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        """
+        Writes the buffered records and closes the column files.
+        :return: None
+        """
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def load(directory: str, mmap: bool = False) -> dict:
+        """
+        Loads the columns of a log written by an EventLog.
+        :param directory: Directory of the log
+        :param mmap: Whether the columns are memory-mapped instead of read into memory
+        :return: Dictionary of numpy arrays, one for each column
+        >>> import tempfile
+        >>> directory = tempfile.mkdtemp()
+        >>> with EventLog(directory, chunk_size=3) as log:
+        ...     for run in range(3):
+        ...         log.write(np.zeros(2, dtype=EventLog.event_dtype), run)
+        >>> columns = EventLog.load(directory, mmap=True)
+        >>> columns['run'].tolist(), columns['response_time'].dtype
+        ([0, 0, 1, 1, 2, 2], dtype('float32'))
+        """
+        with open(os.path.join(directory, 'schema.json')) as f:
+            schema = json.load(f)
+        columns = {}
+        for name, dtype in schema.items():
+            path = os.path.join(directory, f'{name}.bin')
+            if mmap and os.path.getsize(path) > 0:
+                columns[name] = np.memmap(path, dtype=dtype, mode='r')
+            else:
+                columns[name] = np.fromfile(path, dtype=dtype)
+        return columns
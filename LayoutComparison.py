@@ -0,0 +1,123 @@
+"""
+Comparison of configurations of a city (e.g. different locations of the emergency unit buildings), where every
+configuration is simulated on the same emergencies and traffic, and the paired differences of their statistics are
+reported with confidence intervals.
+"""
+import argparse
+import numpy as np
+from EmergencyUnit import EmergencyUnit
+import main
+
+
+def paired_differences(baseline_values, values, antithetic: bool = False, confidence: float = 0.95) -> tuple:
+    """
+    Calculates the mean of the differences between the statistics of the runs of a configuration and the statistics of
+    the same runs of the baseline configuration, and its Student t confidence interval. As both configurations are
+    simulated on the same emergencies and traffic, the noise common to both cancels out of the differences. The two
+    runs of an antithetic pair are averaged into one observation, as they are not independent.
+    :param baseline_values: Statistic of each run of the baseline configuration
+    :param values: Statistic of each run of the configuration compared
+    :param antithetic: Whether the runs are antithetic pairs
+    :param confidence: Confidence level of the interval
+    :return: Mean difference, lower and upper bounds of its confidence interval
+    >>> [round(value, 3) for value in paired_differences([5.0, 6.0, 7.0], [4.0, 5.5, 5.0])]
+    [-1.167, -3.064, 0.731]
+    >>> paired_differences([5.0, 6.0, 7.0, 5.0], [4.0, 5.0, 6.0, 4.0], antithetic=True)
+    (-1.0, -1.0, -1.0)
+    """
+    differences = np.asarray(values, dtype=float) - np.asarray(baseline_values, dtype=float)
+    if antithetic:
+        if len(differences) % 2:
+            raise ValueError("Antithetic comparisons need an even number of runs")
+        differences = differences.reshape(-1, 2).mean(axis=1)
+    if len(differences) < 2:
+        raise ValueError("At least 2 independent observations are needed for a confidence interval")
+    mean = float(np.mean(differences))
+    half_width = main.confidence_half_width(differences, confidence)
+    return mean, mean - half_width, mean + half_width
+
+
+def compare_configurations(configuration_files: list, config_directory: str = "./config", number_of_runs: int = 30,
+                           seed: int = None, antithetic: bool = False, confidence: float = 0.95,
+                           workers: int = 1) -> list:
+    """
+    Simulates each configuration file with the same seed, so that run i of every configuration sees the same
+    emergencies and traffic (common random numbers, see main.simulate_days()), and compares every configuration to the
+    first one (the baseline) through the paired differences of their average response time and percentage of
+    successfully responded emergencies. Optionally the runs are antithetic pairs, further reducing the variance of the
+    differences. The configurations should share the dimensions and populations of the city, only then do they see the
+    same emergencies and traffic.
+    :param configuration_files: Names of the configuration files, the first one being the baseline
+    :param config_directory: Directory of the configuration files
+    :param number_of_runs: Number of simulation runs of each configuration
+    :param seed: Seed of the simulations, drawn at random if not given and shared by all the configurations
+    :param antithetic: Whether the runs are antithetic pairs
+    :param confidence: Confidence level of the intervals
+    :param workers: Number of worker processes across which the runs of a configuration are spread
+    :return: List of dictionaries, one for each configuration compared to the baseline, with the mean statistics of
+    the configuration, and the mean paired differences to the baseline with their confidence intervals
+    >>> import os, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> layout = 'Dimensions\\nHeight 1\\nWidth 2\\nPopulation distribution\\n2500\\n2500\\nIntensity\\n1 0 0 0 0\\n' \\
+    ...          'Small building\\n3\\n{}\\nEmergency rate\\n1 200000\\n'
+    >>> for name, locations in [('left.txt', '1,1\\n0,0\\n2,2'), ('spread.txt', '1,1\\n1,4\\n0,2'),
+    ...                         ('same.txt', '1,1\\n0,0\\n2,2')]:
+    ...     with open(os.path.join(directory, name), 'w') as f:
+    ...         _ = f.write(layout.format(locations))
+    >>> rows = compare_configurations(['left.txt', 'spread.txt', 'same.txt'], directory, number_of_runs=10, seed=1)
+    >>> rows[1]['response_time_difference'], rows[1]['response_time_interval']
+    (0.0, (0.0, 0.0))
+    >>> lower, upper = rows[0]['response_time_interval']
+    >>> upper < 0
+    True
+    >>> rows = compare_configurations(['left.txt', 'spread.txt'], directory, number_of_runs=10, seed=1,
+    ...                               antithetic=True)
+    >>> rows[0]['response_time_interval'][1] < 0
+    True
+    """
+    seed = np.random.SeedSequence().entropy if seed is None else seed
+    run_statistics = []
+    for configuration_file in configuration_files:
+        test_city, base_rate, base_population = main.configure_city_file(configuration_file, config_directory)
+        if test_city is None:
+            raise ValueError(f"Kindly check the configuration file {configuration_file}")
+        runs = list(main.simulate_days(test_city, base_rate, base_population, seed, workers, number_of_runs,
+                                       antithetic))
+        EmergencyUnit.clear_emergency_buildings()
+        run_statistics.append((np.asarray([run[0] for run in runs]), np.asarray([run[1] for run in runs])))
+    baseline_resp_times, baseline_perc_successful = run_statistics[0]
+    rows = []
+    for configuration_file, (resp_times, perc_successful) in zip(configuration_files[1:], run_statistics[1:]):
+        resp_time_difference = paired_differences(baseline_resp_times, resp_times, antithetic, confidence)
+        perc_difference = paired_differences(baseline_perc_successful, perc_successful, antithetic, confidence)
+        rows.append({'configuration': configuration_file,
+                     'baseline': configuration_files[0],
+                     'mean_response_time': float(np.mean(resp_times)),
+                     'success_percentage': float(np.mean(perc_successful)),
+                     'response_time_difference': resp_time_difference[0],
+                     'response_time_interval': resp_time_difference[1:],
+                     'success_difference': perc_difference[0],
+                     'success_interval': perc_difference[1:]})
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare configuration files of a city to a baseline configuration, '
+                                                 'using common random numbers.')
+    parser.add_argument('configurations', nargs='+', help='Names of the configuration files, the first one being '
+                                                          'the baseline')
+    parser.add_argument('--config-directory', default='./config', help='Directory of the configuration files')
+    parser.add_argument('--runs', type=int, default=30, help='Number of simulation runs of each configuration')
+    parser.add_argument('--seed', type=int, default=None, help='Seed shared by the simulations')
+    parser.add_argument('--antithetic', action='store_true', help='Simulate antithetic pairs of runs')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    arguments = parser.parse_args()
+    comparison = compare_configurations(arguments.configurations, arguments.config_directory, arguments.runs,
+                                        arguments.seed, arguments.antithetic, arguments.confidence, arguments.workers)
+    for row in comparison:
+        print(f"{row['configuration']} vs {row['baseline']}: "
+              f"response time difference {row['response_time_difference']:.3f} "
+              f"[{row['response_time_interval'][0]:.3f}, {row['response_time_interval'][1]:.3f}] minutes, "
+              f"success difference {row['success_difference']:.2f} "
+              f"[{row['success_interval'][0]:.2f}, {row['success_interval'][1]:.2f}] %")
@@ -0,0 +1,301 @@
+"""
+Engine advancing a batch of independent simulation runs (replications) of the same city in lockstep, so that numpy does
+the work of every replication at once instead of repeating the event loop of SimulationEngine for each run.
+"""
+import heapq
+import itertools
+import numpy as np
+from Emergency import Emergency
+from EmergencyUnit import EmergencyUnit
+from CityConfiguration import City
+from SimulationEngine import SimulationEngine
+
+
+class LockstepEngine:
+    """
+    Lockstep engine of K replications (runs) of one day of the simulation, each with its own emergencies and traffic.
+    The state of the replications is held in arrays with a leading replication axis: the teams available in every unit
+    (K x units), the travel time tables of the current traffic (K x coordinates x units) and the queue of emergencies
+    of each replication. The replications are advanced together through the minutes at which emergencies
+    occur, and at every minute the emergency at the head of the queue of each replication is allocated its teams in one
+    vectorized step, in waves until every replication has responded to its emergencies or is waiting for teams.
+    The allocation follows SimulationEngine exactly (closest units first, ties resolved by the teams available and by
+    the order of the units, waiting emergencies keeping the teams allocated so far), so every replication gives the
+    same statistics as simulate_day() with the same random number generators. As in SimulationEngine, the teams
+    allocated to an emergency are relieved as soon as it has been allocated all its teams, unless teams are held.
+    """
+    # Largest number of teams required by an emergency, and so of units dispatched to it in one allocation
+    max_requirement = max(mapping['teams'] for mapping in Emergency.intensity_mapping.values())
+
+    def __init__(self, city: City, units: list, arrivals: list, traffic_rngs: list, hold_teams: bool = False):
+        """
+        :param city: City configured where the emergencies of the replications take place
+        :param units: List of the emergency units of the city, copied by every replication with all their teams
+        available
+        :param arrivals: List of the emergencies of each replication, Numpy structured arrays of Emergency.arrival_dtype
+        records drawn by Emergency.generate_arrivals()
+        :param traffic_rngs: List of the numpy random number generators of the traffic penalties of each replication
+        :param hold_teams: Whether the teams allocated to an emergency are held for the time they take to resolve it,
+        see SimulationEngine
+        """
+        self.city = city
+        self.units = units
+        self.traffic_rngs = traffic_rngs
+        self.hold_teams = hold_teams
+        replications = len(arrivals)
+        self.unit_nodes = np.asarray([city.node_number(unit.location) for unit in units], dtype=np.int64)
+        self.capacity = np.tile(np.asarray([EmergencyUnit.type_to_capacity_mapping[unit.size] for unit in units],
+                                           dtype=np.int64), (replications, 1))
+        # Emergencies of all the replications, replication after replication, each in order of occurrence
+        self.offsets = np.concatenate([[0], np.cumsum([len(arrival) for arrival in arrivals])]).astype(np.int64)
+        emergencies = np.concatenate(arrivals) if replications else np.empty(0, dtype=Emergency.arrival_dtype)
+        self.minute = emergencies['minute'].astype(np.int64)
+        self.location = np.stack([emergencies['row'], emergencies['col']], axis=1).tolist()
+        self.node = np.asarray([city.node_number(location) for location in self.location], dtype=np.int64)
+        intensity = emergencies['intensity'].astype(np.int64)
+        self.pending = np.asarray([0] + [Emergency.intensity_mapping[i]['teams'] for i in range(1, 6)])[intensity]
+        self.resolution_time = np.asarray([0] + [Emergency.intensity_mapping[i]['time']
+                                                 for i in range(1, 6)])[intensity]
+        self.response_time = np.full(len(emergencies), np.nan)
+        # Queue of each replication: emergencies from head up to arrived (excluded) have occurred and are waiting
+        self.head = self.offsets[:-1].copy()
+        self.arrived = self.offsets[:-1].copy()
+        # Teams and sum of the travel times of the units allocated so far to the emergency at the head of each queue
+        self.head_teams = np.zeros_like(self.capacity)
+        self.head_time_sum = np.zeros(replications)
+        # Teams of each replication to be relieved, as a heap of the time, order, units and teams of each emergency.
+        # Teams are relieved lazily, when their replication next allocates teams, except in the replications waiting
+        # for teams, where relieving teams triggers an allocation (see run()).
+        self.releases = [[] for _ in range(replications)]
+        self.sequence = itertools.count()
+        self.waiting = set()
+        # Units responding to the first 5 emergencies of each replication, in order of allocation
+        self.first_units = {}
+        self.epoch = -1
+        self.travel_time_tables = None
+
+    def update_traffic(self, time):
+        """
+        Draw the traffic of every traffic update up to a minute, for every replication, and rebuild the travel time
+        tables of the replications for the latest traffic. Replications with the same commute times share the
+        computation of their table, e.g. at the start of the day when there is no traffic penalty.
+        :param time: Minute of the run
+        :return: None
+        """
+        update_minutes = SimulationEngine.traffic_update_minutes
+        epoch = int(np.searchsorted(update_minutes, time, side='right')) - 1
+        if epoch == self.epoch:
+            return
+        for minute in update_minutes[self.epoch + 1:epoch + 1]:
+            weights = [self.city.draw_edge_weights(SimulationEngine.time_of_day(minute), rng)
+                       for rng in self.traffic_rngs]
+        self.epoch = epoch
+        self.travel_time_tables = np.empty((len(weights), self.city.number_of_nodes, len(self.unit_nodes)))
+        for replication, edge_weights in enumerate(weights):
+            for previous in range(replication):
+                if np.array_equal(edge_weights, weights[previous]):
+                    self.travel_time_tables[replication] = self.travel_time_tables[previous]
+                    break
+            else:
+                self.travel_time_tables[replication] = self.city.shortest_travel_times(self.unit_nodes, edge_weights).T
+
+    def relieve_teams(self, replications, time):
+        """
+        Relieve the teams of replications whose time to resolve their emergency has elapsed by a minute.
+        :param replications: Replications whose teams are relieved
+        :param time: Minute of the run
+        :return: None
+        """
+        for replication in replications:
+            releases = self.releases[replication]
+            while releases and releases[0][0] <= time:
+                _, _, units, teams = heapq.heappop(releases)
+                self.capacity[replication, units] += teams
+
+    def dispatch(self, active: np.ndarray, time):
+        """
+        Allocate the available teams to the waiting emergencies of replications, in the order in which the emergencies
+        occurred in each replication. Each wave allocates teams to the emergency at the head of the queue of every
+        replication at once, and the waves go on until every queue is empty or its head is waiting for teams.
+        :param active: Numpy array of the replications allocating teams
+        :param time: Minute of the run at which teams are allocated
+        :return: None
+        """
+        active = active[self.head[active] < self.arrived[active]]
+        if len(active):
+            self.update_traffic(time)
+        columns = min(LockstepEngine.max_requirement, self.capacity.shape[1])
+        while len(active):
+            if len(active) == 1:
+                self.dispatch_replication(active[0], time)
+                break
+            emergency = self.head[active]
+            times = self.travel_time_tables[active, self.node[emergency]]
+            # Minimal default time of 1 minute for a unit at the location itself
+            times[times == 0] = 1
+            capacity = self.capacity[active]
+            # Units ordered as in City.lookup_available_units(), the units without teams available coming last, and
+            # ties resolved by the order of the units as the sort is stable
+            order = np.lexsort((-capacity, np.where(capacity > 0, times, np.inf)))[:, :columns]
+            rows = np.arange(len(active))[:, np.newaxis]
+            available = capacity[rows, order]
+            times = times[rows, order]
+            allocated = np.clip(self.pending[emergency][:, np.newaxis] - (np.cumsum(available, axis=1) - available),
+                                0, available)
+            # Sum of the travel times of the units in order of allocation, as accumulated by Emergency objects
+            time_sum = self.head_time_sum[active]
+            for column in range(columns):
+                time_sum = time_sum + np.where(allocated[:, column] > 0, times[:, column], 0.0)
+            self.capacity[active[:, np.newaxis], order] -= allocated
+            self.head_teams[active[:, np.newaxis], order] += allocated
+            self.pending[emergency] -= allocated.sum(axis=1)
+            for position in np.flatnonzero(emergency < self.offsets[active] + 5):
+                first_units = self.first_units.setdefault(int(emergency[position]), [])
+                for unit in order[position][allocated[position] > 0].tolist():
+                    if unit not in first_units:
+                        first_units.append(unit)
+            responded = self.pending[emergency] == 0
+            self.head_time_sum[active] = np.where(responded, 0.0, time_sum)
+            self.waiting.update(active[~responded].tolist())
+            replications, emergency, time_sum = active[responded], emergency[responded], time_sum[responded]
+            self.waiting.difference_update(replications.tolist())
+            head_teams = self.head_teams[replications]
+            average_time = time_sum / np.count_nonzero(head_teams, axis=1)
+            self.response_time[emergency] = average_time + (time - self.minute[emergency])
+            if self.hold_teams:
+                # Teams relieved once they have commuted to the emergency, resolved it and commuted back
+                release_time = time + (average_time + self.resolution_time[emergency] + average_time)
+                for replication, release, teams in zip(replications.tolist(), release_time.tolist(), head_teams):
+                    units = np.flatnonzero(teams)
+                    heapq.heappush(self.releases[replication], (release, next(self.sequence), units, teams[units]))
+            else:
+                self.capacity[replications] += head_teams
+            self.head_teams[replications] = 0
+            self.head[replications] += 1
+            active = replications[self.head[replications] < self.arrived[replications]]
+
+    def dispatch_replication(self, replication: int, time):
+        """
+        Allocate the available teams to the waiting emergencies of a single replication, as dispatch() does for
+        several replications, looping over the few units with teams available rather than over arrays of every unit.
+        :param replication: Replication allocating teams
+        :param time: Minute of the run at which teams are allocated
+        :return: None
+        """
+        capacity = self.capacity[replication]
+        head_teams = self.head_teams[replication]
+        table = self.travel_time_tables[replication]
+        while self.head[replication] < self.arrived[replication]:
+            emergency = int(self.head[replication])
+            available = np.flatnonzero(capacity)
+            times = table[self.node[emergency], available]
+            # Minimal default time of 1 minute for a unit at the location itself
+            times[times == 0] = 1
+            teams = capacity[available]
+            order = np.lexsort((-teams, times)).tolist()
+            available, times, teams = available.tolist(), times.tolist(), teams.tolist()
+            pending = int(self.pending[emergency])
+            time_sum = float(self.head_time_sum[replication])
+            first_units = self.first_units.setdefault(emergency, []) \
+                if emergency < self.offsets[replication] + 5 else None
+            for index in order:
+                if pending == 0:
+                    break
+                unit, dispatched = available[index], min(pending, teams[index])
+                time_sum += times[index]
+                capacity[unit] -= dispatched
+                head_teams[unit] += dispatched
+                pending -= dispatched
+                if first_units is not None and unit not in first_units:
+                    first_units.append(unit)
+            self.pending[emergency] = pending
+            if pending:
+                self.head_time_sum[replication] = time_sum
+                self.waiting.add(replication)
+                return
+            self.head_time_sum[replication] = 0.0
+            self.waiting.discard(replication)
+            units = np.flatnonzero(head_teams)
+            average_time = time_sum / len(units)
+            self.response_time[emergency] = average_time + (time - self.minute[emergency])
+            if self.hold_teams:
+                release_time = time + (average_time + self.resolution_time[emergency] + average_time)
+                heapq.heappush(self.releases[replication], (release_time, next(self.sequence), units,
+                                                            head_teams[units]))
+            else:
+                capacity[units] += head_teams[units]
+            head_teams[units] = 0
+            self.head[replication] += 1
+
+    def run(self) -> list:
+        """
+        Advance every replication through its day, and through the minutes after midnight needed to respond to the
+        emergencies still waiting for teams.
+        :return: List of the statistics of each replication, as returned by simulate_day(): average response time,
+        percentage of successfully responded emergencies, number of emergencies and list of tuples of the location of
+        each of the first 5 emergencies and the locations of the emergency units that responded to it
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> city = City(2, 1, [2500, 2500], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> units = [EmergencyUnit('small', location, register=False) for location in [(1, 1), (1, 4), (0, 0)]]
+        >>> arrivals = [np.zeros(2, dtype=Emergency.arrival_dtype) for _ in range(2)]
+        >>> arrivals[0]['intensity'], arrivals[1]['intensity'] = 1, 5
+        >>> engine = LockstepEngine(city, units, arrivals, [np.random.default_rng(0), np.random.default_rng(1)],
+        ...                         hold_teams=True)
+        >>> first, second = engine.run()
+        >>> first[2], second[3][0], second[3][1]
+        (2, ((0, 0), [(0, 0), (1, 1), (1, 4)]), ((0, 0), [(1, 4), (0, 0), (1, 1)]))
+        >>> engine.capacity.tolist(), bool(second[0] > first[0])
+        ([[3, 3, 3], [3, 3, 3]], True)
+        >>> engine = LockstepEngine(city, units, arrivals, [np.random.default_rng(0), np.random.default_rng(1)])
+        >>> second = engine.run()[1]
+        >>> second[3][1], engine.capacity.tolist()
+        (((0, 0), [(0, 0), (1, 1), (1, 4)]), [[3, 3, 3], [3, 3, 3]])
+        >>> arrivals[1]['intensity'] = 4
+        >>> LockstepEngine(city, units[:1], arrivals[1:], [np.random.default_rng(0)]).run()
+        Traceback (most recent call last):
+        ...
+        ValueError: Insufficient emergency teams configured in the city to respond to 2 emergencies
+        """
+        replications = len(self.offsets) - 1
+        counts = np.zeros((SimulationEngine.minutes_in_a_day, replications), dtype=np.int64)
+        np.add.at(counts, (self.minute, np.repeat(np.arange(replications), np.diff(self.offsets))), 1)
+        # Emergencies occurred in each replication by the end of each minute
+        arrived = self.offsets[:-1] + np.cumsum(counts, axis=0)
+        arrival_minutes = np.flatnonzero(counts.any(axis=1)).tolist()[::-1]
+        while True:
+            next_arrival = arrival_minutes[-1] if arrival_minutes else np.inf
+            # Teams relieved in a replication with an emergency waiting for teams trigger an allocation when relieved
+            next_release = min((self.releases[replication][0][0] for replication in self.waiting
+                                if self.releases[replication]), default=np.inf)
+            time = min(next_arrival, next_release)
+            if time == np.inf:
+                break
+            active = {replication for replication in self.waiting
+                      if self.releases[replication] and self.releases[replication][0][0] <= time}
+            if time == next_arrival:
+                minute = arrival_minutes.pop()
+                self.arrived = arrived[minute]
+                active.update(np.flatnonzero(counts[minute]).tolist())
+            active = np.asarray(sorted(active), dtype=np.int64)
+            self.relieve_teams(active.tolist(), time)
+            self.dispatch(active, time)
+        waiting = self.arrived - self.head
+        if waiting.any():
+            raise ValueError(f"Insufficient emergency teams configured in the city to respond to "
+                             f"{waiting[waiting > 0][0]} emergencies")
+        self.relieve_teams(range(replications), np.inf)
+        results = []
+        for replication in range(replications):
+            start, end = self.offsets[replication], self.offsets[replication + 1]
+            response_times = self.response_time[start:end]
+            if end == start:
+                avg_resp_time, perc_successful = float('nan'), float('nan')
+            else:
+                avg_resp_time = np.mean(response_times)
+                perc_successful = (np.count_nonzero(response_times <= Emergency.resolution_time_threshold) /
+                                   (end - start)) * 100
+            first_emergencies = [(tuple(self.location[emergency]),
+                                  [tuple(self.units[unit].location) for unit in self.first_units.get(emergency, [])])
+                                 for emergency in range(start, min(start + 5, end))]
+            results.append((avg_resp_time, perc_successful, int(end - start), first_emergencies))
+        return results
@@ -0,0 +1,245 @@
+"""
+Optimizer searching the locations of a fixed budget of emergency unit buildings in a city, which minimize the average
+response time to the emergencies of the city.
+"""
+import argparse
+import contextlib
+import io
+import math
+import numpy as np
+from CityConfiguration import City
+from EmergencyUnit import EmergencyUnit
+import main
+
+
+def greedy_placement(city: City, budget: dict, rng: np.random.Generator = None) -> list:
+    """
+    Places the buildings of the budget at the centre of the most populated zones of the city, the largest buildings in
+    the most populated zones. Buildings left once every zone has a building are placed at random free coordinates.
+    :param city: City where the buildings are placed
+    :param budget: Dictionary of the number of buildings of each size ('small', 'medium', 'large')
+    :param rng: Numpy random number generator used to place the buildings left
+    :return: List of tuples of the size and the location of each building
+    >>> city = City(2, 1, [1000, 3000], [0.4, 0.2, 0.2, 0.1, 0.1])
+    >>> greedy_placement(city, {'small': 1, 'large': 1})
+    [('large', (1, 4)), ('small', (1, 1))]
+    >>> len(set(location for _, location in greedy_placement(city, {'small': 6})))
+    6
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    sizes = sorted((size for size, count in budget.items() for _ in range(count)),
+                   key=lambda size: -EmergencyUnit.type_to_capacity_mapping[size])
+    zones = sorted(range(len(city.zone_populations)), key=lambda zone: -city.zone_populations[zone])
+    placement = []
+    for size, zone in zip(sizes, zones):
+        placement.append((size, (zone // city.width * City.zone_dimension + City.zone_dimension // 2,
+                                 zone % city.width * City.zone_dimension + City.zone_dimension // 2)))
+    occupied = set(location for _, location in placement)
+    for size in sizes[len(placement):]:
+        location = random_free_location(city, occupied, rng)
+        occupied.add(location)
+        placement.append((size, location))
+    return placement
+
+
+def random_free_location(city: City, occupied: set, rng: np.random.Generator) -> tuple:
+    """
+    Draws a coordinate of the city uniformly among the coordinates without a building.
+    :param city: City where the building is placed
+    :param occupied: Set of the locations of the buildings already placed
+    :param rng: Numpy random number generator
+    :return: Location of the coordinate
+    >>> city = City(1, 1, [1000], [0.4, 0.2, 0.2, 0.1, 0.1])
+    >>> occupied = set((x, y) for x in range(3) for y in range(3)) - {(2, 1)}
+    >>> random_free_location(city, occupied, np.random.default_rng(0))
+    (2, 1)
+    """
+    rows, columns = city.height * City.zone_dimension, city.width * City.zone_dimension
+    if len(occupied) >= rows * columns:
+        raise ValueError("No free coordinates left in the city for the buildings")
+    while True:
+        location = (int(rng.integers(rows)), int(rng.integers(columns)))
+        if location not in occupied:
+            return location
+
+
+def neighbour_placement(city: City, placement: list, rng: np.random.Generator, step: int = 2) -> list:
+    """
+    Draws a placement neighbouring a given placement, either by moving one building by at most step coordinates along
+    each axis to a free coordinate of the city, or by swapping the locations of two buildings of different sizes.
+    :param city: City where the buildings are placed
+    :param placement: List of tuples of the size and the location of each building
+    :param rng: Numpy random number generator
+    :param step: Largest move of a building along each axis
+    :return: New list of tuples of the size and the location of each building
+    >>> city = City(2, 2, [1000, 3000, 2000, 500], [0.4, 0.2, 0.2, 0.1, 0.1])
+    >>> placement = [('small', (1, 1)), ('large', (4, 4))]
+    >>> rng = np.random.default_rng(1)
+    >>> neighbours = [neighbour_placement(city, placement, rng) for _ in range(50)]
+    >>> all(city.check_coordinates(*location) for neighbour in neighbours for _, location in neighbour)
+    True
+    >>> all(len(set(location for _, location in neighbour)) == 2 for neighbour in neighbours)
+    True
+    >>> all(sorted(size for size, _ in neighbour) == ['large', 'small'] for neighbour in neighbours)
+    True
+    """
+    placement = list(placement)
+    occupied = set(location for _, location in placement)
+    swappable = [(i, j) for i in range(len(placement)) for j in range(i + 1, len(placement))
+                 if placement[i][0] != placement[j][0]]
+    if swappable and rng.random() < 0.2:
+        i, j = swappable[rng.integers(len(swappable))]
+        (size_i, location_i), (size_j, location_j) = placement[i], placement[j]
+        placement[i], placement[j] = (size_i, location_j), (size_j, location_i)
+        return placement
+    # Moving a building, retrying a few times if the building has no free coordinate within reach
+    for _ in range(10):
+        i = int(rng.integers(len(placement)))
+        size, (x, y) = placement[i]
+        candidates = [(x + dx, y + dy) for dx in range(-step, step + 1) for dy in range(-step, step + 1)
+                      if city.check_coordinates(x + dx, y + dy) and (x + dx, y + dy) not in occupied]
+        if candidates:
+            placement[i] = (size, candidates[rng.integers(len(candidates))])
+            return placement
+    i = int(rng.integers(len(placement)))
+    placement[i] = (placement[i][0], random_free_location(city, occupied, rng))
+    return placement
+
+
+def evaluate_placement(city: City, placement: list, base_rate: float, base_population: int, number_of_runs: int,
+                       seed: int = None) -> tuple:
+    """
+    Simulates the city with the buildings of a placement.
+    :param city: City where the buildings are placed
+    :param placement: List of tuples of the size and the location of each building
+    :param base_rate: Emergency rate per unit minute, for the base population
+    :param base_population: Base population of the emergency rate
+    :param number_of_runs: Number of simulation runs
+    :param seed: Seed of the simulation, placements evaluated with the same seed see the same emergencies
+    :return: Average response time and percentage of successfully responded emergencies, the average response time is
+    infinite if the buildings don't have enough teams to respond to the emergencies
+    >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+    >>> two = evaluate_placement(city, [('small', (1, 1)), ('small', (1, 4))], 1.0, None, 5, seed=3)
+    >>> three = evaluate_placement(city, [('small', (1, 1)), ('small', (1, 4)), ('small', (0, 2))], 1.0, None, 5,
+    ...                            seed=3)
+    >>> three[0] < two[0] and three[1] > two[1]
+    True
+    >>> city = City(2, 1, [2500, 2500], [0, 1, 0, 0, 0])
+    >>> evaluate_placement(city, [('small', (1, 1))], 1.0, None, 1, seed=3)
+    (inf, 0.0)
+    """
+    EmergencyUnit.clear_emergency_buildings()
+    for size, location in placement:
+        EmergencyUnit(size, location)
+    # The simulation reports the placements without enough teams, which are expected while searching
+    with contextlib.redirect_stdout(io.StringIO()):
+        resp_times, perc_successful, number_of_emergencies, _ = main.simulate(city, base_rate, base_population, seed,
+                                                                              show_progress=False,
+                                                                              number_of_runs=number_of_runs)
+    EmergencyUnit.clear_emergency_buildings()
+    if number_of_emergencies == []:
+        return math.inf, 0.0
+    return float(resp_times[-1]), float(perc_successful[-1])
+
+
+def optimize_placement(city: City, budget: dict, base_rate: float = None, base_population: int = None,
+                       iterations: int = 1000, screening_runs: int = 5, promoted: int = 5, full_runs: int = 100,
+                       initial_temperature: float = 1.0, final_temperature: float = 0.01, seed: int = None,
+                       initial_placement: list = None) -> tuple:
+    """
+    Searches the locations of a fixed budget of buildings minimizing the average response time to the emergencies of the
+    city, starting from a greedy placement (see greedy_placement()) and improving it by simulated annealing: a
+    neighbouring placement (see neighbour_placement()) replaces the current one if its average response time is lower,
+    or with a probability decreasing with how much higher it is and with the temperature, which is lowered
+    geometrically from initial_temperature to final_temperature (in minutes) over the iterations.
+    The placements are screened with a cheap simulation of screening_runs runs, all with the same seed so that the
+    placements are compared on the same emergencies and traffic. The best screened placements are then promoted to a
+    full simulation of full_runs runs, with a seed independent of the screening seed, and the placement with the lowest
+    average response time in the full simulation is returned.
+    :param city: City where the buildings are placed
+    :param budget: Dictionary of the number of buildings of each size ('small', 'medium', 'large')
+    :param base_rate: Emergency rate per unit minute, for the base population
+    :param base_population: Base population of the emergency rate
+    :param iterations: Number of neighbouring placements screened
+    :param screening_runs: Number of simulation runs of the screening of a placement
+    :param promoted: Number of best screened placements promoted to the full simulation
+    :param full_runs: Number of simulation runs of the full simulation of the promoted placements
+    :param initial_temperature: Temperature of the annealing at the first iteration
+    :param final_temperature: Temperature of the annealing at the last iteration
+    :param seed: Seed of the search and of the simulations
+    :param initial_placement: Placement the search starts from instead of the greedy placement
+    :return: Best placement, its average response time and percentage of successfully responded emergencies in the
+    full simulation, and the list of tuples of the promoted placements and their full simulation results
+    >>> city = City(2, 1, [500, 4500], [1, 0, 0, 0, 0])
+    >>> best, resp_time, perc, promoted = optimize_placement(city, {'small': 2}, 1.0, None, iterations=10,
+    ...                                                      screening_runs=2, promoted=2, full_runs=4, seed=0)
+    >>> sorted(size for size, _ in best), len(promoted)
+    (['small', 'small'], 2)
+    >>> resp_time == min(result[0] for _, result in promoted)
+    True
+    >>> best == optimize_placement(city, {'small': 2}, 1.0, None, iterations=10, screening_runs=2, promoted=2,
+    ...                            full_runs=4, seed=0)[0]
+    True
+    """
+    if sum(budget.values()) == 0:
+        raise ValueError("The budget must contain at least one building")
+    search_seed, screening_seed, full_seed = (int(state) for state in np.random.SeedSequence(seed).generate_state(3))
+    rng = np.random.default_rng(search_seed)
+    current = greedy_placement(city, budget, rng) if initial_placement is None else list(initial_placement)
+    # Screening scores of every placement visited, keyed by the set of its buildings as the order doesn't matter
+    screened = {}
+
+    def screen(placement):
+        key = frozenset(placement)
+        if key not in screened:
+            screened[key] = evaluate_placement(city, placement, base_rate, base_population, screening_runs,
+                                               screening_seed)[0]
+        return screened[key]
+
+    current_score = screen(current)
+    cooling = (final_temperature / initial_temperature) ** (1 / max(iterations - 1, 1))
+    temperature = initial_temperature
+    for _ in range(iterations):
+        candidate = neighbour_placement(city, current, rng)
+        candidate_score = screen(candidate)
+        if candidate_score <= current_score or current_score == math.inf or \
+                rng.random() < math.exp(-(candidate_score - current_score) / temperature):
+            current, current_score = candidate, candidate_score
+        temperature *= cooling
+    # Promoting the best screened placements to the full simulation
+    best_screened = sorted(screened.items(), key=lambda item: item[1])[:promoted]
+    promoted_placements = [sorted(key, key=lambda building: building[1]) for key, _ in best_screened]
+    promoted_results = [(placement, evaluate_placement(city, placement, base_rate, base_population, full_runs,
+                                                       full_seed))
+                        for placement in promoted_placements]
+    best_placement, (best_resp_time, best_perc) = min(promoted_results, key=lambda item: item[1][0])
+    return best_placement, best_resp_time, best_perc, promoted_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the locations of the emergency unit buildings of a city '
+                                                 'configuration file minimizing the average response time.')
+    parser.add_argument('configuration', help='Name of the configuration file, the number of buildings of each size '
+                                              'configured in it is the budget of the search')
+    parser.add_argument('--config-directory', default='./config', help='Directory of the configuration file')
+    parser.add_argument('--iterations', type=int, default=1000, help='Number of placements screened')
+    parser.add_argument('--screening-runs', type=int, default=5, help='Simulation runs of a screened placement')
+    parser.add_argument('--promoted', type=int, default=5, help='Placements promoted to the full simulation')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the search and of the simulations')
+    arguments = parser.parse_args()
+    configured_city, configured_rate, configured_population = main.configure_city_file(arguments.configuration,
+                                                                                       arguments.config_directory)
+    if configured_city is not None:
+        configured_budget = {}
+        for unit in EmergencyUnit.response_buildings:
+            configured_budget[unit.size] = configured_budget.get(unit.size, 0) + 1
+        placement_found, resp_time_found, perc_found, _ = optimize_placement(
+            configured_city, configured_budget, configured_rate, configured_population, arguments.iterations,
+            arguments.screening_runs, arguments.promoted, seed=arguments.seed)
+        print(f"Average response time: {resp_time_found}, successfully responded emergencies: {perc_found}%")
+        for building_size in ['small', 'medium', 'large']:
+            building_locations = [location for size, location in placement_found if size == building_size]
+            print(f"###{building_size.capitalize()} buildings###")
+            print(len(building_locations))
+            for location in building_locations:
+                print(f"{location[0]},{location[1]}")
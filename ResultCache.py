@@ -0,0 +1,225 @@
+"""
+On-disk cache of the results of simulations, so that simulating a configuration again with the same seed and number of
+runs (e.g. to regenerate plots) returns the stored results instead of simulating it.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+# Digest of the source of the simulation modules, computed once per process by simulator_version()
+source_digest = None
+
+
+class ResultCache:
+    """
+    Cache of the results of main.simulate(), keyed by a hash of everything the results depend on: the city (width,
+    height, zone populations and intensity distribution), the types and locations of the emergency units, the emergency
+    rate and base population, the seed, the number of runs and the options of the stopping rule, and the version of the
+    simulator. Every entry is a JSON file with the aggregated series, the summary statistics and the emergencies used
+    for visualizations. Entries stored more than the maximum age ago are discarded, and the least recently used entries
+    are evicted once the cache exceeds its size limit. The modification time of an entry is the time it was stored and
+    its access time the time it was last used. Entries are written to a temporary path and moved into place, so
+    processes can share a cache directory.
+    """
+    # Version of the layout of the entries, part of every key so that entries of another layout are never loaded
+    format_version = 1
+    # Modules whose source determines the results of a simulation, any change to them invalidates the entries
+    simulator_modules = ['main', 'CityConfiguration', 'Emergency', 'EmergencyUnit', 'SimulationEngine',
+                         'LockstepEngine']
+
+    def __init__(self, directory: str, max_bytes: int = 2 ** 28, max_age: float = 30 * 24 * 3600):
+        """
+        :param directory: Directory of the cache, created if needed
+        :param max_bytes: Size of the cache above which the least recently used entries are evicted
+        :param max_age: Age in seconds after which an entry is discarded, since it was stored, however often it is used
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def simulator_version() -> str:
+        """
+        Version of the simulator, a hash of the source of the simulation modules, so that any change to the simulator
+        gives new keys.
+        :return: Hexadecimal digest
+        >>> ResultCache.simulator_version() == ResultCache.simulator_version()
+        True
+        """
+        global source_digest
+        if source_digest is None:
+            digest = hashlib.sha256()
+            directory = os.path.dirname(os.path.abspath(__file__))
+            for module in ResultCache.simulator_modules:
+                with open(os.path.join(directory, f'{module}.py'), 'rb') as f:
+                    digest.update(f.read())
+            source_digest = digest.hexdigest()
+        return source_digest
+
+    @staticmethod
+    def key(city, units: list, base_rate_for_emergency: float, base_population: int, seed: int, number_of_runs: int,
+            **options) -> str:
+        """
+        Key of the results of a simulation.
+        :param city: City simulated
+        :param units: Emergency units of the city
+        :param base_rate_for_emergency: Emergency rate per unit minute
+        :param base_population: Base population, None for the default
+        :param seed: Seed of the simulation
+        :param number_of_runs: Number of simulation runs
+        :param options: Other arguments of main.simulate() changing its results, e.g. antithetic
+        :return: Hexadecimal digest
+        >>> from CityConfiguration import City
+        >>> from EmergencyUnit import EmergencyUnit
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> units = [EmergencyUnit('small', (1, 1), register=False)]
+        >>> key = ResultCache.key(city, units, 1.0, None, 7, 100, antithetic=False)
+        >>> key == ResultCache.key(city, units, 1.0, None, 7, 100, antithetic=False)
+        True
+        >>> key == ResultCache.key(city, units, 1.0, None, 8, 100, antithetic=False)
+        False
+        >>> key == ResultCache.key(city, [EmergencyUnit('medium', (1, 1), register=False)], 1.0, None, 7, 100,
+        ...                        antithetic=False)
+        False
+        """
+        description = [ResultCache.format_version, ResultCache.simulator_version(), city.width, city.height,
+                       [float(p) for p in np.asarray(city.intensity_distribution, dtype=np.float64)],
+                       [(unit.size, [int(c) for c in unit.location]) for unit in units],
+                       base_rate_for_emergency, base_population, int(seed), number_of_runs, sorted(options.items())]
+        digest = hashlib.sha256(json.dumps(description).encode())
+        digest.update(np.ascontiguousarray(city.zone_populations, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key: str):
+        """
+        Results stored under a key, in the form returned by main.simulate().
+        :param key: Key of the results, see key()
+        :return: Tuple of the aggregated response times, aggregated percentages of successfully responded emergencies,
+        number of emergencies and dictionary of the emergencies used for visualizations, or None if not cached
+        >>> cache = ResultCache(tempfile.mkdtemp())
+        >>> cache.put('abc', ([2.0, 1.5], [100.0, 75.0], 4, {(1, 1): [(0, 0)]}))
+        >>> cache.get('abc')
+        ([2.0, 1.5], [100.0, 75.0], 4, {(1, 1): [(0, 0)]})
+        >>> cache.get('abd') is None
+        True
+        """
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry['stored'] > self.max_age:
+            remove_entry(path)
+            return None
+        # Marked as used, keeping the time it was stored
+        os.utime(path, (time.time(), entry['stored']))
+        plotting_emergency_dict = {tuple(location): [tuple(unit) for unit in unit_locations]
+                                   for location, unit_locations in entry['emergencies']}
+        return entry['response_times'], entry['success_percentages'], entry['summary']['emergencies'], \
+            plotting_emergency_dict
+
+    def put(self, key: str, results: tuple):
+        """
+        Stores the results of a simulation under a key, and evicts the least recently used or expired entries.
+        :param key: Key of the results, see key()
+        :param results: Aggregated response times, aggregated percentages of successfully responded emergencies, number
+        of emergencies and dictionary of the emergencies used for visualizations, as returned by main.simulate()
+        :return: None
+        """
+        resp_times, perc_successful, number_of_emergencies, plotting_emergency_dict = results[:4]
+        stored = time.time()
+        entry = {'stored': stored,
+                 'summary': {'runs': len(resp_times), 'emergencies': int(number_of_emergencies),
+                             'mean_response_time': float(resp_times[-1]),
+                             'success_percentage': float(perc_successful[-1])},
+                 'response_times': [float(value) for value in resp_times],
+                 'success_percentages': [float(value) for value in perc_successful],
+                 'emergencies': [[[int(c) for c in location], [[int(c) for c in unit] for unit in unit_locations]]
+                                 for location, unit_locations in plotting_emergency_dict.items()]}
+        descriptor, staging = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as f:
+            json.dump(entry, f)
+        os.utime(staging, (stored, stored))
+        os.replace(staging, self.path(key))
+        self.evict(keep=self.path(key))
+
+    def entries(self) -> list:
+        """
+        Entries of the cache, with their time of last use, time they were stored and size in bytes.
+        :return: List of tuples of the time of last use, time stored, size and path of each entry
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+                entries.append((status.st_atime, status.st_mtime, status.st_size, path))
+            except FileNotFoundError:
+                # Evicted by another process
+                continue
+        return entries
+
+    def evict(self, keep: str = None):
+        """
+        Evicts the entries stored more than the maximum age ago, as get() does, then the least recently used entries
+        until the cache is within its size limit.
+        :param keep: Path of an entry never evicted, e.g. the entry just stored
+        :return: None
+        >>> cache = ResultCache(tempfile.mkdtemp(), max_bytes=400)
+        >>> for key in ['a', 'b', 'c']:
+        ...     cache.put(key, ([2.0] * 10, [100.0] * 10, 10, {}))
+        >>> cache.get('a') is None, cache.get('c') is None
+        (True, False)
+        >>> sum(size for _, _, size, _ in cache.entries()) <= 400
+        True
+        >>> cache = ResultCache(tempfile.mkdtemp(), max_age=60)
+        >>> cache.put('old', ([2.0], [100.0], 1, {}))
+        >>> cache.put('new', ([2.0], [100.0], 1, {}))
+        >>> os.utime(cache.path('old'), (time.time(), time.time() - 120))  # Used now, stored two minutes ago
+        >>> cache.evict()
+        >>> sorted(os.path.basename(path) for _, _, _, path in cache.entries())
+        ['new.json']
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, _, size, _ in entries)
+        oldest = time.time() - self.max_age
+        for _, stored, size, path in entries:
+            if path != keep and stored < oldest:
+                remove_entry(path)
+                total -= size
+        for _, stored, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path != keep and stored >= oldest:
+                remove_entry(path)
+                total -= size
+
+    def clear(self):
+        """
+        Removes every entry of the cache.
+        :return: None
+        """
+        for _, _, _, path in self.entries():
+            remove_entry(path)
+
+
+def remove_entry(path: str):
+    """
+    Removes an entry of the cache, if it still exists.
+    :param path: Path of the entry
+    :return: None
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,155 @@
+"""
+Recorded scenario traces: the emergencies and traffic of the runs of a simulation, drawn once and replayed against any
+number of layouts of emergency units.
+"""
+import numpy as np
+from CityConfiguration import City
+from Emergency import Emergency
+from SimulationEngine import SimulationEngine
+import main
+
+
+class ScenarioTrace:
+    """
+    Emergencies and commute times of the edges at each traffic update, of each run of a simulation of a city. A trace
+    is only valid for cities with the dimensions and zone populations it was recorded for, which are stored with it and
+    checked when it is replayed.
+    """
+    # Version of the format of the trace files, traces saved with another version are rejected when loaded
+    format_version = 1
+
+    def __init__(self, width: int, height: int, zone_populations, arrivals: np.ndarray, arrival_offsets: np.ndarray,
+                 edge_weights: np.ndarray):
+        """
+        :param width: Width of the city in terms of number of zones
+        :param height: Height of the city in terms of number of zones
+        :param zone_populations: Population of each zone of the city
+        :param arrivals: Numpy structured array of the Emergency.arrival_dtype records of all the runs, run after run
+        :param arrival_offsets: Numpy array of the index of the first emergency of each run in arrivals, followed by the
+        number of emergencies
+        :param edge_weights: Numpy array of the commute times of the edges, indexed by run, time of day identifier and
+        edge
+        """
+        self.width = width
+        self.height = height
+        self.zone_populations = np.asarray(zone_populations)
+        self.arrivals = arrivals
+        self.arrival_offsets = arrival_offsets
+        self.edge_weights = edge_weights
+
+    @property
+    def number_of_runs(self) -> int:
+        return len(self.arrival_offsets) - 1
+
+    @staticmethod
+    def record(city: City, base_rate_for_emergency: float, base_population: int, number_of_runs: int = 100,
+               seed: int = None, minutes: int = 1440):
+        """
+        Draws the emergencies and the traffic of the runs of a simulation of a city, from the same random number
+        streams as main.simulate_days(), so replaying the trace gives the same results as simulating with the seed.
+        :param city: City configured where the emergencies take place
+        :param base_rate_for_emergency: Emergency rate per unit minute, for the base population
+        :param base_population: Base population of the emergency rate
+        :param number_of_runs: Number of simulation runs recorded
+        :param seed: Seed for the random number generators
+        :param minutes: Number of minutes of each run
+        :return: ScenarioTrace of the runs
+        >>> from EmergencyUnit import EmergencyUnit
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> trace = ScenarioTrace.record(city, 1.0, None, number_of_runs=5, seed=4)
+        >>> trace.number_of_runs, trace.edge_weights.shape
+        (5, (5, 4, 27))
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> units = [EmergencyUnit('small', location) for location in [(1, 1), (1, 4), (0, 0)]]
+        >>> live = main.simulate(city, 1.0, None, seed=4, show_progress=False, number_of_runs=5)
+        >>> units = [EmergencyUnit('small', location) for location in [(1, 1), (1, 4), (0, 0)]]
+        >>> live == main.simulate(city, 1.0, None, show_progress=False, number_of_runs=5, trace=trace)
+        True
+        """
+        base_rate_for_emergency = 13.165119 if base_rate_for_emergency is None else base_rate_for_emergency
+        base_population = 200000 if base_population is None else base_population
+        zone_probabilities = main.poisson_probability(base_rate_for_emergency / base_population
+                                                      * np.asarray(city.zone_populations))
+        run_arrivals = []
+        edge_weights = np.empty((number_of_runs, len(SimulationEngine.traffic_update_minutes), len(city.edge_sources)))
+        for run, run_seed in enumerate(np.random.SeedSequence(seed).spawn(number_of_runs)):
+            arrival_rng, traffic_rng = main.run_generators(run_seed)
+            run_arrivals.append(Emergency.generate_arrivals(city, zone_probabilities, minutes, arrival_rng))
+            # Drawn in the order of the traffic updates of a run of SimulationEngine
+            for minute in SimulationEngine.traffic_update_minutes:
+                time_of_day = SimulationEngine.time_of_day(minute)
+                edge_weights[run, time_of_day] = city.draw_edge_weights(time_of_day, traffic_rng)
+        arrival_offsets = np.cumsum([0] + [len(arrivals) for arrivals in run_arrivals])
+        return ScenarioTrace(city.width, city.height, city.zone_populations,
+                             np.concatenate(run_arrivals) if run_arrivals else
+                             np.empty(0, dtype=Emergency.arrival_dtype), arrival_offsets, edge_weights)
+
+    def scenario(self, run: int) -> tuple:
+        """
+        Emergencies and traffic of a run of the trace, as replayed by main.simulate_day().
+        :param run: Index of the run
+        :return: Tuple of the Emergency.arrival_dtype records of the run, and of the commute times of the edges at each
+        traffic update of the run
+        """
+        return self.arrivals[self.arrival_offsets[run]:self.arrival_offsets[run + 1]], self.edge_weights[run]
+
+    def check_city(self, city: City):
+        """
+        Checks that the trace was recorded for a city with the dimensions and zone populations of a city.
+        :param city: City against which the trace is replayed
+        :return: None
+        >>> trace = ScenarioTrace.record(City(2, 1, [2500, 2500], [1, 0, 0, 0, 0]), 1.0, None, number_of_runs=1)
+        >>> trace.check_city(City(2, 1, [2500, 2500], [0, 1, 0, 0, 0]))
+        >>> trace.check_city(City(2, 1, [2500, 2400], [1, 0, 0, 0, 0]))
+        Traceback (most recent call last):
+        ...
+        ValueError: The scenario trace was recorded for a different city (2x1 zones with populations [2500, 2500])
+        """
+        if city.width != self.width or city.height != self.height or \
+                not np.array_equal(np.asarray(city.zone_populations), self.zone_populations):
+            raise ValueError(f"The scenario trace was recorded for a different city ({self.width}x{self.height} zones "
+                             f"with populations {self.zone_populations.tolist()})")
+
+    def save(self, path: str):
+        """
+        Saves the trace to a binary .npz file, with the dimensions and zone populations of its city.
+        :param path: Path of the trace file
+        :return: None
+        >>> import os, tempfile
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> trace = ScenarioTrace.record(city, 1.0, None, number_of_runs=3, seed=1)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'trace.npz')
+        >>> trace.save(path)
+        >>> loaded = ScenarioTrace.load(path, city)
+        >>> bool((loaded.arrivals == trace.arrivals).all()), bool((loaded.edge_weights == trace.edge_weights).all())
+        (True, True)
+        """
+        np.savez(path, format_version=ScenarioTrace.format_version, width=self.width, height=self.height,
+                 zone_populations=self.zone_populations, arrivals=self.arrivals, arrival_offsets=self.arrival_offsets,
+                 edge_weights=self.edge_weights)
+
+    @staticmethod
+    def load(path: str, city: City = None):
+        """
+        Loads a trace saved by save(), rejecting it if it was saved with another version of the format or, if a city is
+        given, if it was recorded for a city with other dimensions or zone populations.
+        :param path: Path of the trace file
+        :param city: City against which the trace is replayed
+        :return: ScenarioTrace loaded
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'trace.npz')
+        >>> ScenarioTrace.record(City(2, 1, [2500, 2500], [1, 0, 0, 0, 0]), 1.0, None, number_of_runs=1).save(path)
+        >>> ScenarioTrace.load(path, City(1, 2, [2500, 2500], [1, 0, 0, 0, 0]))
+        Traceback (most recent call last):
+        ...
+        ValueError: The scenario trace was recorded for a different city (2x1 zones with populations [2500, 2500])
+        """
+        with np.load(path) as data:
+            if int(data['format_version']) != ScenarioTrace.format_version:
+                raise ValueError(f"Scenario trace {path} has format version {int(data['format_version'])}, expected "
+                                 f"version {ScenarioTrace.format_version}")
+            trace = ScenarioTrace(int(data['width']), int(data['height']), data['zone_populations'], data['arrivals'],
+                                  data['arrival_offsets'], data['edge_weights'])
+        if city is not None:
+            trace.check_city(city)
+        return trace
@@ -0,0 +1,276 @@
+"""
+Headless command-line entry point of the simulation, with run, sweep and benchmark subcommands. Results are written to
+stdout as JSON (one object per line), progress is written to stderr as JSON lines, and the exit code tells whether the
+job succeeded. The simulation modules are only imported by the subcommand which needs them, so that short jobs don't
+pay for imports they don't use.
+
+    python SimulationCLI.py run config/small_ps.txt --runs 50 --seed 1 --progress json
+    python SimulationCLI.py sweep config --workers 4 --memory-limit 4000
+    python SimulationCLI.py benchmark --sizes 2 10 --compare results/benchmark_baseline.json
+    python SimulationCLI.py serve --port 8765 --workers 4
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+# Exit codes of the subcommands (argparse exits with 2 on invalid arguments)
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_INVALID_CONFIGURATION = 3
+EXIT_REGRESSION = 4
+
+
+@contextlib.contextmanager
+def messages_to_stderr():
+    """
+    Redirects everything written to stdout to stderr, at the level of the file descriptor so that the messages of
+    worker processes are redirected as well, keeping stdout for the JSON results.
+    :return: Context manager
+    """
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+
+
+def emit(record: dict, stream=None):
+    """
+    Writes a record as one line of JSON.
+    :param record: Dictionary written
+    :param stream: Stream written to, defaults to stdout
+    :return: None
+    >>> emit({'event': 'progress', 'run': 1, 'runs': 10})
+    {"event": "progress", "run": 1, "runs": 10}
+    """
+    stream = sys.stdout if stream is None else stream
+    stream.write(json.dumps(record) + '\n')
+    stream.flush()
+
+
+def json_progress(run: int, number_of_runs: int):
+    """
+    Progress callback of main.simulate() writing the progress of the runs to stderr as JSON lines.
+    :param run: Number of runs completed
+    :param number_of_runs: Number of runs requested
+    :return: None
+    """
+    emit({'event': 'progress', 'run': run, 'runs': number_of_runs}, sys.stderr)
+
+
+def run_command(arguments) -> int:
+    """
+    Simulates one configuration file and writes its statistics as a JSON object.
+    :param arguments: Parsed arguments of the run subcommand
+    :return: Exit code
+    >>> arguments = build_parser().parse_args(['run', 'config/configuration.txt', '--runs', '3', '--seed', '1',
+    ...                                        '--rate', '0.5'])
+    >>> import io
+    >>> output = io.StringIO()
+    >>> with contextlib.redirect_stdout(output):
+    ...     code = run_command(arguments)
+    >>> record = json.loads(output.getvalue())
+    >>> code, record['runs'], record['seed'], record['emergencies'] > 0
+    (0, 3, 1, True)
+    >>> run_command(build_parser().parse_args(['run', 'config/test_config_1.txt']))
+    3
+    """
+    import numpy as np
+    import main
+    directory, name = os.path.split(arguments.configuration)
+    with messages_to_stderr():
+        try:
+            city, base_rate, base_population = main.configure_city_file(name, directory or '.')
+        except OSError as e:
+            print(e)
+            city = None
+        if city is None:
+            return EXIT_INVALID_CONFIGURATION
+        base_rate = arguments.rate if arguments.rate is not None else base_rate
+        # A seed is always reported, so that every job can be reproduced
+        seed = np.random.SeedSequence().entropy if arguments.seed is None else arguments.seed
+        result_cache = None
+        # Results of a drawn seed are never simulated again, so they are not cached
+        if arguments.result_cache and arguments.seed is not None:
+            from ResultCache import ResultCache
+            result_cache = ResultCache(arguments.result_cache)
+        traffic_profile = None
+        if arguments.traffic_profile:
+            from TrafficProfile import TrafficProfile
+            traffic_profile = TrafficProfile.load(arguments.traffic_profile, city)
+        event_log = None
+        if arguments.event_log:
+            from EventLog import EventLog
+            event_log = EventLog(arguments.event_log)
+        try:
+            results = main.simulate(city, base_rate, base_population, seed, arguments.workers,
+                                    show_progress=arguments.progress == 'bar', number_of_runs=arguments.runs,
+                                    antithetic=arguments.antithetic, relative_precision=arguments.relative_precision,
+                                    event_log=event_log, profile=arguments.profile, lockstep=arguments.lockstep,
+                                    result_cache=result_cache, traffic_profile=traffic_profile,
+                                    hold_teams=arguments.hold_teams,
+                                    progress_callback=json_progress if arguments.progress == 'json' else None)
+        finally:
+            if event_log is not None:
+                event_log.close()
+    resp_times, perc_successful, number_of_emergencies = results[:3]
+    if number_of_emergencies == []:
+        return EXIT_FAILURE
+    record = {'configuration': arguments.configuration, 'seed': seed, 'runs': len(resp_times),
+              'emergencies': number_of_emergencies, 'mean_response_time': float(resp_times[-1]),
+              'success_percentage': float(perc_successful[-1])}
+    if arguments.profile:
+        record['stats'] = results[4].as_dict()
+    emit(record)
+    return EXIT_OK
+
+
+def sweep_command(arguments) -> int:
+    """
+    Simulates every configuration file of a directory or glob pattern (see BatchRunner.run_batch()), and writes the
+    statistics of each configuration as a JSON object.
+    :param arguments: Parsed arguments of the sweep subcommand
+    :return: Exit code, EXIT_FAILURE if any configuration is invalid or failed
+    """
+    import BatchRunner
+    with messages_to_stderr():
+        rows = BatchRunner.run_batch(arguments.configurations, arguments.workers, arguments.memory_limit,
+                                     arguments.seed, arguments.output, arguments.result_cache,
+                                     arguments.series_directory)
+    for row in rows:
+        emit(row)
+    if not rows:
+        return EXIT_INVALID_CONFIGURATION
+    return EXIT_OK if all(row['status'] == 'ok' for row in rows) else EXIT_FAILURE
+
+
+def benchmark_command(arguments) -> int:
+    """
+    Runs the benchmark suite (see Benchmarks.run_benchmarks()) and writes each measurement as a JSON object,
+    optionally saving them as a baseline and comparing them to a baseline.
+    :param arguments: Parsed arguments of the benchmark subcommand
+    :return: Exit code, EXIT_REGRESSION if a measurement regressed compared to the baseline
+    """
+    import Benchmarks
+    with messages_to_stderr():
+        measurements = Benchmarks.run_benchmarks(arguments.sizes, arguments.units, arguments.repeat)
+    for measurement in measurements:
+        emit(measurement)
+    if arguments.save:
+        Benchmarks.save_baseline(measurements, arguments.save)
+    if arguments.compare:
+        regressions = Benchmarks.compare_to_baseline(measurements, arguments.compare, arguments.tolerance)
+        for benchmark, zones, units, metric, baseline, measured in regressions:
+            emit({'event': 'regression', 'benchmark': benchmark, 'zones': zones, 'units': units, 'metric': metric,
+                  'baseline': baseline, 'measured': measured})
+        if regressions:
+            return EXIT_REGRESSION
+    return EXIT_OK
+
+
+def serve_command(arguments) -> int:
+    """
+    Runs the local simulation service (see SimulationService) until interrupted, writing the port it listens on as a
+    JSON object once it has started.
+    :param arguments: Parsed arguments of the serve subcommand
+    :return: Exit code
+    """
+    import asyncio
+    from SimulationService import SimulationService
+    service = SimulationService(arguments.workers, arguments.cache)
+    try:
+        asyncio.run(service.serve(arguments.host, arguments.port, ready=lambda port: emit(
+            {'event': 'listening', 'host': arguments.host, 'port': port})))
+    except KeyboardInterrupt:
+        pass
+    return EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Parser of the arguments of the subcommands.
+    :return: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='Monte-Carlo simulation of the emergency response of a city.')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    run = subcommands.add_parser('run', help='Simulate one configuration file')
+    run.add_argument('configuration', help='Path of the configuration file (.txt, .json or .toml)')
+    run.add_argument('--runs', type=int, default=100, help='Number of simulation runs')
+    run.add_argument('--seed', type=int, default=None, help='Seed of the simulation, drawn at random if not given')
+    run.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    run.add_argument('--rate', type=float, default=None, help='Emergency rate overriding the configuration file')
+    run.add_argument('--antithetic', action='store_true', help='Simulate antithetic pairs of runs')
+    run.add_argument('--relative-precision', type=float, default=None,
+                     help='Stop once the confidence intervals are within this relative precision of the means')
+    run.add_argument('--lockstep', type=int, default=1,
+                     help='Number of runs advanced together, with the same results as one run at a time')
+    run.add_argument('--hold-teams', action='store_true',
+                     help='Keep teams busy while they commute to and resolve emergencies, which then compete for '
+                          'teams')
+    run.add_argument('--traffic-profile', default=None,
+                     help='Traffic profile (.npz) replayed instead of drawing the traffic, see TrafficProfile')
+    run.add_argument('--event-log', default=None, help='Directory of an event log of every emergency')
+    run.add_argument('--result-cache', default=None,
+                     help='Directory of the cache of the results, used when the seed is given')
+    run.add_argument('--profile', action='store_true', help='Report the profiling counters, timers and peaks')
+    run.add_argument('--progress', choices=['none', 'json', 'bar'], default='none',
+                     help='Progress written to stderr: none, JSON lines or a progress bar')
+    run.set_defaults(command_function=run_command)
+
+    sweep = subcommands.add_parser('sweep', help='Simulate every configuration file of a directory or glob pattern')
+    sweep.add_argument('configurations', help='Directory or glob pattern of configuration files')
+    sweep.add_argument('--workers', type=int, default=None, help='Maximum number of worker processes')
+    sweep.add_argument('--memory-limit', type=float, default=None, help='Total memory limit of the workers in MB')
+    sweep.add_argument('--seed', type=int, default=None, help='Seed of the simulation of every configuration')
+    sweep.add_argument('--output', default='results/batch_comparison.csv', help='Path of the comparison table')
+    sweep.add_argument('--result-cache', default=None,
+                       help='Directory of the cache of the results, used when the seed is given')
+    sweep.add_argument('--series-directory', default=None,
+                       help='Directory of the series of the statistics after each run of every configuration')
+    sweep.set_defaults(command_function=sweep_command)
+
+    benchmark = subcommands.add_parser('benchmark', help='Benchmark the hot paths of the simulation')
+    benchmark.add_argument('--sizes', type=int, nargs='+', default=None, help='Zones along each side of the cities')
+    benchmark.add_argument('--units', type=int, nargs='+', default=None, help='Numbers of emergency units')
+    benchmark.add_argument('--repeat', type=int, default=3, help='Number of timed calls of each benchmark')
+    benchmark.add_argument('--save', default=None, help='Path of the JSON baseline to save the measurements to')
+    benchmark.add_argument('--compare', default=None, help='Path of a JSON baseline to compare the measurements to')
+    benchmark.add_argument('--tolerance', type=float, default=0.2, help='Relative increase considered a regression')
+    benchmark.set_defaults(command_function=benchmark_command)
+
+    serve = subcommands.add_parser('serve', help='Run the local simulation service')
+    serve.add_argument('--host', default='127.0.0.1', help='Address the service listens on')
+    serve.add_argument('--port', type=int, default=8765, help='Port the service listens on, any free port if 0')
+    serve.add_argument('--workers', type=int, default=2, help='Number of worker processes')
+    serve.add_argument('--cache', default=None, help='Directory of the city cache of the workers')
+    serve.set_defaults(command_function=serve_command)
+    return parser
+
+
+def main_cli(argv: list = None) -> int:
+    """
+    Parses the arguments and runs the subcommand.
+    :param argv: Arguments, defaults to the arguments of the command line
+    :return: Exit code
+    """
+    arguments = build_parser().parse_args(argv)
+    try:
+        return arguments.command_function(arguments)
+    except KeyboardInterrupt:
+        return EXIT_FAILURE
+    except ValueError as v:
+        print(v, file=sys.stderr)
+        return EXIT_FAILURE
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
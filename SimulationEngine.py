@@ -0,0 +1,274 @@
+"""
+Discrete-event engine which advances one simulation run on an explicit simulation clock, measured in minutes.
+"""
+import heapq
+import itertools
+import math
+import time
+import numpy as np
+from collections import deque
+from Emergency import Emergency, EmergencyTable
+from EmergencyUnit import EmergencyUnit, UnitIndex
+from CityConfiguration import City
+from SimulationStats import SimulationStats
+
+
+class SimulationEngine:
+    """
+    Priority-queue discrete-event engine representing one run (one day) of the simulation. Instead of spending program
+    time to represent the passage of simulated time, every change of state of the city is scheduled as an event at the
+    simulated minute at which it occurs, and the events are processed in chronological order. A run can also span
+    several days continuously, scheduling the traffic updates and emergencies of each day as it starts and running up
+    to its end (see schedule_traffic_updates() and run()), so that busy teams and waiting emergencies carry over
+    midnight.
+    By default the teams allocated to an emergency are relieved as soon as the emergency has been allocated all its
+    teams, as in the original threaded simulation, where the program time spent keeping the teams busy was much
+    shorter than the time between two emergencies: every emergency is responded to by the closest units with all
+    their teams available, which gives the statistics of the shipped configurations and results. If teams are held,
+    they stay busy on the simulation clock while they commute to the emergency, resolve it and commute back, and
+    emergencies compete for the teams (e.g. to study the congestion of a city whose units are overloaded).
+    """
+    # Event types, listed in the order in which they are processed when scheduled for the same minute. Traffic is
+    # updated before anything else occurs in the minute, and teams relieved in a minute are available to respond to
+    # emergencies occurring in the same minute.
+    TRAFFIC = 0
+    RELEASE = 1
+    ARRIVAL = 2
+    DISPATCH = 3
+    # Minutes of the day at which the traffic across the paths of the city is updated (every 6 hours of real-time)
+    traffic_update_minutes = [0, 359, 719, 1079]
+    minutes_in_a_day = 1440
+
+    def __init__(self, city: City, units: list = None, rng: np.random.Generator = None,
+                 traffic_weights: np.ndarray = None, traffic_update_minutes: list = None,
+                 stats: SimulationStats = None, hold_teams: bool = False):
+        """
+        Initialize an empty event queue with the clock set to the start of the day, and schedule the traffic updates
+        of the day.
+        :param city: City configured where the emergencies of the run take place
+        :param units: List of the emergency units responding to the emergencies of the run, indexed by the engine
+        (see UnitIndex), defaults to EmergencyUnit.response_buildings
+        :param rng: Numpy random number generator used for the traffic penalties of the run
+        :param traffic_weights: Numpy array of the commute times of the edges of the city at each traffic update
+        (one row per minute of traffic_update_minutes), replayed instead of drawing the traffic penalties, e.g. from a
+        ScenarioTrace or a TrafficProfile
+        :param traffic_update_minutes: Minutes of the day at which the traffic is updated, defaults to the class
+        variable traffic_update_minutes
+        :param stats: SimulationStats to which the counters and timers of the run are added, the run is not profiled
+        if not given
+        :param hold_teams: Whether the teams allocated to an emergency are held for the time they take to resolve it on
+        the simulation clock, instead of being relieved as soon as the emergency has been allocated all its teams
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> engine = SimulationEngine(city)
+        >>> engine.clock
+        0
+        >>> sorted(event[0] for event in engine.event_queue)
+        [0, 359, 719, 1079]
+        >>> sorted(event[3] for event in SimulationEngine(city, traffic_update_minutes=[0, 480, 1020]).event_queue)
+        [0, 1, 2]
+        """
+        self.city = city
+        if units is None:
+            self.units = EmergencyUnit.response_buildings
+            self.unit_index = EmergencyUnit.building_index
+        else:
+            self.units = units
+            self.unit_index = UnitIndex(units)
+        self.rng = rng
+        self.traffic_weights = traffic_weights
+        self.clock = 0
+        self.event_queue = []
+        # Emergencies which occurred but are still waiting for the required number of teams, in order of occurrence
+        self.waiting_emergencies = deque()
+        # List containing all the Emergency objects which occurred during the run
+        self.emergencies = []
+        # Table of the emergencies which have been allocated all the required teams, in order of allocation, since the
+        # table was last cleared (e.g. at the end of each day of a multi-day run)
+        self.responses = EmergencyTable()
+        self.dispatch_pending = False
+        self.stats = stats
+        self.hold_teams = hold_teams
+        self.sequence = itertools.count()
+        self.traffic_update_minutes = SimulationEngine.traffic_update_minutes if traffic_update_minutes is None \
+            else traffic_update_minutes
+        self.schedule_traffic_updates(0)
+
+    @staticmethod
+    def time_of_day(minute) -> int:
+        """
+        Time of day identifier of a minute of the simulation (see City.traffic_time_weights), each identifier covering
+        6 hours of the day.
+        :param minute: Minute of the simulation, counted from the start of the first day
+        :return: Time of day identifier
+        >>> [SimulationEngine.time_of_day(minute) for minute in [0, 359, 719, 1079, 1439, 1440 + 359]]
+        [0, 1, 2, 3, 0, 1]
+        """
+        return math.floor((minute % SimulationEngine.minutes_in_a_day + 1) / 360) % 4
+
+    def schedule_traffic_updates(self, day: int):
+        """
+        Schedule the traffic updates of a day of the run.
+        :param day: Day of the run, counted from 0
+        :return: None
+        """
+        for update, minute in enumerate(self.traffic_update_minutes):
+            minute += day * SimulationEngine.minutes_in_a_day
+            # Replayed commute times are listed by traffic update, drawn ones depend on the time of day
+            self.schedule(minute, SimulationEngine.TRAFFIC,
+                          update if self.traffic_weights is not None else SimulationEngine.time_of_day(minute))
+
+    def schedule(self, time, event_type: int, payload=None):
+        """
+        Add an event to the event queue. Events scheduled for the same minute and of the same type are processed in the
+        order in which they were scheduled.
+        :param time: Simulated minute at which the event occurs
+        :param event_type: One of the event type class variables
+        :param payload: Data needed to process the event (time of day identifier or index of the replayed traffic
+        update, tuple of zone, location and intensity of an emergency, or Emergency object)
+        :return: None
+        >>> city = City(2, 1, [400, 800], [0.4, 0.2, 0.2, 0.1, 0.1])
+        >>> engine = SimulationEngine(city)
+        >>> engine.schedule(-1, SimulationEngine.ARRIVAL, (0, None, None))
+        Traceback (most recent call last):
+        ...
+        ValueError: Cannot schedule an event before the current simulation time
+        """
+        if time < self.clock:
+            raise ValueError("Cannot schedule an event before the current simulation time")
+        heapq.heappush(self.event_queue, (time, event_type, next(self.sequence), payload))
+
+    def schedule_arrivals(self, arrivals: np.ndarray, offset: int = 0):
+        """
+        Schedule an arrival event for each of the emergencies drawn using Emergency.generate_arrivals().
+        :param arrivals: Numpy structured array of Emergency.arrival_dtype records
+        :param offset: Minute of the run from which the minutes of the arrivals are counted, e.g. the start of a day
+        :return: None
+        >>> city = City(2, 1, [400, 800], [0, 0, 0, 1, 0])
+        >>> engine = SimulationEngine(city)
+        >>> engine.schedule_arrivals(Emergency.generate_arrivals(city, np.asarray([1.0, 0.0]), 2))
+        >>> sorted(event[3] for event in engine.event_queue if event[1] == SimulationEngine.ARRIVAL)[0][2]
+        4
+        """
+        for minute, zone, row, col, intensity in arrivals.tolist():
+            self.schedule(offset + minute, SimulationEngine.ARRIVAL, (zone, (row, col), intensity))
+
+    def run(self, until: int = None):
+        """
+        Process the events in chronological order until the event queue is empty, i.e. until every emergency that
+        occurred has been responded to, and the teams allocated to it have been relieved. If a minute is given to run
+        until, only the events occurring before it are processed, and the emergencies still waiting for teams and the
+        teams still busy carry over to the next call.
+        :param until: Minute before which events are processed, e.g. the end of a day
+        :return: List of the Emergency objects which occurred during the run
+        >>> from EmergencyUnit import EmergencyUnit
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> unit = EmergencyUnit('small', (1, 1))
+        >>> engine = SimulationEngine(city, hold_teams=True)
+        >>> engine.schedule(10, SimulationEngine.ARRIVAL, (0, None, None))
+        >>> engine.schedule(10, SimulationEngine.ARRIVAL, (0, None, None))
+        >>> first, second = engine.run()
+        >>> first.waiting_time, second.waiting_time == first.time_to_resolve
+        (0, True)
+        >>> unit.available_capacity
+        3
+        >>> engine = SimulationEngine(city)
+        >>> engine.schedule(10, SimulationEngine.ARRIVAL, (0, None, None))
+        >>> engine.schedule(10, SimulationEngine.ARRIVAL, (0, None, None))
+        >>> [emergency.waiting_time for emergency in engine.run()], unit.available_capacity
+        ([0, 0], 3)
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> engine = SimulationEngine(city)
+        >>> engine.schedule(10, SimulationEngine.ARRIVAL, (0, None, None))
+        >>> engine.run()
+        Traceback (most recent call last):
+        ...
+        ValueError: Insufficient emergency teams configured in the city to respond to 1 emergencies
+        >>> EmergencyUnit.clear_emergency_buildings()
+        >>> unit = EmergencyUnit('small', (1, 1))
+        >>> engine = SimulationEngine(city, hold_teams=True)
+        >>> engine.schedule(1436, SimulationEngine.ARRIVAL, (0, (1, 1), 1))
+        >>> len(engine.run(until=1440)), unit.available_capacity
+        (1, 0)
+        >>> engine.run(until=2880)[0].time_to_resolve, unit.available_capacity, engine.clock
+        (7.0, 3, 1443.0)
+        >>> engine = SimulationEngine(city, [EmergencyUnit('small', (0, 0))], stats=SimulationStats(), hold_teams=True)
+        >>> for minute in [10, 10, 11]:
+        ...     engine.schedule(minute, SimulationEngine.ARRIVAL, (0, (1, 1), 1))
+        >>> _ = engine.run()
+        >>> stats = engine.stats.counters
+        >>> stats['arrivals'], stats['closest_unit_searches'], stats['blocked_allocations'], stats['emergencies_waited']
+        (3, 6, 3, 2)
+        >>> stats['waiting_minutes'] == engine.emergencies[1].waiting_time + engine.emergencies[2].waiting_time
+        True
+        """
+        stats = self.stats
+        while self.event_queue and (until is None or self.event_queue[0][0] < until):
+            self.clock, event_type, _, payload = heapq.heappop(self.event_queue)
+            if stats is not None:
+                start = time.perf_counter()
+            if event_type == SimulationEngine.TRAFFIC:
+                if self.traffic_weights is None:
+                    self.city.update_graph_edges(payload, self.rng)
+                else:
+                    self.city.set_edge_weights(self.traffic_weights[payload])
+                if stats is not None:
+                    stats.record_peak('travel_time_table_bytes', self.city.travel_time_table_bytes)
+            elif event_type == SimulationEngine.RELEASE:
+                payload.release_teams()
+                self.request_dispatch()
+            elif event_type == SimulationEngine.ARRIVAL:
+                zone, location, intensity = payload
+                emergency = Emergency(self.city, zone, self.clock, location, intensity)
+                self.emergencies.append(emergency)
+                self.waiting_emergencies.append(emergency)
+                self.request_dispatch()
+            elif event_type == SimulationEngine.DISPATCH:
+                self.dispatch_pending = False
+                self.dispatch_waiting_emergencies()
+            if stats is not None:
+                stats.record_event(event_type, time.perf_counter() - start)
+        if self.waiting_emergencies and until is None:
+            raise ValueError(f"Insufficient emergency teams configured in the city to respond to "
+                             f"{len(self.waiting_emergencies)} emergencies")
+        return self.emergencies
+
+    def request_dispatch(self):
+        """
+        Schedule a dispatch event at the current minute if there are emergencies waiting for teams, and no dispatch
+        event is already scheduled.
+        :return: None
+        """
+        if self.waiting_emergencies and not self.dispatch_pending:
+            self.dispatch_pending = True
+            self.schedule(self.clock, SimulationEngine.DISPATCH)
+
+    def dispatch_waiting_emergencies(self):
+        """
+        Allocate the available teams to the waiting emergencies, in the order in which the emergencies occurred. An
+        emergency which cannot be allocated the required number of teams keeps the teams allocated to it so far, and
+        the emergencies occurring after it keep waiting until teams are relieved, as no two emergencies are allocated
+        teams at the same time. The teams of every emergency which has been allocated all the required teams are
+        relieved at once, or scheduled to be relieved once they have commuted to the emergency, resolved it and
+        commuted back if teams are held.
+        :return: None
+        """
+        stats = self.stats
+        while self.waiting_emergencies:
+            emergency = self.waiting_emergencies[0]
+            emergency.resolve_emergency(self.clock, self.unit_index)
+            if stats is not None:
+                stats.counters['closest_unit_searches'] += 1
+                if emergency.time_to_respond is None:
+                    stats.counters['blocked_allocations'] += 1
+                elif emergency.waiting_time > 0:
+                    stats.counters['emergencies_waited'] += 1
+                    stats.counters['waiting_minutes'] += emergency.waiting_time
+            if emergency.time_to_respond is None:
+                break
+            self.waiting_emergencies.popleft()
+            self.responses.append(emergency)
+            if self.hold_teams:
+                self.schedule(self.clock + emergency.time_to_resolve, SimulationEngine.RELEASE, emergency)
+            else:
+                emergency.release_teams()
@@ -0,0 +1,493 @@
+"""
+Local simulation service: an asyncio HTTP server which queues the configurations submitted by several clients, runs
+them on a fixed pool of warm worker processes, and streams the progress and results of the simulations back as JSON.
+Start it with the serve subcommand of SimulationCLI.py, and submit configurations in the format of CityConfig:
+
+    python SimulationCLI.py serve --port 8765 --workers 4
+
+    POST /jobs               {"config": {...}, "runs": 100, "seed": 1, "rate": null, "lockstep": 1, "client": "ana"}
+    GET  /jobs               status of every job
+    GET  /jobs/<id>          status and result of a job
+    GET  /jobs/<id>/events   status, progress and result of a job as JSON lines, until the job ends
+    GET  /status             number of workers, running jobs and queued jobs
+"""
+import asyncio
+import contextlib
+import hashlib
+import http.client
+import io
+import itertools
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from CityConfig import CityConfig
+
+# Parameters of a submission other than the configuration, with their defaults
+submission_defaults = {'runs': 100, 'seed': None, 'rate': None, 'lockstep': 1}
+# Largest request body accepted, in bytes
+max_body_bytes = 2 ** 24
+# Reasons of the HTTP status codes of the responses
+status_reasons = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  413: 'Payload Too Large'}
+# State of a worker process: modules of the simulation, city cache and queue of the progress of the jobs
+worker_state = {}
+
+
+def initialize_worker(progress_queue, cache_directory: str):
+    """
+    Initializer of the worker processes of the service, importing the modules of the simulation once per worker and
+    opening the city cache shared by the workers, so that jobs start without paying for either.
+    :param progress_queue: multiprocessing Queue to which the progress of the jobs is put
+    :param cache_directory: Directory of the CityCache of the workers
+    :return: None
+    """
+    import main
+    from CityCache import CityCache
+    worker_state['main'] = main
+    worker_state['cache'] = CityCache(cache_directory)
+    worker_state['progress'] = progress_queue
+
+
+def warm_up() -> int:
+    """
+    Task submitted to every worker when the service starts, so that the workers are started and initialized before
+    the first job arrives.
+    :return: Process identifier of the worker
+    """
+    return multiprocessing.current_process().pid
+
+
+def run_job(job_id: int, config_data: dict, runs: int, seed: int, rate: float, lockstep: int) -> dict:
+    """
+    Simulates a submitted configuration in a worker process, putting the progress of the runs to the progress queue.
+    :param job_id: Identifier of the job
+    :param config_data: Configuration, in the format of CityConfig.from_dict()
+    :param runs: Number of simulation runs
+    :param seed: Seed of the simulation
+    :param rate: Emergency rate overriding the rate of the configuration, if not None
+    :param lockstep: Number of runs advanced together, see main.simulate_days()
+    :return: Dictionary of the statistics of the simulation
+    """
+    main = worker_state['main']
+    progress_queue = worker_state['progress']
+    start = time.perf_counter()
+    config = CityConfig.from_dict(config_data)
+    city = config.build_city(worker_state['cache'])
+    config.build_units(register=True)
+    base_rate = config.base_rate_for_emergency if rate is None else rate
+    # The messages of the simulation are turned into the error of the job
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        results = main.simulate(city, base_rate, config.base_population, seed, show_progress=False,
+                                number_of_runs=runs, lockstep=lockstep,
+                                progress_callback=lambda run, number_of_runs: progress_queue.put((job_id, run)))
+    resp_times, perc_successful, number_of_emergencies = results[:3]
+    if number_of_emergencies == []:
+        raise ValueError(messages.getvalue().strip() or "The simulation failed")
+    return {'runs': len(resp_times), 'emergencies': number_of_emergencies,
+            'mean_response_time': float(resp_times[-1]), 'success_percentage': float(perc_successful[-1]),
+            'wall_time_seconds': round(time.perf_counter() - start, 3)}
+
+
+class Job:
+    """
+    Simulation of a configuration submitted to the service, shared by every identical submission.
+    """
+
+    def __init__(self, job_id: int, key: str, client: str, submission: dict):
+        """
+        :param job_id: Identifier of the job
+        :param key: Hash of the submission, identical submissions having the same key
+        :param client: Name of the client which first submitted the job
+        :param submission: Configuration and parameters of the simulation, with the seed drawn if it wasn't given
+        """
+        self.id = job_id
+        self.key = key
+        self.client = client
+        self.submission = submission
+        self.status = 'queued'
+        self.run = 0
+        self.result = None
+        self.error = None
+        # Queues of the event streams of the job
+        self.listeners = []
+
+    def as_dict(self) -> dict:
+        """
+        Status of the job, as returned to clients.
+        :return: Dictionary of the status, progress and result of the job
+        """
+        return {'job': self.id, 'client': self.client, 'status': self.status, 'run': self.run,
+                'runs': self.submission['runs'], 'seed': self.submission['seed'], 'result': self.result,
+                'error': self.error}
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def publish(self, event: dict):
+        """
+        Sends an event to every stream of the job, and ends the streams once the job has finished.
+        :param event: Dictionary of the event
+        :return: None
+        """
+        for listener in self.listeners:
+            listener.put_nowait(event)
+            if self.finished:
+                listener.put_nowait(None)
+        if self.finished:
+            self.listeners = []
+
+
+class SimulationService:
+    """
+    Service queueing the simulation jobs of several clients and running them on a fixed pool of worker processes. The
+    queued jobs are started fairly, taking one job of each client with queued jobs in turn, and a submission identical
+    to a job which hasn't failed (same configuration and parameters) is answered with that job instead of being
+    simulated again. The workers keep the modules of the simulation imported and share a CityCache, so cities with
+    the same dimensions and populations are only built once.
+    """
+
+    def __init__(self, workers: int = 2, cache_directory: str = None):
+        """
+        :param workers: Number of worker processes
+        :param cache_directory: Directory of the CityCache of the workers, a temporary directory removed when the
+        service stops if not given
+        """
+        self.workers = workers
+        self.cache_directory = cache_directory
+        self.jobs = {}
+        self.jobs_by_key = {}
+        # Queued jobs of each client, in the order in which the clients are served
+        self.queues = OrderedDict()
+        self.running = 0
+        self.job_ids = itertools.count(1)
+        self.executor = None
+        self.server = None
+        self.progress_queue = None
+        self.progress_reader = None
+        self.temporary_cache = None
+
+    def submit(self, data: dict, client: str) -> tuple:
+        """
+        Validates a submission and queues its job, unless an identical submission already has a job which hasn't
+        failed.
+        :param data: Submission: configuration (config), and optionally runs, seed, rate and lockstep
+        :param client: Name of the client submitting the job
+        :return: Tuple of the job and of whether it is the job of an identical submission
+        >>> config = {'width': 1, 'height': 1, 'zone_populations': [5000], 'intensity_distribution': [1, 0, 0, 0, 0],
+        ...           'buildings': {'small': [[1, 1], [0, 0]]}}
+        >>> service = SimulationService()
+        >>> job, deduplicated = service.submit({'config': config, 'runs': 5, 'seed': 1}, 'ana')
+        >>> job.id, deduplicated, service.submit({'runs': 5, 'config': config, 'seed': 1}, 'ben')[0].id
+        (1, False, 1)
+        >>> service.submit({'config': config, 'runs': 0}, 'ana')
+        Traceback (most recent call last):
+        ...
+        ValueError: runs should be a positive integer
+        """
+        if not isinstance(data, dict) or 'config' not in data:
+            raise ValueError("The submission should be a JSON object with a config field")
+        unknown = set(data) - set(submission_defaults) - {'config', 'client'}
+        if unknown:
+            raise ValueError(f"Unknown fields of the submission: {', '.join(sorted(unknown))}")
+        submission = dict(submission_defaults)
+        submission.update({name: value for name, value in data.items() if name != 'client'})
+        for name in ['runs', 'lockstep']:
+            if type(submission[name]) is not int or submission[name] < 1:
+                raise ValueError(f"{name} should be a positive integer")
+        if submission['seed'] is not None and (type(submission['seed']) is not int or submission['seed'] < 0):
+            raise ValueError("seed should be a non-negative integer")
+        if submission['rate'] is not None and (type(submission['rate']) not in (int, float) or
+                                               submission['rate'] <= 0):
+            raise ValueError("rate should be a number greater than 0")
+        submission['config'] = CityConfig.from_dict(submission['config']).to_dict()
+        key = hashlib.sha256(json.dumps(submission, sort_keys=True).encode()).hexdigest()
+        job = self.jobs_by_key.get(key)
+        if job is not None and job.status != 'failed':
+            return job, True
+        if submission['seed'] is None:
+            # A seed is always reported, so that every job can be reproduced
+            import numpy as np
+            submission['seed'] = np.random.SeedSequence().entropy
+        job = Job(next(self.job_ids), key, client, submission)
+        self.jobs[job.id] = job
+        self.jobs_by_key[key] = job
+        self.queues.setdefault(client, deque()).append(job)
+        self.schedule()
+        return job, False
+
+    def next_job(self) -> Job:
+        """
+        Takes the next job to start, from the client served least recently among the clients with queued jobs.
+        :return: Job, None if no job is queued
+        >>> config = {'width': 1, 'height': 1, 'zone_populations': [5000], 'intensity_distribution': [1, 0, 0, 0, 0],
+        ...           'buildings': {'small': [[1, 1], [0, 0]]}}
+        >>> service = SimulationService()
+        >>> for runs, client in [(1, 'ana'), (2, 'ana'), (3, 'ana'), (4, 'ben'), (5, 'cem')]:
+        ...     _ = service.submit({'config': config, 'runs': runs}, client)
+        >>> [service.next_job().submission['runs'] for _ in range(5)], service.next_job()
+        ([1, 4, 5, 2, 3], None)
+        """
+        if not self.queues:
+            return None
+        client, queue = self.queues.popitem(last=False)
+        job = queue.popleft()
+        if queue:
+            self.queues[client] = queue
+        return job
+
+    def schedule(self):
+        """
+        Starts queued jobs while workers are free.
+        :return: None
+        """
+        while self.executor is not None and self.running < self.workers:
+            job = self.next_job()
+            if job is None:
+                break
+            self.running += 1
+            asyncio.get_running_loop().create_task(self.run(job))
+
+    async def run(self, job: Job):
+        """
+        Runs a job on the worker pool, and publishes its result.
+        :param job: Job started
+        :return: None
+        """
+        job.status = 'running'
+        job.publish({'event': 'status', **job.as_dict()})
+        submission = job.submission
+        executor = self.executor
+        try:
+            job.result = await asyncio.get_running_loop().run_in_executor(
+                executor, run_job, job.id, submission['config'], submission['runs'], submission['seed'],
+                submission['rate'], submission['lockstep'])
+            job.status = 'done'
+        except BrokenProcessPool:
+            job.error = "A worker process stopped unexpectedly, e.g. running out of memory"
+            job.status = 'failed'
+            # The other jobs of the broken pool fail as well, and the next jobs run on a new pool
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.executor = self.create_executor()
+        except Exception as e:
+            # An error of a job (invalid city, insufficient teams, crash of the worker) only fails the job
+            job.error = str(e) or type(e).__name__
+            job.status = 'failed'
+        finally:
+            self.running -= 1
+        job.publish({'event': 'result', **job.as_dict()})
+        self.schedule()
+
+    async def read_progress(self):
+        """
+        Publishes the progress of the running jobs put to the progress queue by the workers, until None is put.
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, self.progress_queue.get)
+            if message is None:
+                break
+            job_id, run = message
+            job = self.jobs.get(job_id)
+            if job is not None and job.status == 'running':
+                job.run = run
+                job.publish({'event': 'progress', 'job': job_id, 'run': run, 'runs': job.submission['runs']})
+
+    def create_executor(self) -> ProcessPoolExecutor:
+        """
+        Creates the pool of worker processes.
+        :return: ProcessPoolExecutor
+        """
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=initialize_worker,
+                                   initargs=(self.progress_queue, self.cache_directory or self.temporary_cache))
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """
+        Starts the worker pool and the HTTP server, and the jobs already submitted.
+        :param host: Address the server listens on, only the local host by default
+        :param port: Port the server listens on, any free port if 0
+        :return: Port the server listens on
+        """
+        if self.cache_directory is None:
+            self.temporary_cache = tempfile.mkdtemp(prefix='city_cache_')
+        self.progress_queue = multiprocessing.Queue()
+        self.executor = self.create_executor()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.executor, warm_up) for _ in range(self.workers)])
+        self.progress_reader = loop.create_task(self.read_progress())
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.schedule()
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """
+        Stops the HTTP server and the worker pool, cancelling the queued jobs.
+        :return: None
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        executor, self.executor = self.executor, None
+        await asyncio.get_running_loop().run_in_executor(None, lambda: executor.shutdown(cancel_futures=True))
+        self.progress_queue.put(None)
+        await self.progress_reader
+        if self.temporary_cache is not None:
+            shutil.rmtree(self.temporary_cache, ignore_errors=True)
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 0, ready=None):
+        """
+        Runs the service until it is cancelled, e.g. by a keyboard interrupt.
+        :param host: Address the server listens on
+        :param port: Port the server listens on
+        :param ready: Function called with the port once the service has started
+        :return: None
+        """
+        port = await self.start(host, port)
+        if ready is not None:
+            ready(port)
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles one HTTP request, closing the connection once answered.
+        :param reader: Stream of the request
+        :param writer: Stream of the response
+        :return: None
+        """
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > max_body_bytes:
+                await respond(writer, 413, {'error': f"Request bodies are limited to {max_body_bytes} bytes"})
+            else:
+                body = await reader.readexactly(length) if length else b''
+                await self.route(method, target.split('?')[0].rstrip('/'), body, writer)
+        except (ValueError, asyncio.IncompleteReadError):
+            await respond(writer, 400, {'error': "Malformed HTTP request"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter):
+        """
+        Answers a request to one of the endpoints of the service.
+        :param method: HTTP method of the request
+        :param path: Path of the request
+        :param body: Body of the request
+        :param writer: Stream of the response
+        :return: None
+        """
+        parts = path.strip('/').split('/')
+        if parts == ['status']:
+            await respond(writer, 200, {'workers': self.workers, 'running': self.running,
+                                        'queued': sum(len(queue) for queue in self.queues.values())})
+        elif parts == ['jobs'] and method == 'POST':
+            try:
+                data = json.loads(body)
+                job, deduplicated = self.submit(data, str(data.get('client', 'anonymous')))
+            except (ValueError, AttributeError) as e:
+                await respond(writer, 400, {'error': str(e)})
+                return
+            await respond(writer, 202, {**job.as_dict(), 'deduplicated': deduplicated})
+        elif parts == ['jobs']:
+            await respond(writer, 200, [job.as_dict() for job in self.jobs.values()])
+        elif parts[0] != 'jobs' or len(parts) > 3 or not parts[1].isdigit() or int(parts[1]) not in self.jobs or \
+                (len(parts) == 3 and parts[2] != 'events'):
+            await respond(writer, 404, {'error': f"Not found: {path}"})
+        elif method != 'GET':
+            await respond(writer, 405, {'error': f"{method} is not allowed on {path}"})
+        elif len(parts) == 2:
+            await respond(writer, 200, self.jobs[int(parts[1])].as_dict())
+        else:
+            await self.stream(self.jobs[int(parts[1])], writer)
+
+    async def stream(self, job: Job, writer: asyncio.StreamWriter):
+        """
+        Streams the status, progress and result of a job as JSON lines, until the job ends.
+        :param job: Job streamed
+        :param writer: Stream of the response
+        :return: None
+        """
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n')
+        event = {'event': 'result' if job.finished else 'status', **job.as_dict()}
+        events = asyncio.Queue()
+        if not job.finished:
+            job.listeners.append(events)
+        while event is not None:
+            writer.write(json.dumps(event).encode() + b'\n')
+            await writer.drain()
+            event = await events.get() if event['event'] != 'result' else None
+
+
+async def respond(writer: asyncio.StreamWriter, status: int, payload):
+    """
+    Writes a JSON response.
+    :param writer: Stream of the response
+    :param status: HTTP status code
+    :param payload: Body of the response, serialized as JSON
+    :return: None
+    """
+    body = json.dumps(payload).encode()
+    writer.write(f'HTTP/1.1 {status} {status_reasons[status]}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+    await writer.drain()
+
+
+def request_service(port: int, method: str, path: str, data: dict = None, host: str = '127.0.0.1') -> tuple:
+    """
+    Client of the service, e.g. for a notebook: sends a request and waits for the whole response.
+    :param port: Port of the service
+    :param method: HTTP method
+    :param path: Path of the endpoint
+    :param data: Body of the request, serialized as JSON
+    :param host: Address of the service
+    :return: Tuple of the status code and of the JSON body of the response, or of the list of events of a stream
+    >>> config = {'width': 1, 'height': 1, 'zone_populations': [5000], 'intensity_distribution': [1, 0, 0, 0, 0],
+    ...           'buildings': {'small': [[1, 1], [0, 0]]}, 'emergency_rate': {'rate': 1, 'base_population': 200000}}
+    >>> async def session(service):
+    ...     port = await service.start()
+    ...     submission = {'config': config, 'runs': 3, 'seed': 1}
+    ...     first = await asyncio.to_thread(request_service, port, 'POST', '/jobs', submission)
+    ...     second = await asyncio.to_thread(request_service, port, 'POST', '/jobs', {**submission, 'client': 'ben'})
+    ...     _, events = await asyncio.to_thread(request_service, port, 'GET', f"/jobs/{first[1]['job']}/events")
+    ...     invalid = await asyncio.to_thread(request_service, port, 'POST', '/jobs', {'config': {'width': 1}})
+    ...     missing = await asyncio.to_thread(request_service, port, 'GET', '/jobs/7')
+    ...     await service.stop()
+    ...     return first, second, events, invalid, missing
+    >>> first, second, events, invalid, missing = asyncio.run(session(SimulationService(workers=1)))
+    >>> first[0], first[1]['deduplicated'], second[1]['job'] == first[1]['job'], second[1]['deduplicated']
+    (202, False, True, True)
+    >>> events[-1]['event'], events[-1]['status'], events[-1]['result']['runs'], events[-1]['result']['emergencies'] > 0
+    ('result', 'done', 3, True)
+    >>> invalid[0], missing[0]
+    (400, 404)
+    """
+    connection = http.client.HTTPConnection(host, port)
+    try:
+        body = None if data is None else json.dumps(data)
+        connection.request(method, path, body, {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        content = response.read().decode()
+        if response.getheader('Content-Type') == 'application/x-ndjson':
+            return response.status, [json.loads(line) for line in content.splitlines()]
+        return response.status, json.loads(content)
+    finally:
+        connection.close()
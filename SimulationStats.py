@@ -0,0 +1,109 @@
+"""
+Profiling counters and timers of the hot paths of a simulation, collected when profiling is switched on.
+"""
+
+
+class SimulationStats:
+    """
+    Counters and timers (in seconds) of one or more simulation runs, collected by the SimulationEngine of each run and
+    merged across runs (and worker processes) by main.simulate(). The timers of the events cover the processing of
+    each type of event: traffic updates (update_graph_edges() and the rebuild of the travel time table), relieving of
+    teams, arrivals of emergencies and dispatches of teams to the waiting emergencies. The peaks hold the largest value
+    measured across the runs, e.g. the memory used by the travel time table rebuilt at each traffic update.
+    """
+    # Names of the timers and of the counters of the event types of SimulationEngine, indexed by event type
+    event_names = ['traffic', 'release', 'arrival', 'dispatch']
+    event_counter_names = ['traffic_updates', 'releases', 'arrivals', 'dispatches']
+    counter_names = ['runs', 'events', 'traffic_updates', 'releases', 'arrivals', 'dispatches',
+                     'closest_unit_searches', 'blocked_allocations', 'emergencies_waited', 'waiting_minutes']
+    timer_names = ['run', 'arrival_generation', 'traffic', 'release', 'arrival', 'dispatch']
+    peak_names = ['travel_time_table_bytes']
+
+    def __init__(self):
+        self.counters = dict.fromkeys(SimulationStats.counter_names, 0)
+        self.timers = dict.fromkeys(SimulationStats.timer_names, 0.0)
+        self.peaks = dict.fromkeys(SimulationStats.peak_names, 0)
+
+    def record_event(self, event_type: int, seconds: float):
+        """
+        Counts an event processed by the engine and adds the time taken to process it to the timer of its type.
+        :param event_type: Event type of SimulationEngine
+        :param seconds: Time taken to process the event
+        :return: None
+        >>> stats = SimulationStats()
+        >>> stats.record_event(0, 0.5)
+        >>> stats.record_event(0, 0.25)
+        >>> stats.counters['events'], stats.counters['traffic_updates'], stats.timers['traffic']
+        (2, 2, 0.75)
+        """
+        self.counters['events'] += 1
+        self.counters[SimulationStats.event_counter_names[event_type]] += 1
+        self.timers[SimulationStats.event_names[event_type]] += seconds
+
+    def record_peak(self, name: str, value: int):
+        """
+        Keeps the largest value measured for a peak, e.g. the bytes of the travel time table at a traffic update.
+        :param name: Name of the peak
+        :param value: Value measured
+        :return: None
+        >>> stats = SimulationStats()
+        >>> stats.record_peak('travel_time_table_bytes', 288)
+        >>> stats.record_peak('travel_time_table_bytes', 144)
+        >>> stats.peaks['travel_time_table_bytes']
+        288
+        """
+        if value > self.peaks[name]:
+            self.peaks[name] = value
+
+    def merge(self, other):
+        """
+        Adds the counters and timers of other stats to these stats, e.g. those of another run, and keeps the largest of
+        their peaks.
+        :param other: SimulationStats merged
+        :return: None
+        >>> first, second = SimulationStats(), SimulationStats()
+        >>> first.counters['runs'], second.counters['runs'] = 1, 1
+        >>> second.timers['run'] = 2.0
+        >>> first.record_peak('travel_time_table_bytes', 288)
+        >>> second.record_peak('travel_time_table_bytes', 288)
+        >>> first.merge(second)
+        >>> first.counters['runs'], first.timers['run'], first.peaks['travel_time_table_bytes']
+        (2, 2.0, 288)
+        """
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for name, value in other.timers.items():
+            self.timers[name] += value
+        for name, value in other.peaks.items():
+            self.record_peak(name, value)
+
+    def as_dict(self) -> dict:
+        """
+        Flattens the counters, timers and peaks into a single dictionary, the timers being suffixed with _seconds.
+        :return: Dictionary of the counters, timers and peaks
+        >>> stats = SimulationStats().as_dict()
+        >>> stats['dispatch_seconds'], stats['travel_time_table_bytes']
+        (0.0, 0)
+        """
+        stats = dict(self.counters)
+        stats.update({f'{name}_seconds': value for name, value in self.timers.items()})
+        stats.update(self.peaks)
+        return stats
+
+    def report(self) -> str:
+        """
+        Human readable summary of the stats, with the counters per run, the share of the run time of each timer and the
+        peaks.
+        :return: Summary of the stats
+        >>> stats = SimulationStats()
+        >>> stats.record_peak('travel_time_table_bytes', 288)
+        >>> stats.report().splitlines()[-1]
+        'travel_time_table_bytes          288 (peak)'
+        """
+        runs = max(self.counters['runs'], 1)
+        run_time = self.timers['run'] or 1.0
+        lines = [f"{name:<22} {value:>12} ({value / runs:.1f} per run)" for name, value in self.counters.items()]
+        lines += [f"{name + ' time':<22} {value:>11.3f}s ({value / run_time * 100:.1f}% of run time)"
+                  for name, value in self.timers.items()]
+        lines += [f"{name:<22} {value:>12} (peak)" for name, value in self.peaks.items()]
+        return '\n'.join(lines)
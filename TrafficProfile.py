@@ -0,0 +1,157 @@
+"""
+Traffic profiles: the commute times of every edge of a city at each epoch of the day (e.g. every hour or every 15
+minutes), precomputed once and replayed by every run of a simulation instead of drawing the traffic of each run.
+"""
+import hashlib
+import numpy as np
+from CityConfiguration import City
+from SimulationEngine import SimulationEngine
+
+
+class TrafficProfile:
+    """
+    Tensor of the commute times of the edges of a city (epoch x edge), with the minute of the day at which each epoch
+    starts. A profile is only valid for cities with the dimensions it was built for, which are stored with it and
+    checked when it is replayed. When consecutive epochs differ in a few places of the city only, e.g. the congestion
+    of some zones, the travel time table of the emergency units is updated incrementally from one epoch to the next
+    (see City.update_travel_time_table()), so a finer resolution of the traffic doesn't multiply the time of the runs.
+    """
+    # Version of the format of the profile files, profiles saved with another version are rejected when loaded
+    format_version = 1
+
+    def __init__(self, width: int, height: int, minutes, edge_weights: np.ndarray):
+        """
+        :param width: Width of the city in terms of number of zones
+        :param height: Height of the city in terms of number of zones
+        :param minutes: Minute of the day at which each epoch starts, in increasing order from minute 0
+        :param edge_weights: Numpy array of the commute times of the edges, indexed by epoch and edge
+        >>> TrafficProfile(2, 1, [0, 60], np.full((2, 26), 3.0))
+        Traceback (most recent call last):
+        ...
+        ValueError: Expected the commute times of 27 edges at each of the 2 epochs of the traffic profile, got (2, 26)
+        >>> TrafficProfile(2, 1, [0, 1440], np.full((2, 27), 3.0))
+        Traceback (most recent call last):
+        ...
+        ValueError: The epochs of a traffic profile should start at minute 0 and increase within the day, got [0, 1440]
+        """
+        self.width = width
+        self.height = height
+        self.minutes = [int(minute) for minute in minutes]
+        self.edge_weights = np.asarray(edge_weights, dtype=np.float64)
+        # Horizontal edges followed by vertical edges, as in City.build_city_graph()
+        columns, rows = width * City.zone_dimension, height * City.zone_dimension
+        number_of_edges = rows * (columns - 1) + (rows - 1) * columns
+        if self.edge_weights.shape != (len(self.minutes), number_of_edges):
+            raise ValueError(f"Expected the commute times of {number_of_edges} edges at each of the "
+                             f"{len(self.minutes)} epochs of the traffic profile, got {self.edge_weights.shape}")
+        if not self.minutes or self.minutes[0] != 0 or self.minutes[-1] >= SimulationEngine.minutes_in_a_day or \
+                any(later <= earlier for earlier, later in zip(self.minutes, self.minutes[1:])):
+            raise ValueError(f"The epochs of a traffic profile should start at minute 0 and increase within the day, "
+                             f"got {self.minutes}")
+        if not (self.edge_weights > 0).all():
+            raise ValueError("The commute times of a traffic profile should be positive")
+
+    @property
+    def number_of_epochs(self) -> int:
+        return len(self.minutes)
+
+    @staticmethod
+    def draw(city: City, minutes: list, seed: int = None):
+        """
+        Draws the traffic of a city at each epoch, as drawn at the traffic updates of a run (see
+        City.draw_edge_weights()), with the traffic penalty weight of the time of day of the epoch.
+        :param city: City of the profile
+        :param minutes: Minute of the day at which each epoch starts
+        :param seed: Seed for the random number generator
+        :return: TrafficProfile of the city
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> profile = TrafficProfile.draw(city, range(0, 1440, 60), seed=1)
+        >>> profile.number_of_epochs, profile.edge_weights.shape, bool((profile.edge_weights[:6] == 3).all())
+        (24, (24, 27), True)
+        """
+        rng = np.random.default_rng(seed)
+        return TrafficProfile(city.width, city.height, minutes,
+                              [city.draw_edge_weights(SimulationEngine.time_of_day(minute), rng) for minute in minutes])
+
+    @staticmethod
+    def from_zone_congestion(city: City, minutes: list, congestion) -> 'TrafficProfile':
+        """
+        Builds the profile of the congestion of each zone at each epoch, e.g. measured hourly. An edge takes the
+        average congestion of the zones of its two nodes, and its commute time is increased by that fraction of the
+        default commute time, as the traffic penalties of City.draw_edge_weights().
+        :param city: City of the profile
+        :param minutes: Minute of the day at which each epoch starts
+        :param congestion: Array of the congestion of each zone (from 0 for no traffic), indexed by epoch and zone
+        :return: TrafficProfile of the city
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> profile = TrafficProfile.from_zone_congestion(city, [0, 480, 600], [[0, 0], [0, 1], [0, 0]])
+        >>> sorted(set(profile.edge_weights[1].tolist())), bool((profile.edge_weights[2] == 3).all())
+        ([3.0, 4.5, 6.0], True)
+        """
+        congestion = np.asarray(congestion, dtype=np.float64)
+        if congestion.shape != (len(minutes), len(city.zone_populations)):
+            raise ValueError(f"Expected the congestion of {len(city.zone_populations)} zones at each of the "
+                             f"{len(minutes)} epochs of the traffic profile, got {congestion.shape}")
+        edge_congestion = 0.5 * (congestion[:, city.node_zones[city.edge_sources]]
+                                 + congestion[:, city.node_zones[city.edge_destinations]])
+        return TrafficProfile(city.width, city.height, minutes,
+                              City.default_commute_time + City.default_commute_time * edge_congestion)
+
+    def digest(self) -> str:
+        """
+        Hash of the profile, e.g. to key the results of the simulations replaying it (see ResultCache).
+        :return: Hexadecimal digest
+        """
+        digest = hashlib.sha256(np.asarray([self.width, self.height] + self.minutes, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(self.edge_weights).tobytes())
+        return digest.hexdigest()
+
+    def check_city(self, city: City):
+        """
+        Checks that the profile was built for a city with the dimensions of a city.
+        :param city: City against which the profile is replayed
+        :return: None
+        >>> profile = TrafficProfile(2, 1, [0], np.full((1, 27), 3.0))
+        >>> profile.check_city(City(1, 2, [2500, 2500], [1, 0, 0, 0, 0]))
+        Traceback (most recent call last):
+        ...
+        ValueError: The traffic profile was built for a different city (2x1 zones)
+        """
+        if city.width != self.width or city.height != self.height:
+            raise ValueError(f"The traffic profile was built for a different city ({self.width}x{self.height} zones)")
+
+    def save(self, path: str):
+        """
+        Saves the profile to a binary .npz file, with the dimensions of its city.
+        :param path: Path of the profile file
+        :return: None
+        >>> import os, tempfile
+        >>> city = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+        >>> profile = TrafficProfile.draw(city, range(0, 1440, 15), seed=2)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'profile.npz')
+        >>> profile.save(path)
+        >>> loaded = TrafficProfile.load(path, city)
+        >>> loaded.minutes == profile.minutes, loaded.digest() == profile.digest()
+        (True, True)
+        """
+        np.savez(path, format_version=TrafficProfile.format_version, width=self.width, height=self.height,
+                 minutes=np.asarray(self.minutes), edge_weights=self.edge_weights)
+
+    @staticmethod
+    def load(path: str, city: City = None):
+        """
+        Loads a profile saved by save(), rejecting it if it was saved with another version of the format or, if a city
+        is given, if it was built for a city with other dimensions.
+        :param path: Path of the profile file
+        :param city: City against which the profile is replayed
+        :return: TrafficProfile loaded
+        """
+        with np.load(path) as data:
+            if int(data['format_version']) != TrafficProfile.format_version:
+                raise ValueError(f"Traffic profile {path} has format version {int(data['format_version'])}, expected "
+                                 f"version {TrafficProfile.format_version}")
+            profile = TrafficProfile(int(data['width']), int(data['height']), data['minutes'].tolist(),
+                                     data['edge_weights'])
+        if city is not None:
+            profile.check_city(city)
+        return profile
@@ -1,15 +1,20 @@
 """
 Driver program containing functions that control the input and execution of the Monte-Carlo Simulation.
 """
-import math
-import random
+import copy
+import itertools
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from Emergency import Emergency
 from CityConfiguration import City
+from CityConfig import CityConfig
 from EmergencyUnit import EmergencyUnit
-from threading import Thread
+from EventLog import EventLog
+from SimulationEngine import SimulationEngine
+from LockstepEngine import LockstepEngine
+from SimulationStats import SimulationStats
 import numpy as np
-from tqdm import tqdm
 
 
 class ValidationError(Exception):
@@ -27,6 +32,69 @@ class ValidationError(Exception):
         return f"Kindly check {self.flag}, it's passed as {self.x}. This isn't correct. It should be greater than 0"
 
 
+class AntitheticGenerator:
+    """
+    Random number generator of one run of an antithetic pair of runs. Both runs of the pair draw the same underlying
+    uniform random numbers, and the mirrored run uses each uniform number u as 1 - u (and each integer drawn uniformly
+    in [low, high) as low + high - 1 - x), so the two runs are negatively correlated and the variance of their average
+    is reduced. Beta random numbers are drawn by inversion of their distribution function so that they are mirrored as
+    well. Provides the methods of numpy random number generators used by the simulation.
+    """
+
+    def __init__(self, rng: np.random.Generator, mirrored: bool):
+        """
+        :param rng: Numpy random number generator drawing the underlying random numbers, seeded identically for both
+        runs of the pair
+        :param mirrored: Whether the random numbers drawn are mirrored
+        >>> first = AntitheticGenerator(np.random.default_rng(1), False)
+        >>> second = AntitheticGenerator(np.random.default_rng(1), True)
+        >>> bool(np.allclose(first.random(5) + second.random(5), 1))
+        True
+        >>> (first.integers(1, 101, 5) + second.integers(1, 101, 5)).tolist()
+        [101, 101, 101, 101, 101]
+        >>> bool(np.allclose(first.beta(2, 2, 5) + second.beta(2, 2, 5), 1))
+        True
+        """
+        self.rng = rng
+        self.mirrored = mirrored
+
+    def random(self, size=None):
+        uniform = self.rng.random(size)
+        return 1 - uniform if self.mirrored else uniform
+
+    def integers(self, low, high=None, size=None):
+        low, high = (0, low) if high is None else (low, high)
+        integer = self.rng.integers(low, high, size)
+        return low + high - 1 - integer if self.mirrored else integer
+
+    def beta(self, a, b, size=None):
+        # scipy.stats is imported when first needed, as it is slow to import
+        from scipy.stats import beta
+        return beta.ppf(self.random(size), a, b)
+
+
+def run_generators(run_seed: np.random.SeedSequence, mirrored: bool = None) -> tuple:
+    """
+    Creates the random number generators of a simulation run, one for the emergencies and one for the traffic, so that
+    the runs of two configurations with the same seed see the same emergencies and traffic penalties (common random
+    numbers) even when the configurations draw a different number of random numbers of one kind.
+    :param run_seed: Seed sequence of the run
+    :param mirrored: None for ordinary random numbers, False or True for the first or the mirrored run of an antithetic
+    pair of runs (see AntitheticGenerator)
+    :return: Random number generators of the emergencies and of the traffic
+    >>> arrival_rng, traffic_rng = run_generators(np.random.SeedSequence(3))
+    >>> arrival_rng.random() == run_generators(np.random.SeedSequence(3))[0].random() != traffic_rng.random()
+    True
+    """
+    # Two independent states derived from the seed sequence, without spawning from it, so the same seed sequence can be
+    # used by both runs of an antithetic pair
+    state = run_seed.generate_state(8)
+    generators = (np.random.default_rng(state[:4]), np.random.default_rng(state[4:]))
+    if mirrored is None:
+        return generators
+    return tuple(AntitheticGenerator(generator, mirrored) for generator in generators)
+
+
 def poisson_probability(rates: np.array) -> np.array:
     """
     Given an input numpy array of the per-minute rates of emergency for each zone in the city, calculates and returns
@@ -47,7 +115,7 @@ def poisson_probability(rates: np.array) -> np.array:
         raise ValueError("Rates cannot be converted to poisson probabilities")
 
 
-def configure_city_file(configuration_file: str):
+def configure_city_file(configuration_file: str, config_directory: str = "./config"):
     """
     Function to read the configuration file and construct the city
     List of validations being conducted:
@@ -58,6 +126,9 @@ def configure_city_file(configuration_file: str):
     Intensity distributions should sum up to 1
     Unit coordinates should be the same as initial number passed
     If no rate/base population passed, run with default config
+    Structured configuration files (.json or .toml) are validated and read by CityConfig instead.
+    :param configuration_file: Name of the configuration file
+    :param config_directory: Directory containing the configuration file
     :return:
 
     >>> configure_city_file("test_config_1.txt") # doctest: +ELLIPSIS
@@ -72,13 +143,32 @@ def configure_city_file(configuration_file: str):
     Didn't receive either rate or base population. Running the simulation using  default values of rate and population
     >>> c[0].coordinate_populations # doctest: +ELLIPSIS
     [500.0, 500.0, 500.0...400.0]
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> with open(f"{directory}/city.json", 'w') as f:
+    ...     _ = f.write('{"width": 2, "height": 1, "zone_populations": [2500, 2500], '
+    ...                 '"intensity_distribution": [1, 0, 0, 0, 0], "buildings": {"small": [[1, 1], [1, 1]]}}')
+    >>> configure_city_file("city.json", directory)
+    Coordinates are duplicate for EmergencyResponse unit buildings.. - (1, 1)
+    ###Kindly check the configuration file###
+    (None, None, None)
     """
+    if configuration_file.endswith(('.json', '.toml')):
+        Emergency.clear_emergencies()
+        try:
+            config = CityConfig.load(f"{config_directory}/{configuration_file}")
+        except ValueError as v:
+            print(v)
+            print("###Kindly check the configuration file###")
+            return None, None, None
+        config.build_units(register=True)
+        return config.build_city(), config.base_rate_for_emergency, config.base_population
     city_init = 0
     building_flag = ''
     Emergency.clear_emergencies()
     EmergencyUnit.clear_emergency_buildings()
     try:
-        with open(f"./config/{configuration_file}", 'r') as f:
+        with open(f"{config_directory}/{configuration_file}", 'r') as f:
             present_line = f.readline()
             while present_line:
                 if re.search('dimension', present_line, re.IGNORECASE):
@@ -180,14 +270,399 @@ def configure_city_file(configuration_file: str):
     return None, None, None
 
 
-def simulate(test_city, base_rate_for_emergency: float, base_population: int):
+def confidence_half_width(values, confidence: float = 0.95) -> float:
+    """
+    Calculates the half width of the Student t confidence interval of the mean of independent observations.
+    :param values: Observations
+    :param confidence: Confidence level of the interval
+    :return: Half width of the confidence interval, infinite if there are less than 2 observations
+    >>> round(confidence_half_width([4.0, 5.0, 6.0, 5.0]), 4)
+    1.2992
+    >>> confidence_half_width([4.0])
+    inf
+    """
+    if len(values) < 2:
+        return float('inf')
+    from scipy.stats import t
+    return float(t.ppf((1 + confidence) / 2, len(values) - 1) * np.std(values, ddof=1) / np.sqrt(len(values)))
+
+
+# State of a worker process of the process pool used by simulate(), set once per worker by initialize_worker()
+worker_state = {}
+
+
+def simulate_day(test_city, units: list, zone_probabilities: np.array, run_seed: np.random.SeedSequence,
+                 mirrored: bool = None, scenario: tuple = None, record_events: bool = False, profile: bool = False,
+                 traffic_profile=None, hold_teams: bool = False):
+    """
+    Performs one run of the simulation, representing a span of 1 day. The run uses its own copies of the emergency
+    units, so that it doesn't share any state with other runs, and draws all its random numbers (emergencies and
+    traffic) from the random number generators of its seed sequence (see run_generators()), unless it replays a
+    recorded scenario (see ScenarioTrace).
+    :param test_city: The CityConfiguration object representing the city configured in the simulation
+    :param units: List of the emergency units configured in the city
+    :param zone_probabilities: Numpy array of the probabilities of emergency occurring in the next 1 minute, in each
+    zone of the city
+    :param run_seed: Seed sequence of the run
+    :param mirrored: None for ordinary random numbers, False or True for the first or the mirrored run of an antithetic
+    pair of runs
+    :param scenario: Tuple of the emergencies (Emergency.arrival_dtype records) and of the commute times of the edges
+    at each traffic update of a recorded run, replayed instead of drawing random numbers
+    :param record_events: Whether the records of all the emergencies of the run are returned, for an EventLog
+    :param profile: Whether the SimulationStats of the run are returned
+    :param traffic_profile: TrafficProfile whose commute times are replayed at each of its epochs, instead of drawing
+    the traffic of the run
+    :param hold_teams: Whether teams are held for the time they take to resolve an emergency, see SimulationEngine
+    :return: Average response time of the emergencies of the run, percentage of successfully responded emergencies,
+    number of emergencies that occurred, list of tuples of the location of each of the first 5 emergencies and the
+    locations of the emergency units that responded to it, followed by the EventLog records of the emergencies if
+    record_events is True, and by the SimulationStats of the run if profile is True.
+    >>> test = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+    >>> EmergencyUnit.clear_emergency_buildings()
+    >>> units = [EmergencyUnit('small', location) for location in [(1, 1), (1, 4), (0, 0)]]
+    >>> probabilities = np.asarray([0.01, 0.01])
+    >>> day = simulate_day(test, units, probabilities, np.random.SeedSequence(5))
+    >>> day == simulate_day(test, units, probabilities, np.random.SeedSequence(5))
+    True
+    >>> day[2] > 0, [unit.available_capacity for unit in units]
+    (True, [3, 3, 3])
+    >>> profiled = simulate_day(test, units, probabilities, np.random.SeedSequence(5), profile=True)
+    >>> profiled[:4] == day, profiled[4].counters['arrivals'] == day[2], profiled[4].counters['traffic_updates']
+    (True, True, 4)
+    >>> from TrafficProfile import TrafficProfile
+    >>> hourly = TrafficProfile.draw(test, range(0, 1440, 60), seed=1)
+    >>> replayed = simulate_day(test, units, probabilities, np.random.SeedSequence(5), profile=True,
+    ...                         traffic_profile=hourly)
+    >>> replayed[2] == day[2], replayed[4].counters['traffic_updates']
+    (True, 24)
+    """
+    minutes_in_a_day = SimulationEngine.minutes_in_a_day
+    stats = SimulationStats() if profile else None
+    start = time.perf_counter()
+    if scenario is None:
+        arrival_rng, traffic_rng = run_generators(run_seed, mirrored)
+        if traffic_profile is None:
+            engine = SimulationEngine(test_city, [copy.copy(unit) for unit in units], traffic_rng, stats=stats,
+                                      hold_teams=hold_teams)
+        else:
+            engine = SimulationEngine(test_city, [copy.copy(unit) for unit in units],
+                                      traffic_weights=traffic_profile.edge_weights,
+                                      traffic_update_minutes=traffic_profile.minutes, stats=stats,
+                                      hold_teams=hold_teams)
+        arrivals = Emergency.generate_arrivals(test_city, zone_probabilities, minutes_in_a_day, arrival_rng)
+        if profile:
+            stats.timers['arrival_generation'] = time.perf_counter() - start
+    else:
+        arrivals, traffic_weights = scenario
+        engine = SimulationEngine(test_city, [copy.copy(unit) for unit in units], traffic_weights=traffic_weights,
+                                  stats=stats, hold_teams=hold_teams)
+    engine.schedule_arrivals(arrivals)
+    engine.run()
+    Emergency.clear_emergencies()
+    # Statistics of the emergencies of the run (all responded to, in order of occurrence) computed on the columns of the
+    # table of responses: average response time and percentage of emergencies successfully responded to
+    avg_resp_time, perc_successful = engine.responses.statistics()
+    first_emergencies = [(emergency.location, [tuple(key.location) for key in emergency.response_unit])
+                         for emergency in engine.emergencies[:5]]
+    run_result = (avg_resp_time, perc_successful, len(engine.responses), first_emergencies)
+    if record_events:
+        run_result += (EventLog.records(engine.responses),)
+    if profile:
+        stats.counters['runs'] = 1
+        stats.timers['run'] = time.perf_counter() - start
+        run_result += (stats,)
+    return run_result
+
+
+def simulate_batch(test_city, units: list, zone_probabilities: np.array, run_seeds: list, mirrors: list,
+                   hold_teams: bool = False) -> list:
+    """
+    Performs a batch of runs of the simulation in lockstep (see LockstepEngine), each run drawing its emergencies and
+    traffic from the same random number streams as simulate_day(), so that the statistics of each run are the same as
+    those of simulate_day() with the same seed sequence, with the travel time table of the units set in the city (see
+    simulate_days()).
+    :param test_city: The CityConfiguration object representing the city configured in the simulation
+    :param units: List of the emergency units configured in the city
+    :param zone_probabilities: Numpy array of the probabilities of emergency occurring in the next 1 minute, in each
+    zone of the city
+    :param run_seeds: List of the seed sequences of the runs
+    :param mirrors: List of the runs of antithetic pairs, as in simulate_day()
+    :param hold_teams: Whether teams are held for the time they take to resolve an emergency, as in simulate_day()
+    :return: List of the statistics of each run, as returned by simulate_day()
+    >>> test = City(2, 1, [2500, 2500], [0.4, 0.2, 0.2, 0.1, 0.1])
+    >>> EmergencyUnit.clear_emergency_buildings()
+    >>> units = [EmergencyUnit('small', location) for location in [(1, 1), (1, 4), (0, 0)]]
+    >>> probabilities = np.asarray([0.01, 0.01])
+    >>> run_seeds = np.random.SeedSequence(5).spawn(4)
+    >>> batch = simulate_batch(test, units, probabilities, run_seeds, [None] * 4)
+    >>> test.set_unit_locations([unit.location for unit in units])
+    >>> batch == [simulate_day(test, units, probabilities, run_seed) for run_seed in run_seeds]
+    True
+    >>> held = simulate_batch(test, units, probabilities, run_seeds, [None] * 4, hold_teams=True)
+    >>> held == [simulate_day(test, units, probabilities, run_seed, hold_teams=True) for run_seed in run_seeds]
+    True
+    >>> test.set_unit_locations([])
+    """
+    generators = [run_generators(run_seed, mirrored) for run_seed, mirrored in zip(run_seeds, mirrors)]
+    arrivals = [Emergency.generate_arrivals(test_city, zone_probabilities, SimulationEngine.minutes_in_a_day,
+                                            arrival_rng) for arrival_rng, _ in generators]
+    return LockstepEngine(test_city, units, arrivals, [traffic_rng for _, traffic_rng in generators],
+                          hold_teams).run()
+
+
+def initialize_worker(test_city, units: list, zone_probabilities: np.array, traffic_profile=None,
+                      hold_teams: bool = False):
+    """
+    Initializer of the worker processes used by simulate(), storing the city, the emergency units, the zone
+    probabilities, the traffic profile and whether teams are held in the worker, so that they are sent once per worker
+    rather than once per run.
+    :return: None
+    """
+    worker_state['city'] = test_city
+    worker_state['units'] = units
+    worker_state['zone_probabilities'] = zone_probabilities
+    worker_state['traffic_profile'] = traffic_profile
+    worker_state['hold_teams'] = hold_teams
+
+
+def simulate_day_in_worker(run_seed: np.random.SeedSequence, mirrored: bool = None, scenario: tuple = None,
+                           record_events: bool = False, profile: bool = False):
+    """
+    Performs one run of the simulation in a worker process.
+    :param run_seed: Seed sequence of the run, spawned from the seed of the simulation
+    :param mirrored: Run of an antithetic pair, as in simulate_day()
+    :param scenario: Recorded run replayed, as in simulate_day()
+    :param record_events: Whether the records of the emergencies are returned, as in simulate_day()
+    :param profile: Whether the SimulationStats of the run are returned, as in simulate_day()
+    :return: Statistics of the run, as returned by simulate_day()
+    """
+    return simulate_day(worker_state['city'], worker_state['units'], worker_state['zone_probabilities'], run_seed,
+                        mirrored, scenario, record_events, profile, worker_state['traffic_profile'],
+                        worker_state['hold_teams'])
+
+
+def simulate_batch_in_worker(run_seeds: list, mirrors: list):
+    """
+    Performs a batch of runs of the simulation in lockstep in a worker process.
+    :param run_seeds: List of the seed sequences of the runs
+    :param mirrors: List of the runs of antithetic pairs, as in simulate_day()
+    :return: List of the statistics of each run, as returned by simulate_batch()
+    """
+    return simulate_batch(worker_state['city'], worker_state['units'], worker_state['zone_probabilities'], run_seeds,
+                          mirrors, worker_state['hold_teams'])
+
+
+def simulate_days(test_city, base_rate_for_emergency: float, base_population: int, seed: int = None,
+                  workers: int = 1, number_of_runs: int = 100, antithetic: bool = False, trace=None,
+                  record_events: bool = False, profile: bool = False, lockstep: int = 1, traffic_profile=None,
+                  hold_teams: bool = False):
+    """
+    Performs the runs of the simulation of a city, with the emergency units configured in the city, and yields the
+    statistics of each run as it completes (see simulate_day()), in the order of the runs.
+    Every run has its own copy of the emergency units and its own independent streams of random numbers, spawned from
+    the seed of the simulation, so the runs can be spread across a pool of worker processes and a given seed gives the
+    same results whatever the number of workers. Two cities simulated with the same seed see the same emergencies and
+    traffic in their runs, as long as they have the same dimensions and populations. Alternatively the runs replay the
+    emergencies and traffic of a recorded scenario trace (see ScenarioTrace), without drawing any random numbers.
+    :param test_city: The CityConfiguration object representing the city configured in the simulation
+    :param base_rate_for_emergency: Emergency rate per unit minute, for the base population
+    :param base_population: Base population of the emergency rate
+    :param seed: Seed for the random number generators, to reproduce the results of the simulation
+    :param workers: Number of worker processes across which the runs are spread, runs are executed in the current
+    process if 1
+    :param number_of_runs: Number of simulation runs
+    :param antithetic: Whether the runs are antithetic pairs (see AntitheticGenerator), runs 1 and 2 forming the first
+    pair, runs 3 and 4 the second pair, and so on
+    :param trace: ScenarioTrace whose first number_of_runs runs are replayed, recorded for a city with the same
+    dimensions and populations
+    :param record_events: Whether the records of the emergencies of each run are yielded, see simulate_day()
+    :param profile: Whether the SimulationStats of each run are yielded, see simulate_day()
+    :param lockstep: Number of runs advanced together by a LockstepEngine (see simulate_batch()), giving the same
+    statistics as the runs performed one at a time (1) with less work per run, at the cost of holding the travel time
+    tables of all the runs of a batch in memory
+    :param traffic_profile: TrafficProfile replayed by every run instead of drawing the traffic of the runs, built for
+    a city with the same dimensions, see simulate_day()
+    :param hold_teams: Whether teams are held for the time they take to resolve an emergency, see simulate_day()
+    :return: Generator of the statistics of each run
+    >>> test = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+    >>> EmergencyUnit.clear_emergency_buildings()
+    >>> units = [EmergencyUnit('small', location) for location in [(1, 1), (1, 4), (0, 0)]]
+    >>> days = list(simulate_days(test, 1.0, None, seed=2, number_of_runs=4, antithetic=True))
+    >>> len(days), days[0] != days[1]
+    (4, True)
+    >>> days == list(simulate_days(test, 1.0, None, seed=2, number_of_runs=4, antithetic=True, lockstep=3))
+    True
+    >>> held = list(simulate_days(test, 1.0, None, seed=2, number_of_runs=4, antithetic=True, hold_teams=True))
+    >>> held == list(simulate_days(test, 1.0, None, seed=2, number_of_runs=4, antithetic=True, hold_teams=True,
+    ...                            workers=2, lockstep=3))
+    True
+    >>> test.travel_time_table is None
+    True
+    """
+    # Setting rate of the number of emergencies per minute and the population reference for which the rate was
+    # specified to default values, if user input was not provided.
+    base_rate_for_emergency = 13.165119 if base_rate_for_emergency is None else base_rate_for_emergency
+    base_population = 200000 if base_population is None else base_population
+    base_rate_per_person = base_rate_for_emergency/base_population
+    zone_probabilities = poisson_probability(base_rate_per_person * np.asarray(test_city.zone_populations))
+    units = list(EmergencyUnit.response_buildings)
+    scenarios = [None] * number_of_runs
+    if trace is not None:
+        if antithetic:
+            raise ValueError("Recorded scenario traces cannot be replayed as antithetic pairs")
+        trace.check_city(test_city)
+        if number_of_runs > trace.number_of_runs:
+            raise ValueError(f"The scenario trace only has {trace.number_of_runs} runs, {number_of_runs} runs were "
+                             f"requested")
+        scenarios = [trace.scenario(run) for run in range(number_of_runs)]
+    if traffic_profile is not None:
+        if trace is not None:
+            raise ValueError("A scenario trace replays its own traffic, it cannot be replayed with a traffic profile")
+        traffic_profile.check_city(test_city)
+    if lockstep > 1 and (trace is not None or record_events or profile or traffic_profile is not None):
+        raise ValueError("Runs advanced in lockstep cannot replay a scenario trace or a traffic profile, record events "
+                         "or be profiled")
+    # Independent random number streams for every run, shared by the two runs of an antithetic pair
+    if antithetic:
+        run_seeds = [run_seed for run_seed in np.random.SeedSequence(seed).spawn((number_of_runs + 1) // 2)
+                     for _ in range(2)][:number_of_runs]
+        mirrors = ([False, True] * ((number_of_runs + 1) // 2))[:number_of_runs]
+    else:
+        run_seeds = np.random.SeedSequence(seed).spawn(number_of_runs)
+        mirrors = [None] * number_of_runs
+    # Travel times from the emergency units to every coordinate are tabulated at every traffic update
+    test_city.set_unit_locations([unit.location for unit in units])
+    executor = None
+    try:
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=initialize_worker,
+                                           initargs=(test_city, units, zone_probabilities, traffic_profile,
+                                                     hold_teams))
+        if lockstep > 1:
+            batch_seeds = [run_seeds[start:start + lockstep] for start in range(0, number_of_runs, lockstep)]
+            batch_mirrors = [mirrors[start:start + lockstep] for start in range(0, number_of_runs, lockstep)]
+            if executor is not None:
+                batches = executor.map(simulate_batch_in_worker, batch_seeds, batch_mirrors)
+            else:
+                batches = map(simulate_batch, itertools.repeat(test_city), itertools.repeat(units),
+                              itertools.repeat(zone_probabilities), batch_seeds, batch_mirrors,
+                              itertools.repeat(hold_teams))
+            for batch in batches:
+                yield from batch
+        elif executor is not None:
+            yield from executor.map(simulate_day_in_worker, run_seeds, mirrors, scenarios,
+                                    itertools.repeat(record_events), itertools.repeat(profile))
+        else:
+            for run_seed, mirrored, scenario in zip(run_seeds, mirrors, scenarios):
+                yield simulate_day(test_city, units, zone_probabilities, run_seed, mirrored, scenario, record_events,
+                                   profile, traffic_profile, hold_teams)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        test_city.set_unit_locations([])
+
+
+def simulate_horizon(test_city, base_rate_for_emergency: float, base_population: int, days: int = 7,
+                     seed: int = None, traffic_update_minutes: list = None, traffic_profile=None):
+    """
+    Performs one continuous run of the simulation over several days, and yields the statistics of each day as soon as
+    the day ends. Unlike the independent 1 day runs of simulate(), the teams still busy and the emergencies still
+    waiting for teams at midnight carry over to the next day. The emergencies and traffic of each day are drawn when
+    the day starts, from the random number streams of the day, and the emergencies of a day are discarded once its
+    statistics are yielded, so memory use and throughput stay stable over a horizon of any length.
+    The statistics of a day cover the emergencies which were allocated all their teams during the day, including
+    emergencies carried over from earlier days. Teams are always held for the time they take to resolve an emergency
+    (see SimulationEngine), as teams relieved at once never carry over.
+    :param test_city: The CityConfiguration object representing the city configured in the simulation
+    :param base_rate_for_emergency: Emergency rate per unit minute, for the base population
+    :param base_population: Base population of the emergency rate
+    :param days: Number of days of the run
+    :param seed: Seed for the random number generators, to reproduce the results of the simulation
+    :param traffic_update_minutes: Minutes of each day at which the traffic is updated, defaults to
+    SimulationEngine.traffic_update_minutes
+    :param traffic_profile: TrafficProfile replayed every day instead of drawing the traffic, at the minutes of its
+    epochs
+    :return: Generator of a dictionary of the statistics of each day: day (counted from 0), emergencies (that occurred
+    during the day), responded (emergencies allocated their teams during the day), mean_response_time and
+    success_percentage (of the emergencies responded, nan if there are none), backlog (emergencies waiting for teams at
+    midnight) and busy_teams (at midnight)
+    >>> test = City(2, 1, [2500, 2500], [1, 0, 0, 0, 0])
+    >>> EmergencyUnit.clear_emergency_buildings()
+    >>> units = [EmergencyUnit('small', location) for location in [(1, 1), (1, 4), (0, 0)]]
+    >>> week = list(simulate_horizon(test, 1.0, None, days=7, seed=3))
+    >>> [day['day'] for day in week], all(day['responded'] > 0 for day in week)
+    ([0, 1, 2, 3, 4, 5, 6], True)
+    >>> week == list(simulate_horizon(test, 1.0, None, days=7, seed=3))
+    True
+    >>> sum(day['emergencies'] for day in week) == sum(day['responded'] for day in week) + week[-1]['backlog']
+    True
+    >>> [unit.available_capacity for unit in units], test.travel_time_table is None
+    ([3, 3, 3], True)
+    """
+    base_rate_for_emergency = 13.165119 if base_rate_for_emergency is None else base_rate_for_emergency
+    base_population = 200000 if base_population is None else base_population
+    base_rate_per_person = base_rate_for_emergency/base_population
+    zone_probabilities = poisson_probability(base_rate_per_person * np.asarray(test_city.zone_populations))
+    units = [copy.copy(unit) for unit in EmergencyUnit.response_buildings]
+    test_city.set_unit_locations([unit.location for unit in units])
+    if traffic_profile is None:
+        engine = SimulationEngine(test_city, units, traffic_update_minutes=traffic_update_minutes, hold_teams=True)
+    else:
+        traffic_profile.check_city(test_city)
+        engine = SimulationEngine(test_city, units, traffic_weights=traffic_profile.edge_weights,
+                                  traffic_update_minutes=traffic_profile.minutes, hold_teams=True)
+    minutes_in_a_day = SimulationEngine.minutes_in_a_day
+    try:
+        for day, day_seed in enumerate(np.random.SeedSequence(seed).spawn(days)):
+            arrival_rng, engine.rng = run_generators(day_seed)
+            if day > 0:
+                engine.schedule_traffic_updates(day)
+            arrivals = Emergency.generate_arrivals(test_city, zone_probabilities, minutes_in_a_day, arrival_rng)
+            engine.schedule_arrivals(arrivals, day * minutes_in_a_day)
+            engine.run(until=(day + 1) * minutes_in_a_day)
+            mean_response_time, success_percentage = engine.responses.statistics()
+            day_statistics = {
+                'day': day,
+                'emergencies': len(arrivals),
+                'responded': len(engine.responses),
+                'mean_response_time': float(mean_response_time),
+                'success_percentage': float(success_percentage),
+                'backlog': len(engine.waiting_emergencies),
+                'busy_teams': sum(EmergencyUnit.type_to_capacity_mapping[unit.size] - unit.available_capacity
+                                  for unit in units)}
+            # Discarding the emergencies of the day, only the waiting emergencies are carried over
+            engine.emergencies = []
+            engine.responses.clear()
+            Emergency.clear_emergencies()
+            yield day_statistics
+    finally:
+        test_city.set_unit_locations([])
+
+
+def simulate(test_city, base_rate_for_emergency: float, base_population: int, seed: int = None, workers: int = 1,
+             show_progress: bool = True, number_of_runs: int = 100, antithetic: bool = False,
+             relative_precision: float = None, confidence: float = 0.95, min_runs: int = 10, trace=None,
+             event_log: EventLog = None, profile: bool = False, progress_callback=None, lockstep: int = 1,
+             result_cache=None, traffic_profile=None, hold_teams: bool = False):
     """
-    Performs a Monte-Carlo simulation with 100 runs and each run representing a span of 1 day, of emergencies occurring
-    at randomized time and locations within the city, with randomly chosen intensities in the scale of 1 to 5.
-    The traffic present across the different paths in the city is randomized and updated 4 times in a day, over the
-    span of every 6 hours. The emergencies occurring are responded to by the emergency units configured in specific
-    locations across the city, and the statistics of average response time and percentage of successfully responded
-    emergencies are calculated for each run of the simulation, and are aggregated over all the 100 runs.
+    Performs a Monte-Carlo simulation with 100 runs (by default) and each run representing a span of 1 day, of
+    emergencies occurring at randomized time and locations within the city, with randomly chosen intensities in the
+    scale of 1 to 5. The traffic present across the different paths in the city is randomized and updated 4 times in a
+    day, over the span of every 6 hours, unless a traffic profile with a finer resolution (e.g. hourly) is replayed
+    instead (see TrafficProfile). The emergencies occurring are responded to by the emergency units configured
+    in specific locations across the city, and the statistics of average response time and percentage of successfully
+    responded emergencies are calculated for each run of the simulation, and are aggregated over all the runs.
+    Each run is carried out by a discrete-event engine (SimulationEngine), where the occurrence of emergencies, the
+    dispatch of teams and the relieving of teams are events processed on an explicit simulation clock. By default the
+    teams are relieved as soon as they are allocated, which reproduces the statistics of the original threaded
+    simulation; with hold_teams the teams stay busy while they commute and resolve the emergency, and emergencies
+    compete for the teams (a city overloaded at its emergency rate then accumulates a backlog of emergencies).
+    With a relative precision, the simulation stops as soon as the confidence intervals of the mean response time and
+    of the mean percentage of successfully responded emergencies are both narrower than the relative precision of the
+    means (e.g. a half width within 5% of the mean for 0.05), after at least min_runs and at most number_of_runs runs,
+    and the number of runs used is the length of the lists returned.
+    The runs are performed by simulate_days(), so a given seed gives the same results whatever the number of workers,
+    and configurations simulated with the same seed are compared on the same emergencies and traffic.
 
     :param test_city: The CityConfiguration object representing the city configured in the simulation - with a
     defined width, height, population of each zone, and emergency units at specific locations.
@@ -195,9 +670,32 @@ def simulate(test_city, base_rate_for_emergency: float, base_population: int):
     the input file then the default value is considered as calculated from the Montgomery PA data
     :param base_population: Base population as given in the configuration file, if the value isnt given then the default
     value is considered as calculated from the Montgomery PA data
+    :param seed: Seed for the random number generators, to reproduce the results of the simulation
+    :param workers: Number of worker processes across which the runs are spread, runs are executed in the current
+    process if 1
+    :param show_progress: Whether a progress bar of the runs is displayed
+    :param number_of_runs: Number of simulation runs, fewer runs give a cheaper but noisier estimate of the statistics
+    :param antithetic: Whether the runs are antithetic pairs, see simulate_days()
+    :param relative_precision: Relative half width of the confidence intervals at which the simulation stops, the
+    simulation performs all the runs if not given
+    :param confidence: Confidence level of the intervals of the stopping rule
+    :param min_runs: Minimum number of runs with a relative precision
+    :param trace: ScenarioTrace replayed instead of drawing the emergencies and traffic, see simulate_days()
+    :param event_log: EventLog to which every emergency of every run is written, the log is left open
+    :param profile: Whether the counters and timers of the hot paths of the runs are collected and returned, the runs
+    are not instrumented otherwise
+    :param progress_callback: Function called after each run with the number of runs completed and number_of_runs,
+    e.g. to report progress in a machine-readable form instead of the progress bar
+    :param lockstep: Number of runs advanced together, see simulate_days()
+    :param result_cache: ResultCache from which the results are returned if the same city, units and arguments were
+    already simulated with the same seed, and in which they are stored otherwise. Simulations without a seed, replaying
+    a trace, writing an event log or profiled are always simulated.
+    :param traffic_profile: TrafficProfile replayed by every run instead of drawing the traffic, see simulate_days()
+    :param hold_teams: Whether teams are held for the time they take to resolve an emergency, see SimulationEngine
     :return: List of average responses times aggregated after each simulation run, list of percentage of successfully
     responded emergencies aggregated after each simulation run, total number of emergencies that occurred in the
-    entire duration of the simulations, dictionary of details of first 3 emergencies used for visualizations.
+    entire duration of the simulations, dictionary of details of first 3 emergencies used for visualizations, followed
+    by the SimulationStats merged over all the runs if profile is True.
     >>> populations = [2500, 2500]
     >>> intensity_distributions = [1, 0, 0, 0, 0]
     >>> test = City(2, 1, populations, intensity_distributions)
@@ -217,60 +715,100 @@ def simulate(test_city, base_rate_for_emergency: float, base_population: int):
     True
     >>> 90 <= perc[-1]
     True
+    >>> locations = [(1, 1), (1, 3), (1, 5), (0, 2), (0, 4), (2, 0), (2, 2), (2, 4), (0, 0)]
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> first = simulate(test, 1.0, None, seed=7)
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> first[:3] == simulate(test, 1.0, None, seed=7)[:3]
+    True
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> first == simulate(test, 1.0, None, seed=7, workers=2)
+    True
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> adaptive = simulate(test, 1.0, None, seed=7, show_progress=False, number_of_runs=1000, relative_precision=0.05)
+    >>> 10 <= len(adaptive[0]) < 1000, adaptive[0][:10] == first[0][:10]
+    (True, True)
+    >>> import tempfile
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> with EventLog(tempfile.mkdtemp()) as log:
+    ...     logged = simulate(test, 1.0, None, seed=7, show_progress=False, event_log=log)
+    >>> events = EventLog.load(log.directory)
+    >>> logged == first, len(events['run']) == first[2]
+    (True, True)
+    >>> bool(np.isclose(events['response_time'][events['run'] == 0].mean(), first[0][0]))
+    True
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> *profiled, stats = simulate(test, 1.0, None, seed=7, show_progress=False, profile=True)
+    >>> profiled == list(first), stats.counters['runs'], stats.counters['arrivals'] == first[2]
+    (True, 100, True)
+    >>> stats.peaks['travel_time_table_bytes'] == len(locations) * len(test.city_graph) * 8
+    True
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> first == simulate(test, 1.0, None, seed=7, show_progress=False, lockstep=32)
+    True
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> held = simulate(test, 1.0, None, seed=7, show_progress=False, hold_teams=True)
+    >>> held[2] == first[2], held[0][-1] >= first[0][-1]
+    (True, True)
+    >>> from ResultCache import ResultCache
+    >>> cache = ResultCache(tempfile.mkdtemp())
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> first == simulate(test, 1.0, None, seed=7, show_progress=False, result_cache=cache)
+    True
+    >>> units = [EmergencyUnit('small', location) for location in locations]
+    >>> first == simulate(test, 1.0, None, seed=7, show_progress=False, result_cache=cache), len(cache.entries())
+    (True, 1)
     """
-    # Setting rate of the number of emergencies per minute and the population reference for which the rate was
-    # specified to default values, if user input was not provided.
-    base_rate_for_emergency = 13.165119 if base_rate_for_emergency is None else base_rate_for_emergency
-    base_population = 200000 if base_population is None else base_population
-    thread_list = []
-    minutes_in_a_day = 1440
     number_of_emergencies = 0
     aggregate_resp_times = []
     aggregate_perc_successful = []
+    # Statistics of each run, used by the stopping rule
+    run_resp_times = []
+    run_perc_successful = []
     plotting_emergency_dict = {}
+    stats = SimulationStats() if profile else None
+    cache_key = None
     try:
         if test_city is None:
             raise ValueError("Kindly rerun after checking the file...")
-        base_rate_per_person = base_rate_for_emergency/base_population
-        zone_probabilities = poisson_probability(base_rate_per_person * np.asarray(test_city.zone_populations))
+        if result_cache is not None and seed is not None and trace is None and event_log is None and not profile:
+            cache_key = result_cache.key(test_city, EmergencyUnit.response_buildings, base_rate_for_emergency,
+                                         base_population, seed, number_of_runs, antithetic=antithetic,
+                                         relative_precision=relative_precision, confidence=confidence,
+                                         min_runs=min_runs, hold_teams=hold_teams,
+                                         traffic_profile=None if traffic_profile is None else traffic_profile.digest())
+            results = result_cache.get(cache_key)
+            if results is not None:
+                EmergencyUnit.clear_emergency_buildings()
+                if progress_callback is not None:
+                    progress_callback(len(results[0]), number_of_runs)
+                return results
+        run_results = simulate_days(test_city, base_rate_for_emergency, base_population, seed, workers, number_of_runs,
+                                    antithetic, trace, event_log is not None, profile, lockstep, traffic_profile,
+                                    hold_teams)
         # Obtained code for displaying progress bar in for loop from:
         # https://stackoverflow.com/questions/3160699/python-progress-bar
-        # Executing 100 simulation runs
-        for run in tqdm(range(1, 101)):
-            # Each iteration and the corresponding computation in each iteration represents one minute of program/
-            # simulation time
-            for i in range(minutes_in_a_day):
-                # Traffic across the paths in the city are updated 4 times in a day (every 6 hours of real-time)
-                if i in [0, 359, 719, 1079]:
-                    test_city.update_graph_edges(math.floor((i+1)/360))
-                # Using the probability of an emergency occurring in each zone, randomizing if an emergency occurs
-                for zone in range(len(zone_probabilities)):
-                    prob = zone_probabilities[zone]*1000000
-                    if random.randint(1, 1000000) <= prob:
-                        # New thread is spawned for every emergency creation and resolution
-                        th = Thread(target=Emergency, args=[test_city, zone], daemon=False)
-                        th.start()
-                        thread_list.append(th)
-            for th in thread_list:
-                th.join()
-            thread_list = []
-            resp_times = list()
-            successful_response_emergencies = 0
-            for emergency in Emergency.emergencies:
-                number_of_emergencies += 1
-                if emergency.time_to_respond <= Emergency.resolution_time_threshold:
-                    successful_response_emergencies += 1
-                resp_times.append(emergency.time_to_respond)
-            # Calculating average of response time across all emergencies that occurred in 1 day (1 simulation run)
-            avg_resp_time = np.mean(np.asarray(resp_times))
-            # Calculating percentage of emergencies that were successfully responded to in 1 day (1 simulation run)
-            perc_successful = (successful_response_emergencies/len(resp_times))*100
-            # Aggregating the average response time and percentage of successfully responded emergencies over
-            # all simulation runs
+        progress = run_results
+        if show_progress:
+            from tqdm import tqdm
+            progress = tqdm(run_results, total=number_of_runs)
+        # Executing the simulation runs
+        for run, run_result in enumerate(progress, 1):
+            avg_resp_time, perc_successful, emergencies_in_run, first_emergencies = run_result[:4]
+            if progress_callback is not None:
+                progress_callback(run, number_of_runs)
+            if event_log is not None:
+                event_log.write(run_result[4], run - 1)
+            if profile:
+                stats.merge(run_result[-1])
+            number_of_emergencies += emergencies_in_run
+            run_resp_times.append(avg_resp_time)
+            run_perc_successful.append(perc_successful)
+            # Aggregating the average response time and percentage of successfully responded emergencies over all
+            # simulation runs
             if run == 1:
-                for emergency in Emergency.emergencies[:5]:
-                    plotting_emergency_dict[emergency.location] = [tuple(key.location) for key in
-                                                                   emergency.response_unit]
+                for location, unit_locations in first_emergencies:
+                    plotting_emergency_dict[location] = unit_locations
                 aggregate_resp_times.append(avg_resp_time)
                 aggregate_perc_successful.append(perc_successful)
             else:
@@ -280,9 +818,28 @@ def simulate(test_city, base_rate_for_emergency: float, base_population: int):
                 perc_sum_until_now = aggregate_perc_successful[-1] * len(aggregate_perc_successful)
                 avg_perc_successful = (perc_sum_until_now + perc_successful)/run
                 aggregate_perc_successful.append(avg_perc_successful)
-            Emergency.clear_emergencies()
+            # Stopping once the confidence intervals of both statistics are narrow enough, the two runs of an
+            # antithetic pair being averaged into one independent observation
+            if relative_precision is not None and run >= min_runs and not (antithetic and run % 2):
+                if antithetic:
+                    observations = [np.asarray(values).reshape(-1, 2).mean(axis=1)
+                                    for values in (run_resp_times, run_perc_successful)]
+                else:
+                    observations = [run_resp_times, run_perc_successful]
+                if all(confidence_half_width(values, confidence) <= relative_precision * abs(np.mean(values))
+                       for values in observations):
+                    break
+        run_results.close()
         EmergencyUnit.clear_emergency_buildings()
+        if cache_key is not None:
+            result_cache.put(cache_key, (aggregate_resp_times, aggregate_perc_successful, number_of_emergencies,
+                                         plotting_emergency_dict))
+        if profile:
+            return aggregate_resp_times, aggregate_perc_successful, number_of_emergencies, plotting_emergency_dict, \
+                stats
         return aggregate_resp_times, aggregate_perc_successful, number_of_emergencies, plotting_emergency_dict
     except ValueError as v:
         print(v)
+    if profile:
+        return [0], [0], [], {}, stats
     return [0], [0], [], {}